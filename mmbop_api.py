@@ -1,16 +1,27 @@
 """
 Uses Falcon to implement simple API wrapper for mmbop
 """
+import base64
+import collections
+import concurrent.futures
+import functools
 import ipaddress
 import configparser
 import hashlib
 import json
+import queue
+import threading
+import time
+import uuid
+from time import monotonic
 import falcon
-import mmbop
+import mmbop_core
 
 # Pylint really doesn't like falcon, this is to silence false positives
 # pylint: disable=too-few-public-methods,c-extension-no-member,no-self-use,no-member
 
+NDJSON = 'application/x-ndjson'
+
 class HandleCORS:
     """
     To enable all sites to reach the API, as it relies on
@@ -29,6 +40,133 @@ class HandleCORS:
         if req.method == 'OPTIONS':
             raise falcon.http_status.HTTPStatus(falcon.HTTP_200, body='\n')
 
+class ClosedStream:
+    """
+    The stream of a reply, calling finished (with no arguments) when the
+    WSGI server closes it, once the reply has been sent (or the client
+    has gone away)
+    """
+
+    def __init__(self, stream, finished):
+        self.stream = stream
+        self.finished = finished
+
+    def __iter__(self):
+        return iter(self.stream)
+
+    def close(self):
+        """
+        Close the stream (if it can be), then call finished once
+        """
+        (finished, self.finished) = (self.finished, None)
+        try:
+            if hasattr(self.stream, 'close'):
+                self.stream.close()
+        finally:
+            if finished:
+                finished()
+
+class RequestMetrics:
+    """
+    Records the duration of each request, by method, route and status,
+    and the number in progress, in mmbop_core.METRICS (see /metrics). For
+    streamed replies the duration is until the stream is closed, when
+    the whole reply has been sent (see ClosedStream). start and finish
+    are shared with mmbop_asgi.
+    """
+
+    def process_request(self, req, _):
+        """
+        Falcon required method, starting the clock for the request
+        """
+        self.start(req)
+
+    def process_response(self, req, resp, *_):
+        """
+        Falcon required method, recording the request
+        """
+        self.finish(req, resp, ClosedStream)
+
+    @staticmethod
+    def start(req):
+        """
+        Start the clock for the request
+        """
+        req.context.metrics_started = monotonic()
+        mmbop_core.METRICS.inc('mmbop_api_requests_in_flight')
+
+    @classmethod
+    def finish(cls, req, resp, stream_class):
+        """
+        Record the request (or, for a streamed reply, wrap the stream in
+        stream_class to record it when the stream is closed)
+        """
+        started = getattr(req.context, 'metrics_started', None)
+        if started is None:
+            return
+        labels = (req.method, req.uri_template or 'unmatched', str(resp.status).split(' ')[0])
+        if resp.stream is not None:
+            resp.stream = stream_class(resp.stream, functools.partial(cls.record, labels, started))
+        else:
+            cls.record(labels, started)
+
+    @staticmethod
+    def record(labels, started):
+        """
+        Record a request that started (monotonic time) at started
+        """
+        mmbop_core.METRICS.observe('mmbop_api_request_seconds', labels, monotonic() - started)
+        mmbop_core.METRICS.inc('mmbop_api_requests_in_flight', (), -1)
+
+class RequestTiming:
+    """
+    With the request parameter timing=true, traces the request (see
+    mmbop_core.Trace), and reports how long each step took (the backend
+    calls, lookups and planning) in a Server-Timing header. Streamed
+    replies (such as /hostlist) do their work as they are sent, after
+    the header, so with timing=true they are read in full first.
+    start and finish are shared with mmbop_asgi.
+    """
+
+    def process_request(self, req, _):
+        """
+        Falcon required method, starting the trace if asked for
+        """
+        trace = self.start(req)
+        if trace:
+            trace.activate()
+
+    def process_response(self, req, resp, *_):
+        """
+        Falcon required method, adding the Server-Timing header
+        """
+        if getattr(req.context, 'trace', None) and resp.stream is not None:
+            resp.data = b''.join(resp.stream)
+            resp.stream = None
+        self.finish(req, resp)
+
+    @staticmethod
+    def start(req):
+        """
+        Return a new trace for the request (kept in its context) if
+        timing=true, None otherwise
+        """
+        if not req.get_param_as_bool('timing'):
+            return None
+        req.context.trace = mmbop_core.Trace()
+        return req.context.trace
+
+    @staticmethod
+    def finish(req, resp):
+        """
+        Add the Server-Timing header of the trace of the request (if it
+        has one), once the reply has been made
+        """
+        trace = getattr(req.context, 'trace', None)
+        if trace:
+            trace.deactivate()
+            resp.set_header('Server-Timing', trace.finish().server_timing())
+
 class AuthToken:
     """
     Implements simple authentication token
@@ -40,6 +178,8 @@ class AuthToken:
     TOKEN_FILE = './mmbop_api.ini'
     # Key in the token file, the value of which is the hashed token string
     TOKEN_FIELD = 'token'
+    # Routes that do not need the token
+    OPEN_ROUTES = ('/healthz',)
 
     def __init__(self):
         if not self.__class__.AUTH_TOKEN:
@@ -64,6 +204,15 @@ class AuthToken:
         Falcon required method for handling request and (in this case)
         ensuring the provided token is correct
         """
+        self.check(req)
+
+    def check(self, req):
+        """
+        Raise HTTPUnauthorized unless the request has the right token
+        (or is for one of OPEN_ROUTES)
+        """
+        if req.path in self.__class__.OPEN_ROUTES:
+            return
         token = req.get_header('Authorization')
         if not token:
             desc = ('Provide an authentication token in header request')
@@ -82,29 +231,391 @@ class AuthToken:
         """
         return hashlib.sha224(str.encode(token)).hexdigest()
 
+class JobResponse:
+    """
+    Stands in for the falcon response when a responder is run as a job.
+    progress (None outside of JobQueue) is called by the responders that
+    work through a list of items with the number done and the total.
+    """
+
+    def __init__(self, progress=None):
+        self.status = falcon.HTTP_200
+        self.body = None
+        self.location = None
+        self.content_type = None
+        self.stream = None
+        self.progress = progress
+
+class JobQueue:
+    """
+    Runs requests (to the mutating endpoints) as jobs, in a bounded
+    pool of worker threads, so the API can reply straight away.
+    At most max_pending jobs can be queued or running (more are
+    refused), and the last max_kept finished jobs are kept for
+    /jobs/{job_id}. Jobs are kept in the memory of this process.
+    """
+
+    def __init__(self, workers=4, max_kept=1000, max_pending=100):
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=int(workers))
+        self.max_kept = int(max_kept)
+        self.max_pending = int(max_pending)
+        self.pending = 0
+        self.jobs = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def submit(self, responder):
+        """
+        Queue responder (called with a JobResponse) as a new job,
+        return the job id. Raises HTTPServiceUnavailable (503) if
+        max_pending jobs are already queued or running.
+        """
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            if self.pending >= self.max_pending:
+                raise falcon.HTTPServiceUnavailable(
+                    title='Job Queue Full',
+                    description='%d jobs are queued or running, try again later'
+                    % self.pending)
+            self.pending += 1
+            self.jobs[job_id] = {'job': job_id, 'state': 'queued', 'submitted': time.time(),
+                                 'started': None, 'finished': None, 'progress': None,
+                                 'status': None, 'result': None}
+        self.executor.submit(self._run, job_id, responder)
+        return job_id
+
+    def _progress(self, job_id, done, total):
+        """
+        Record that done of the total items of the job are done
+        """
+        with self.lock:
+            self.jobs[job_id]['progress'] = {'done': done, 'total': total}
+
+    def _run(self, job_id, responder):
+        """
+        Run the job in a worker thread, recording its state and result
+        """
+        with self.lock:
+            self.jobs[job_id].update(state='running', started=time.time())
+        job_resp = JobResponse(functools.partial(self._progress, job_id))
+        try:
+            responder(job_resp)
+            result = job_resp.body
+            if job_resp.stream is not None:
+                # Bulk requests stream NDJSON, keep the list of results
+                # (and show them as they come)
+                result = []
+                total = getattr(job_resp.stream, 'count', None)
+                with self.lock:
+                    self.jobs[job_id]['result'] = result
+                self._progress(job_id, 0, total)
+                for chunk in job_resp.stream:
+                    lines = [json.loads(x) for x in chunk.decode().splitlines() if x]
+                    with self.lock:
+                        result.extend(lines)
+                    self._progress(job_id, len(result), total)
+            elif result is not None:
+                try:
+                    result = json.loads(result)
+                except ValueError:
+                    pass
+        except falcon.HTTPError as http_err:
+            (job_resp.status, result) = (http_err.status, http_err.to_dict())
+        except Exception as job_err:  # pylint: disable=broad-except
+            (job_resp.status, result) = (falcon.HTTP_500, str(job_err))
+        with self.lock:
+            self.pending -= 1
+            self.jobs[job_id].update(state='done', finished=time.time(),
+                                     status=job_resp.status, result=result)
+            finished = [x for x in self.jobs if self.jobs[x]['state'] == 'done']
+            for old_job in finished[:max(len(finished) - self.max_kept, 0)]:
+                del self.jobs[old_job]
+
+    def get(self, job_id):
+        """
+        Return (a copy of) the job, None if there is no such job
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if not job:
+                return None
+            job = dict(job)
+            if isinstance(job['result'], list):
+                job['result'] = list(job['result'])
+            return job
+
+def queueable(responder):
+    """
+    Decorator for the responders of mutating endpoints. With the
+    request parameter async=true, the responder is run as a job
+    (see JobQueue), and the reply is 202 with the job id.
+    """
+    @functools.wraps(responder)
+    def wrapper(resource, req, resp, *args):
+        if not req.get_param_as_bool('async'):
+            return responder(resource, req, resp, *args)
+        # Read the body now, the job runs after this request has finished
+        _ = req.media
+        job_id = JOBS.submit(lambda job_resp: responder(resource, req, job_resp, *args))
+        resp.status = falcon.HTTP_202
+        resp.location = '/jobs/' + job_id
+        resp.body = json.dumps({'job': job_id})
+        return None
+    return wrapper
+
+def use_backend(backends, name):
+    """
+    Return the backend (dig, nsupdate or rndc) of backends (a
+    mmbop_core.Backends), which is created the first time it is used.
+    Raises HTTPError (503) if it cannot be set up.
+    """
+    try:
+        return getattr(backends, name)
+    except (mmbop_core.DigQueryError, mmbop_core.NSUpdateError,
+            mmbop_core.RNDCError) as backend_err:
+        raise falcon.HTTPError(falcon.HTTP_503, 'Backend Error', str(backend_err))
+
 class RNDCBase:
     """
-    Base API class to initialize rndc
+    Base API class to initialize rndc (when first used)
     """
 
-    def __init__(self, rndc_instance):
-        self.rndc = rndc_instance
+    def __init__(self, backends):
+        self.backends = backends
+
+    @property
+    def rndc(self):
+        """
+        The RNDC instance
+        """
+        return use_backend(self.backends, 'rndc')
 
 class NSBase:
     """
     Base API class to initialize nsupdate
+
+    The mutating endpoints also accept a JSON array of operations
+    (bulk requests), which are made together, grouped by zone. The
+    reply is NDJSON, one line per operation of form:
+        {'index': int, 'success': boolean, 'message': string}
+    sent as the updates for each zone complete, so the lines are not
+    in the order of the operations. The response code is 200, see
+    success of each line for the result. The operations are all made
+    even if the client stops reading the reply, and if the request
+    fails part of the way through, every operation not yet reported
+    gets a line with success false and the error.
     """
 
-    def __init__(self, nsupdate_instance):
-        self.nsupdate = nsupdate_instance
+    def __init__(self, backends):
+        self.backends = backends
+
+    @property
+    def nsupdate(self):
+        """
+        The NSUpdate instance (created when first used)
+        """
+        return use_backend(self.backends, 'nsupdate')
+
+    @staticmethod
+    def _valid_field(name, value):
+        """
+        True if value is a non-empty string (or for addr, a non-empty
+        list of them)
+        """
+        if name == 'addr' and isinstance(value, list):
+            return bool(value) and all(isinstance(x, str) and x for x in value)
+        return isinstance(value, str) and bool(value)
+
+    @classmethod
+    def split_operations(cls, operations, required):
+        """
+        Split the operations of a bulk request into the valid ones, a
+        list of tuples of form (index, operation), and the results for
+        those missing a required field (or with one of the wrong type)
+        """
+        valid = []
+        invalid = []
+        for (index, operation) in enumerate(operations):
+            message = None
+            if not (isinstance(operation, dict)
+                    and all(cls._valid_field(x, operation.get(x)) for x in required)):
+                message = 'Need to provide the %s' % ' and '.join(required)
+            elif not isinstance(operation.get('force', False), bool):
+                message = 'force must be true or false'
+            if message:
+                invalid.append({'index': index, 'success': False, 'message': message})
+            else:
+                valid.append((index, operation))
+        return (valid, invalid)
+
+    def stream_results(self, resp, results, count):
+        """
+        Reply with results (an iterable of dicts, for count operations)
+        as NDJSON, each line sent as soon as it is produced (see
+        BulkResults)
+        """
+        # Raises 503 now, rather than part of the way through the reply
+        _ = self.nsupdate
+        resp.content_type = NDJSON
+        resp.stream = BulkResults(results, count)
+
+class BulkResults:
+    """
+    Makes the operations of a bulk request in a thread of its own, so
+    they are all made whether or not the client reads the whole reply,
+    and iterates over the NDJSON lines of their results as they are
+    produced. If the request fails (such as nsupdate not running),
+    the operations without a result are reported as failed.
+    """
+
+    def __init__(self, results, count):
+        self.count = count
+        self.lines = queue.Queue()
+        self.thread = threading.Thread(target=mmbop_core.traced(self._run), args=(results, count),
+                                       name='mmbop-bulk')
+        self.thread.start()
+
+    def _run(self, results, count):
+        """
+        Queue the line of each result, then None at the end
+        """
+        reported = set()
+        try:
+            for result in results:
+                reported.add(result['index'])
+                self.lines.put(json.dumps(result).encode() + b'\n')
+        except Exception as bulk_err:  # pylint: disable=broad-except
+            message = 'Not completed: %s' % (str(bulk_err) or bulk_err.__class__.__name__)
+            for index in range(count):
+                if index not in reported:
+                    self.lines.put(json.dumps({'index': index, 'success': False,
+                                               'message': message}).encode() + b'\n')
+        finally:
+            self.lines.put(None)
+
+    def __iter__(self):
+        while True:
+            line = self.lines.get()
+            if line is None:
+                return
+            yield line
 
 class DIGBase:
     """
-    Base API class to initialize dig
+    Base API class to initialize dig (when first used)
     """
 
-    def __init__(self, dig_instance):
-        self.dig = dig_instance
+    def __init__(self, backends):
+        self.backends = backends
+
+    @property
+    def dig(self):
+        """
+        The DigQuery instance
+        """
+        return use_backend(self.backends, 'dig')
+
+class Page:
+    """
+    Pagination and field selection for the records of a zone, from the
+    request parameters limit (most entries to return), cursor (from
+    the previous page) and fields (comma separated, of FIELDS).
+    Records are added one at a time (see add), so a page is streamed
+    without holding the zone. The cursor is the number of entries
+    before the next page, so if the zone changes between requests
+    entries may be skipped or repeated.
+    """
+    FIELDS = ('entry', 'ttl', 'class', 'type', 'value')
+
+    def __init__(self, req, key, default_fields, not_found=None):
+        self.key = key
+        self.not_found = not_found
+        self.requested = any(x in req.params for x in ('limit', 'cursor', 'fields'))
+        self.limit = req.get_param_as_int('limit', min_value=1)
+        self.offset = self.decode_cursor(req.params.get('cursor'))
+        fields = req.params.get('fields')
+        if isinstance(fields, list):
+            fields = ','.join(fields)
+        self.fields = [x for x in (fields or '').split(',') if x] or default_fields
+        for field in self.fields:
+            if field not in self.FIELDS:
+                raise falcon.HTTPInvalidParam('Fields are ' + ', '.join(self.FIELDS), 'fields')
+        self.seen = 0
+        self.sent = 0
+        self.done = False
+
+    @staticmethod
+    def encode_cursor(offset):
+        """
+        Return the cursor for the page starting after offset entries
+        """
+        return base64.urlsafe_b64encode(json.dumps({'offset': offset}).encode()).decode()
+
+    @staticmethod
+    def decode_cursor(cursor):
+        """
+        Return the offset of the cursor (0 if there is none)
+        """
+        if not cursor:
+            return 0
+        try:
+            offset = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())['offset']
+            if isinstance(offset, int) and offset >= 0:
+                return offset
+        except (ValueError, TypeError, KeyError):
+            pass
+        raise falcon.HTTPInvalidParam('Not a cursor from a previous page', 'cursor')
+
+    def start(self):
+        """
+        Return the start of the JSON reply
+        """
+        return ('{"%s": [' % self.key).encode()
+
+    def add(self, record):
+        """
+        Return the JSON (bytes) of the entry for record (line of dig
+        output), if it is on the page, otherwise None. Sets done once
+        the page is full and there are more entries.
+        """
+        values = record.split()
+        if len(values) != len(self.FIELDS):
+            return None
+        self.seen += 1
+        if self.seen <= self.offset:
+            return None
+        if self.limit and self.sent == self.limit:
+            self.done = True
+            return None
+        entry = dict(zip(self.FIELDS, values))
+        self.sent += 1
+        return (b', ' if self.sent > 1 else b'') + json.dumps(
+            {x: entry[x] for x in self.fields}).encode()
+
+    def end(self):
+        """
+        Return the end of the JSON reply, with the cursor of the next
+        page (null if this is the last). If there were no entries at
+        all, the reply holds the not_found message instead.
+        """
+        ending = b''
+        if not self.seen and self.not_found:
+            ending = json.dumps(dict({x: None for x in self.fields},
+                                     entry=self.not_found)).encode()
+        cursor = self.encode_cursor(self.offset + self.sent) if self.done else None
+        return ending + ('], "next": %s}' % json.dumps(cursor)).encode()
+
+    def stream(self, records):
+        """
+        Generator of the JSON reply for records
+        """
+        yield self.start()
+        for record in records:
+            entry = self.add(record)
+            if entry:
+                yield entry
+            if self.done:
+                break
+        yield self.end()
 
 class Query(DIGBase):
     """
@@ -116,20 +627,27 @@ class Query(DIGBase):
         Equivalent to "mmbop query <entry>" command
         """
         entry = req.params.get('entry', None)
-        reply = []
         matched_entries = []
         if entry:
             matched_entries = self.dig.find_record(entry)
+        resp.body = json.dumps({'matched_entries': self.format_entries(matched_entries)})
+
+    @staticmethod
+    def format_entries(matched_entries):
+        """
+        Return the list of entries for the reply to a query
+        """
+        reply = []
         if not matched_entries:
             reply.append({'entry': 'Record not found'})
-        for match in matched_entries:
+        for match in matched_entries or []:
             try:
                 (host, ttl, _, class_type, value) = match.split()
                 reply.append({'entry': host, 'ttl': ttl,
                               'class': class_type, 'value': value})
             except ValueError:
                 continue
-        resp.body = json.dumps({'matched_entries': reply})
+        return reply
 
 class Status(RNDCBase):
     """
@@ -161,10 +679,15 @@ class AliasAdd(NSBase):
     Otherwise, response code will be 400.
     """
 
+    @queueable
     def on_post(self, req, resp):
         """
         Equivalent to "mmbop.py alias <alias> <real>" command
+        A JSON array of these adds is a bulk request (see NSBase).
         """
+        if isinstance(req.media, list):
+            self.stream_results(resp, self._bulk_add(req.media), len(req.media))
+            return
         result_list = []
         alias = req.media.get('alias')
         real = req.media.get('real')
@@ -185,6 +708,21 @@ class AliasAdd(NSBase):
             resp.status = falcon.HTTP_400
         resp.body = json.dumps({'result': result_list})
 
+    def _bulk_add(self, operations):
+        """
+        Generator of the results of a bulk alias request
+        """
+        (valid, invalid) = self.split_operations(operations, ('alias', 'real'))
+        for result in invalid:
+            yield result
+        entries = [(x['alias'], x['real'], x.get('force', False)) for (_, x) in valid]
+        for (position, alias, real, success, message) in self.nsupdate.iter_add_aliases(entries):
+            if success:
+                message = alias + ' ' + real + ' added successfully'
+            else:
+                message = alias + ' ' + real + ' not added: ' + message
+            yield {'index': valid[position][0], 'success': success, 'message': message}
+
 class HostModify(NSBase):
     """
     Handle hostmodify requests
@@ -212,17 +750,41 @@ class HostModify(NSBase):
             return falcon.HTTP_200
         return falcon.HTTP_201
 
+    @queueable
     def on_post(self, req, resp):
         """
         Equivalent to "mmbop.py hostadd <fqdn> <ip_addr> ..." command
+        If range is provided, equivalent to "mmbop.py hostadd --range N",
+        with one result per entry in the range (none are added if any
+        of them conflicts with existing records, unless force is true).
+        A JSON array of these adds (without range) is a bulk request
+        (see NSBase).
         """
+        if isinstance(req.media, list):
+            self.stream_results(resp, self._bulk_add(req.media), len(req.media))
+            return
         result_list = []
         fqdn = req.media.get('fqdn')
         addr = req.media.get('addr')
         force = req.media.get('force', False)
+        num_entries = req.media.get('range')
         if not (fqdn and addr):
             result_list.append({'success': False,
                                 'message': 'Need to provide the fqdn and addr'})
+        elif num_entries:
+            try:
+                entries = mmbop_core.range_entries(fqdn, addr, num_entries)
+            except ValueError as val_err:
+                entries = []
+                result_list.append({'success': False, 'message': str(val_err)})
+            # As hostadd --range, nothing is added if any entry conflicts
+            for (fqdn, addrs, success, message) in self.nsupdate.add_records(entries, force,
+                                                                              True):
+                if success:
+                    message = fqdn + ' ' + str(addrs) + ' added successfully'
+                else:
+                    message = fqdn + ' ' + str(addrs) + ' not added: ' + message
+                result_list.append({'success': success, 'message': message})
         else:
             if ' ' in addr:
                 addr = addr.split(' ')
@@ -236,10 +798,15 @@ class HostModify(NSBase):
         resp.status = self._all_succeeded(result_list)
         resp.body = json.dumps({'result': result_list})
 
+    @queueable
     def on_delete(self, req, resp):
         """
         Equivalent to "mmbop.py hostdel <entry>" command
+        A JSON array of these deletes is a bulk request (see NSBase).
         """
+        if isinstance(req.media, list):
+            self.stream_results(resp, self._bulk_delete(req.media), len(req.media))
+            return
         result_list = []
         entry = req.media.get('entry')
         force = req.media.get('force', False)
@@ -257,16 +824,64 @@ class HostModify(NSBase):
         resp.status = self._all_succeeded(result_list)
         resp.body = json.dumps({'result': result_list})
 
+    def _bulk_add(self, operations):
+        """
+        Generator of the results of a bulk add request
+        """
+        (valid, invalid) = self.split_operations(operations, ('fqdn', 'addr'))
+        for result in invalid:
+            yield result
+        entries = []
+        for (_, operation) in valid:
+            addr = operation['addr']
+            if isinstance(addr, str) and ' ' in addr:
+                addr = addr.split(' ')
+            entries.append((operation['fqdn'], addr, operation.get('force', False)))
+        for (position, fqdn, addrs, success, message) in self.nsupdate.iter_add_records(entries):
+            if success:
+                message = fqdn + ' ' + str(addrs) + ' added successfully'
+            else:
+                message = fqdn + ' ' + str(addrs) + ' not added: ' + message
+            yield {'index': valid[position][0], 'success': success, 'message': message}
+
+    def _bulk_delete(self, operations):
+        """
+        Generator of the results of a bulk delete request
+        """
+        (valid, invalid) = self.split_operations(operations, ('entry',))
+        for result in invalid:
+            yield result
+        entries = [(x['entry'], x.get('force', False)) for (_, x) in valid]
+        for (position, entry, success, message) in self.nsupdate.iter_delete_records(entries):
+            if success:
+                message = entry + ' deleted successfully'
+            else:
+                message = entry + ' not deleted: ' + message
+            yield {'index': valid[position][0], 'success': success, 'message': message}
+
 class HostList(DIGBase):
     """
     Handle hostlist requests
     """
 
-    def on_get(self, _, resp, domain):
+    def on_get(self, req, resp, domain):
         """
         Equivalent to 'mmbop.py hostlist <domain>'
+        The records are streamed (one per line) as the zone transfer arrives.
+        With limit, cursor or fields (see Page), the reply is instead JSON:
+            {records: [{entry: <entry1>, ttl: <ttl1>, class: <class1>,
+                        type: <type1>, value: <value1>},
+                       ...
+                      ],
+             next: <cursor of the next page>|null
+            }
         """
-        resp.body = (self.dig.hostlist(domain))
+        page = Page(req, 'records', Page.FIELDS)
+        if page.requested:
+            resp.stream = page.stream(self.dig.hostlist(domain))
+            return
+        resp.content_type = falcon.MEDIA_TEXT
+        resp.stream = (record.encode() + b'\n' for record in self.dig.hostlist(domain))
 
 class HostSearch(DIGBase):
     """
@@ -279,39 +894,55 @@ class HostSearch(DIGBase):
         Call with query parameters: ?domain=xxx&term=yyy.
         Prepending '~' to the term will enable negation -
         returning all entries that do not match the term.
+        limit, cursor and fields select the page and fields (see Page).
+        With ?range=xxx (a CIDR network or start-end addresses) instead,
+        the PTR records for the range are returned, in address order.
         Reply json:
             {matched_entries: [{entry: <entry1>, value: <value1>},
                                {entry: <entry2>, value: <value2>},
                                ...
-                              ]
+                              ],
+             next: <cursor of the next page>|null
             }
         """
+        address_range = req.params.get('range')
+        if address_range:
+            page = Page(req, 'matched_entries', ('entry', 'value'),
+                        'No records found in range ' + address_range)
+            try:
+                records = self.dig.iter_range(address_range)
+            except ValueError as val_err:
+                raise falcon.HTTPInvalidParam(str(val_err), 'range')
+            resp.stream = page.stream(records)
+            return
+        (domain, search_term, reverse, message) = self.search_request(req.params)
+        page = Page(req, 'matched_entries', ('entry', 'value'), message)
+        matched_entries = []
+        if domain:
+            matched_entries = self.dig.iter_domain(domain, search_term, reverse)
+        resp.stream = page.stream(matched_entries)
+
+    @classmethod
+    def search_request(cls, params):
+        """
+        Return a tuple of form (domain, search_term, reverse, not_found_message)
+        from the request parameters
+        """
         reverse = False
-        domain = self.fix_if_reverse(req.params.get('domain', None))
-        term = self.reverse_if_ip(domain, req.params.get('term', None))
+        domain = params.get('domain', None)
+        if domain:
+            domain = cls.fix_if_reverse(domain)
+        term = cls.reverse_if_ip(domain or '', params.get('term', None))
         search_term = term
-        matched_entries = []
-        reply = []
         if term and term.startswith('~'):
             reverse = True
             search_term = term[1:]
-        if domain:
-            matched_entries = self.dig.search_domain(domain, search_term, reverse)
-        if not matched_entries:
-            message = 'No records found'
-            if reverse:
-                message = message + ' not'
-            if term:
-                message = message + ' containing term "' + search_term + '"'
-            reply.append({'entry': message, 'value': None})
-            matched_entries = [message]
-        for match in matched_entries:
-            try:
-                (entry, _, _, _, value) = match.split()
-                reply.append({'entry': entry, 'value': value})
-            except ValueError:
-                continue
-        resp.body = json.dumps({'matched_entries': reply})
+        message = 'No records found'
+        if reverse:
+            message = message + ' not'
+        if term:
+            message = message + ' containing term "' + search_term + '"'
+        return (domain, search_term, reverse, message)
 
     @staticmethod
     def fix_if_reverse(zone_name):
@@ -363,9 +994,10 @@ class ZoneList(RNDCBase):
     Handle list of active zones
     """
 
-    def on_get(self, _, resp):
+    def on_get(self, req, resp):
         """
-        Return result of 'rndc dumpdb' with zone checking
+        Return result of 'rndc dumpdb' with zone checking, from the
+        zone inventory unless refresh=true is given
         Reply json:
             {zones: [{zone: <zone1>},
                      {zone: <zone2>},
@@ -373,7 +1005,10 @@ class ZoneList(RNDCBase):
             }
         """
         zones = []
-        zone_list = self.rndc.list_zones()
+        zone_list = self.rndc.zone_inventory(req.get_param_as_bool('refresh') or False)
+        if zone_list is None:
+            raise falcon.HTTPError(falcon.HTTP_503, 'Zone List Error',
+                                   'Unable to read list of zones')
         for zone in zone_list:
             zones.append({'zone': zone})
         resp.body = json.dumps({'zones': zones})
@@ -381,58 +1016,168 @@ class ZoneList(RNDCBase):
 class ZoneModify(RNDCBase):
     """
     Handle add/delete requests
+
+    domain can be one zone, or a list of zones. Returns JSON of form:
+    {'result': [{ 'zone': string, 'success': boolean, 'message': string },
+                ...
+               ]
+    with one result for each zone, in the order of the request.
     """
 
+    @staticmethod
+    def _zone_names(req):
+        """
+        Return the list of zones in the request (None if there are none)
+        """
+        zone_names = req.media.get('domain')
+        if isinstance(zone_names, str):
+            zone_names = [zone_names]
+        if not (isinstance(zone_names, list) and zone_names
+                and all(isinstance(x, str) and x for x in zone_names)):
+            return None
+        return zone_names
+
+    @staticmethod
+    def _progress(resp):
+        """
+        Return the progress callback of the job (see JobResponse),
+        None if the request is not run as a job
+        """
+        return resp.progress if isinstance(resp, JobResponse) else None
+
+    @queueable
     def on_post(self, req, resp):
         """
-        Adding a zone via POST request
+        Adding a zone (or zones) via POST request
         """
-        zone_name = req.media.get('domain')
-        if not zone_name:
+        zone_names = self._zone_names(req)
+        if not zone_names:
             resp.status = falcon.HTTP_400
             resp.body = ('Missing domain parameter')
-        else:
-            (success, message) = self.rndc.add(zone_name)
-            if success:
-                resp.status = falcon.HTTP_201
-                resp.body = json.dumps({'result': [{'success': True, 'message': message}]})
-            else:
-                resp.status = falcon.HTTP_400
-                resp.body = json.dumps({'result': [{'success': False, 'message': message}]})
+            return
+        results = self.rndc.add_zones(zone_names, self._progress(resp))
+        resp.status = falcon.HTTP_201
+        if not all(x[1] for x in results):
+            resp.status = falcon.HTTP_400
+        resp.body = json.dumps({'result': [{'zone': zone_name, 'success': success,
+                                            'message': message}
+                                           for (zone_name, success, message) in results]})
 
+    @queueable
     def on_delete(self, req, resp):
         """
-        Removing a zone via DELETE request
+        Removing a zone (or zones) via DELETE request
         """
-        zone_name = req.media.get('domain')
-        if not zone_name:
-            resp.statuss = falcon.HTTP_400
+        zone_names = self._zone_names(req)
+        if not zone_names:
+            resp.status = falcon.HTTP_400
             resp.body = ('Missing domain parameter')
+            return
+        results = self.rndc.delete_zones(zone_names, self._progress(resp))
+        if not all(x[1] for x in results):
+            resp.status = falcon.HTTP_400
+        resp.body = json.dumps({'result': [{'zone': zone_name, 'success': success,
+                                            'message': message}
+                                           for (zone_name, success, message) in results]})
+
+class Metrics:
+    """
+    Handle metrics requests
+    """
+
+    def on_get(self, _, resp):
+        """
+        Return the request, backend and cache metrics, in the
+        Prometheus text format
+        """
+        resp.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+        resp.body = mmbop_core.METRICS.render()
+
+class Healthz:
+    """
+    Handle health checks, which report the last result of the
+    background 'rndc status' check (see mmbop_core.StatusCheck) rather than
+    waiting on BIND, and do not need the token
+    """
+
+    def __init__(self, status_check):
+        self.status_check = status_check
+
+    def reply(self):
+        """
+        Return a tuple of form (status, body) of the reply
+        """
+        state = self.status_check.state()
+        if state['reachable'] is None and self.status_check.refresh_interval > 0:
+            status = 'starting'
+        elif state['reachable'] is False:
+            status = 'unavailable'
         else:
-            (success, message) = self.rndc.delete(zone_name)
-            if success:
-                resp.body = json.dumps({'result': [{'success': True, 'message': message}]})
-            else:
-                resp.status = falcon.HTTP_400
-                resp.body = json.dumps({'result': [{'success': True, 'message': message}]})
+            status = 'ok'
+        body = json.dumps({'status': status, 'rndc': state,
+                           'backends': self.status_check.backends.created()})
+        return (falcon.HTTP_200 if status == 'ok' else falcon.HTTP_503, body)
+
+    def on_get(self, _, resp):
+        """
+        Reply json:
+            {status: ok|starting|unavailable,
+             rndc: {reachable: true|false|null, error: <message>|null,
+                    age: <seconds since the check>|null},
+             backends: [<backends in use, of dig, nsupdate and rndc>]}
+        The status is 503 if the last check did not reach BIND, or
+        (starting) if the first check has not been made yet. With the
+        check turned off, reachable stays null and the status is ok.
+        """
+        (resp.status, resp.body) = self.reply()
 
+class JobStatus:
+    """
+    Handle requests for the state of jobs (see queueable)
+    """
+
+    def on_get(self, _, resp, job_id):
+        """
+        Reply json:
+            {job: <job_id>, state: queued|running|done,
+             submitted: <time>, started: <time>, finished: <time>,
+             progress: {done: <items done>, total: <items>}|null,
+             status: <HTTP status the request would have had>,
+             result: <body the request would have had>}
+        progress is set as the operations of a bulk request, or the
+        zones of /zonemodify, are done, and result has the results of
+        a bulk request so far while it is running.
+        """
+        job = JOBS.get(job_id)
+        if not job:
+            raise falcon.HTTPNotFound(description='No job %s' % job_id)
+        resp.body = json.dumps(job)
 
 CONF_FILE = './mmbop.ini'
 
-MY_CONF = mmbop.read_config(CONF_FILE)
-MY_RNDC = mmbop.RNDC.create(**MY_CONF)
-MY_NSUPDATE = MY_RNDC.my_nsupdate
-MY_DIG = mmbop.DigQuery()
-APP = falcon.API(middleware=[HandleCORS(), AuthToken()])
-QUERY = Query(MY_DIG)
-STATUS = Status(MY_RNDC)
-HOSTMODIFY = HostModify(MY_NSUPDATE)
-ALIASADD = AliasAdd(MY_NSUPDATE)
-HOSTLIST = HostList(MY_DIG)
-HOSTSEARCH = HostSearch(MY_DIG)
-ZONEINFO = ZoneInfo(MY_RNDC)
-ZONEMODIFY = ZoneModify(MY_RNDC)
-ZONELIST = ZoneList(MY_RNDC)
+mmbop_core.METRICS.define('mmbop_api_request_seconds', 'histogram', 'Duration of API requests',
+                     ('method', 'route', 'status'))
+mmbop_core.METRICS.define('mmbop_api_requests_in_flight', 'gauge', 'API requests in progress')
+MY_CONF = mmbop_core.read_config(CONF_FILE)
+# The backends are created by the first request that uses them, so
+# starting the API does not wait on BIND
+BACKENDS = mmbop_core.Backends(MY_CONF, check=False)
+STATUS_CHECK = mmbop_core.StatusCheck(BACKENDS, MY_CONF.get('statusrefresh', 30))
+JOBS = JobQueue(MY_CONF.get('jobworkers', 4), MY_CONF.get('jobskept', 1000),
+                MY_CONF.get('jobqueue', 100))
+APP = falcon.API(middleware=[RequestMetrics(), HandleCORS(), AuthToken(), RequestTiming()])
+QUERY = Query(BACKENDS)
+STATUS = Status(BACKENDS)
+HOSTMODIFY = HostModify(BACKENDS)
+ALIASADD = AliasAdd(BACKENDS)
+HOSTLIST = HostList(BACKENDS)
+HOSTSEARCH = HostSearch(BACKENDS)
+ZONEINFO = ZoneInfo(BACKENDS)
+ZONEMODIFY = ZoneModify(BACKENDS)
+ZONELIST = ZoneList(BACKENDS)
+JOBSTATUS = JobStatus()
+METRICS = Metrics()
+HEALTHZ = Healthz(STATUS_CHECK)
 APP.add_route('/query', QUERY)
 APP.add_route('/status', STATUS)
 APP.add_route('/hostmodify', HOSTMODIFY)
@@ -442,3 +1187,6 @@ APP.add_route('/hostsearch', HOSTSEARCH)
 APP.add_route('/zonemodify', ZONEMODIFY)
 APP.add_route('/zonelist', ZONELIST)
 APP.add_route('/zoneinfo/{domain}', ZONEINFO)
+APP.add_route('/jobs/{job_id}', JOBSTATUS)
+APP.add_route('/metrics', METRICS)
+APP.add_route('/healthz', HEALTHZ)
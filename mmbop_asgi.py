@@ -0,0 +1,338 @@
+"""
+Uses falcon.asgi (Falcon 3) to implement the mmbop API for an ASGI
+server, with the same routes, configuration and authentication token
+as mmbop_api.
+
+Queries and zone transfers (/query, /hostlist, /hostsearch) are made
+with asyncio, so one process can have many of them waiting on BIND at
+once. The other routes call rndc and nsupdate, and are handled by the
+mmbop_api resources in worker threads (at most 'jobs' at a time).
+"""
+import asyncio
+import concurrent.futures
+import functools
+import json
+import threading
+import falcon
+import falcon.asgi
+import mmbop_core
+import mmbop_api
+import mmbop_async
+
+# Pylint really doesn't like falcon, this is to silence false positives
+# pylint: disable=too-few-public-methods,c-extension-no-member,no-self-use,no-member
+
+class HandleCORS:
+    """
+    To enable all sites to reach the API, as it relies on
+    token authentication for access control
+    """
+
+    async def process_request(self, req, resp):
+        """
+        Same as mmbop_api.HandleCORS
+        """
+        resp.set_header('Access-Control-Allow-Origin', '*')
+        resp.set_header('Access-Control-Allow-Methods', '*')
+        resp.set_header('Access-Control-Allow-Headers', '*')
+        resp.set_header('Access-Control-Max-Age', 1728000)  # 20 days
+        if req.method == 'OPTIONS':
+            raise falcon.HTTPStatus(falcon.HTTP_200, text='\n')
+
+class ClosedStream:
+    """
+    The asynchronous stream of a reply, calling finished when Falcon
+    closes it (see mmbop_api.ClosedStream)
+    """
+
+    def __init__(self, stream, finished):
+        self.stream = stream
+        self.finished = finished
+
+    def __aiter__(self):
+        return self.stream.__aiter__()
+
+    async def close(self):
+        """
+        Close the stream (if it can be), then call finished once
+        """
+        (finished, self.finished) = (self.finished, None)
+        try:
+            if hasattr(self.stream, 'aclose'):
+                await self.stream.aclose()
+            elif hasattr(self.stream, 'close'):
+                await self.stream.close()
+        finally:
+            if finished:
+                finished()
+
+class RequestMetrics:
+    """
+    Records request metrics (see mmbop_api.RequestMetrics)
+    """
+
+    async def process_request(self, req, _):
+        """
+        Falcon required method, starting the clock for the request
+        """
+        mmbop_api.RequestMetrics.start(req)
+
+    async def process_response(self, req, resp, *_):
+        """
+        Falcon required method, recording the request
+        """
+        mmbop_api.RequestMetrics.finish(req, resp, ClosedStream)
+
+class RequestTiming:
+    """
+    Reports the steps of the request in a Server-Timing header (see
+    mmbop_api.RequestTiming). Only the responders run in worker threads
+    (see Threaded) are traced, as the event loop serves many requests.
+    """
+
+    async def process_request(self, req, _):
+        """
+        Falcon required method, starting the trace if asked for
+        """
+        mmbop_api.RequestTiming.start(req)
+
+    async def process_response(self, req, resp, *_):
+        """
+        Falcon required method, adding the Server-Timing header (after
+        reading a streamed reply in full, see mmbop_api.RequestTiming)
+        """
+        if getattr(req.context, 'trace', None) and resp.stream is not None:
+            resp.data = b''.join([chunk async for chunk in resp.stream])
+            resp.stream = None
+        mmbop_api.RequestTiming.finish(req, resp)
+
+class AuthToken:
+    """
+    Implements simple authentication token (see mmbop_api.AuthToken)
+    """
+
+    def __init__(self):
+        self.token = mmbop_api.AuthToken()
+
+    async def process_request(self, req, _):
+        """
+        Falcon required method for handling request and (in this case)
+        ensuring the provided token is correct
+        """
+        self.token.check(req)
+
+class ThreadedRequest:
+    """
+    The parts of the request that mmbop_api responders use, so they
+    can be run in a worker thread
+    """
+
+    def __init__(self, req, media):
+        self.req = req
+        self.params = req.params
+        self.media = media
+
+    def get_param_as_bool(self, name, *args, **kwargs):
+        """
+        Same as the falcon request method
+        """
+        return self.req.get_param_as_bool(name, *args, **kwargs)
+
+class Threaded:
+    """
+    Serves a mmbop_api resource, running its (blocking) responders
+    in the worker threads of EXECUTOR
+    """
+
+    def __init__(self, resource):
+        self.resource = resource
+        for method in ('on_get', 'on_post', 'on_delete'):
+            if hasattr(resource, method):
+                setattr(self, method, self._responder(getattr(resource, method)))
+
+    @staticmethod
+    def _responder(wsgi_responder):
+        """
+        Return a coroutine responder that runs wsgi_responder
+        """
+        async def responder(req, resp, **kwargs):
+            media = await req.get_media(default_when_empty=None)
+            job_resp = mmbop_api.JobResponse()
+            call = functools.partial(wsgi_responder, ThreadedRequest(req, media), job_resp,
+                                     **kwargs)
+            trace = getattr(req.context, 'trace', None)
+            if trace:
+                call = trace.wrap(call)
+            await asyncio.get_event_loop().run_in_executor(EXECUTOR, call)
+            resp.status = job_resp.status
+            if job_resp.location:
+                resp.location = job_resp.location
+            if job_resp.content_type:
+                resp.content_type = job_resp.content_type
+            if job_resp.stream is not None:
+                resp.stream = Threaded.stream_in_thread(job_resp.stream)
+            else:
+                resp.text = job_resp.body
+        return responder
+
+    @staticmethod
+    async def stream_in_thread(iterable):
+        """
+        Asynchronous generator of the chunks of the (blocking) iterable,
+        each read in a worker thread
+        """
+        iterator = iter(iterable)
+        done = object()
+        while True:
+            chunk = await asyncio.get_event_loop().run_in_executor(EXECUTOR, next,
+                                                                   iterator, done)
+            if chunk is done:
+                return
+            yield chunk
+
+class DIGBase:
+    """
+    Base class of the resources making asyncio queries, with the
+    AsyncDigQuery of the DigQuery of mmbop_api.BACKENDS (both are
+    created when first used)
+    """
+
+    async_dig = None
+    lock = threading.Lock()
+
+    @property
+    def dig(self):
+        """
+        The AsyncDigQuery instance
+        """
+        with DIGBase.lock:
+            if DIGBase.async_dig is None:
+                DIGBase.async_dig = mmbop_async.AsyncDigQuery(
+                    mmbop_api.use_backend(mmbop_api.BACKENDS, 'dig'), EXECUTOR)
+            return DIGBase.async_dig
+
+class Query(DIGBase):
+    """
+    Handle query requests
+    """
+
+    async def on_get(self, req, resp):
+        """
+        Equivalent to "mmbop query <entry>" command
+        """
+        entry = req.params.get('entry', None)
+        matched_entries = []
+        if entry:
+            matched_entries = await self.dig.find_record(entry)
+        resp.text = json.dumps({'matched_entries':
+                                mmbop_api.Query.format_entries(matched_entries)})
+
+class HostList(DIGBase):
+    """
+    Handle hostlist requests
+    """
+
+    async def on_get(self, req, resp, domain):
+        """
+        Equivalent to 'mmbop.py hostlist <domain>'
+        The records are streamed (one per line) as the zone transfer
+        arrives, or as JSON pages (see mmbop_api.HostList).
+        """
+        page = mmbop_api.Page(req, 'records', mmbop_api.Page.FIELDS)
+        if page.requested:
+            resp.stream = stream_page(page, self.dig.hostlist(domain))
+            return
+        resp.content_type = falcon.MEDIA_TEXT
+        resp.stream = self.stream_records(domain)
+
+    async def stream_records(self, domain):
+        """
+        Asynchronous generator of the reply lines
+        """
+        async for record in self.dig.hostlist(domain):
+            yield record.encode() + b'\n'
+
+class HostSearch(DIGBase):
+    """
+    Handle hostsearch requests (see mmbop_api.HostSearch)
+    """
+
+    async def on_get(self, req, resp):
+        """
+        Equivalent to 'mmbop.py hostlist <domain> <term>'.
+        """
+        address_range = req.params.get('range')
+        if address_range:
+            page = mmbop_api.Page(req, 'matched_entries', ('entry', 'value'),
+                                  'No records found in range ' + address_range)
+            try:
+                records = await self.dig.find_range(address_range)
+            except ValueError as val_err:
+                raise falcon.HTTPInvalidParam(str(val_err), 'range')
+            resp.stream = stream_page(page, iterate(records))
+            return
+        (domain, search_term, reverse, message) = mmbop_api.HostSearch.search_request(
+            req.params)
+        page = mmbop_api.Page(req, 'matched_entries', ('entry', 'value'), message)
+        if domain:
+            resp.stream = stream_page(page, self.dig.iter_domain(domain, search_term, reverse))
+        else:
+            resp.stream = stream_page(page, None)
+
+class Healthz:
+    """
+    Handle health checks (see mmbop_api.Healthz)
+    """
+
+    def __init__(self, status_check):
+        self.health = mmbop_api.Healthz(status_check)
+
+    async def on_get(self, _, resp):
+        """
+        Same as mmbop_api.Healthz, without the need for a worker thread
+        """
+        (resp.status, resp.text) = self.health.reply()
+
+async def iterate(items):
+    """
+    Asynchronous generator of the items of a list
+    """
+    for item in items:
+        yield item
+
+async def stream_page(page, records):
+    """
+    Asynchronous generator of the JSON reply of a mmbop_api.Page for
+    records (an asynchronous iterable, or None for no records)
+    """
+    yield page.start()
+    if records is not None:
+        try:
+            async for record in records:
+                entry = page.add(record)
+                if entry:
+                    yield entry
+                if page.done:
+                    break
+        finally:
+            # Stop the zone transfer if the page ended before it did
+            await records.aclose()
+    yield page.end()
+
+
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=int(mmbop_api.MY_CONF.get('jobs', 8)))
+APP = falcon.asgi.App(middleware=[RequestMetrics(), HandleCORS(), AuthToken(),
+                                  RequestTiming()])
+APP.add_route('/query', Query())
+APP.add_route('/status', Threaded(mmbop_api.STATUS))
+APP.add_route('/hostmodify', Threaded(mmbop_api.HOSTMODIFY))
+APP.add_route('/alias', Threaded(mmbop_api.ALIASADD))
+APP.add_route('/hostlist/{domain}', HostList())
+APP.add_route('/hostsearch', HostSearch())
+APP.add_route('/zonemodify', Threaded(mmbop_api.ZONEMODIFY))
+APP.add_route('/zonelist', Threaded(mmbop_api.ZONELIST))
+APP.add_route('/zoneinfo/{domain}', Threaded(mmbop_api.ZONEINFO))
+APP.add_route('/jobs/{job_id}', Threaded(mmbop_api.JOBSTATUS))
+APP.add_route('/metrics', Threaded(mmbop_api.METRICS))
+APP.add_route('/healthz', Healthz(mmbop_api.STATUS_CHECK))
@@ -0,0 +1,379 @@
+"""
+asyncio versions of the mmbop DNS queries and zone transfers, used by
+mmbop_asgi so that one process can have many lookups waiting on BIND.
+
+These are kept apart from mmbop so that the command line and the WSGI
+API do not pay for importing asyncio when they start.
+"""
+import asyncio
+import logging
+import struct
+import subprocess
+import threading
+from mmbop_core import (BackendCall, DigQueryError, DNSMessage, DNSRecord, DNSWireError,
+                        EDNS_PAYLOAD, FLAG_RD, format_record)
+
+# AsyncDigQuery uses the parsing helpers of the DigQuery it wraps
+# pylint: disable=protected-access
+
+class _AsyncUDPReply(asyncio.DatagramProtocol):
+    """
+    Receives the reply to one UDP query for AsyncDNSClient
+    """
+
+    def __init__(self, msg_id):
+        self.msg_id = msg_id
+        self.reply = asyncio.get_event_loop().create_future()
+
+    def datagram_received(self, data, addr):
+        try:
+            reply = DNSMessage.from_wire(data)
+        except DNSWireError as wire_err:
+            logging.debug('Ignoring invalid reply: %s', wire_err)
+            return
+        if reply.msg_id != self.msg_id:
+            logging.debug('Ignoring reply with mismatched id %s', reply.msg_id)
+        elif not self.reply.done():
+            self.reply.set_result(reply)
+
+    def error_received(self, exc):
+        if not self.reply.done():
+            self.reply.set_exception(exc)
+
+class AsyncDNSClient:
+    """
+    asyncio version of the DNSClient queries and zone transfers, so
+    that many lookups can be waiting on the name server at once.
+    Talks to the same name server as dns_client (a DNSClient).
+    """
+
+    # Seconds to wait for a UDP reply before sending the query again
+    UDP_RETRY = 1
+
+    def __init__(self, dns_client):
+        self.family = dns_client.family
+        self.address = dns_client.address
+        self.timeout = dns_client.timeout
+
+    async def _exchange_udp(self, message):
+        """
+        Send the message over UDP, returning the matching reply. With
+        many queries at once a datagram is more likely to be dropped,
+        so the query is sent again every UDP_RETRY seconds until timeout.
+        """
+        loop = asyncio.get_event_loop()
+        (transport, protocol) = await loop.create_datagram_endpoint(
+            lambda: _AsyncUDPReply(message.msg_id), remote_addr=self.address,
+            family=self.family)
+        deadline = loop.time() + self.timeout
+        wire = message.to_wire()
+        try:
+            while True:
+                transport.sendto(wire)
+                wait = min(self.UDP_RETRY, deadline - loop.time())
+                try:
+                    return await asyncio.wait_for(asyncio.shield(protocol.reply), wait)
+                except asyncio.TimeoutError:
+                    if loop.time() >= deadline:
+                        raise
+                    logging.debug('No reply for query %s, sending again', message.msg_id)
+        finally:
+            transport.close()
+
+    async def _connect(self):
+        """
+        Return the (reader, writer) streams of a TCP connection to the name server
+        """
+        return await asyncio.wait_for(asyncio.open_connection(*self.address), self.timeout)
+
+    async def _read_message(self, reader):
+        """
+        Read one (length prefixed) message from TCP, as a DNSMessage
+        """
+        (length,) = struct.unpack('!H', await asyncio.wait_for(reader.readexactly(2),
+                                                                self.timeout))
+        return DNSMessage.from_wire(await asyncio.wait_for(reader.readexactly(length),
+                                                           self.timeout))
+
+    async def _exchange_tcp(self, message):
+        """
+        Send the message over TCP, returning the reply
+        """
+        (reader, writer) = await self._connect()
+        try:
+            wire = message.to_wire()
+            writer.write(struct.pack('!H', len(wire)) + wire)
+            return await self._read_message(reader)
+        finally:
+            writer.close()
+
+    async def query(self, qname, qtype='A'):
+        """
+        Query the name server, using UDP and retrying over TCP if
+        the reply was truncated. Returns the reply DNSMessage.
+        """
+        message = DNSMessage(flags=FLAG_RD)
+        message.question.append((qname, qtype, 'IN'))
+        message.additional.append(DNSRecord('.', 0, EDNS_PAYLOAD, 'OPT', ''))
+        try:
+            reply = await self._exchange_udp(message)
+            if reply.truncated:
+                logging.debug('Reply for %s truncated, retrying over TCP', qname)
+                reply = await self._exchange_tcp(message)
+        except (OSError, EOFError, asyncio.TimeoutError) as os_err:
+            raise DNSWireError('Query for %s %s failed: %s'
+                               % (qname, qtype, os_err or 'timeout')) from os_err
+        logging.debug('Query for %s %s: %s, %d answers', qname, qtype,
+                      reply.rcode_name, len(reply.answer))
+        return reply
+
+    async def axfr(self, zone_name):
+        """
+        Asynchronous generator that performs a zone transfer over TCP,
+        yielding each DNSRecord (starting and ending with the zone SOA)
+        as it arrives. As with dig, a refused transfer yields nothing.
+        """
+        message = DNSMessage()
+        message.question.append((zone_name, 'AXFR', 'IN'))
+        count = 0
+        try:
+            (reader, writer) = await self._connect()
+            try:
+                wire = message.to_wire()
+                writer.write(struct.pack('!H', len(wire)) + wire)
+                while True:
+                    reply = await self._read_message(reader)
+                    if reply.rcode and count:
+                        raise DNSWireError('Transfer of %s failed part way: %s'
+                                           % (zone_name, reply.rcode_name))
+                    if reply.rcode:
+                        logging.debug('Transfer of %s failed: %s', zone_name, reply.rcode_name)
+                        return
+                    for record in reply.answer:
+                        count += 1
+                        yield record
+                        if record.rtype == 'SOA' and count > 1:
+                            return
+            finally:
+                writer.close()
+        except (OSError, EOFError, asyncio.TimeoutError) as os_err:
+            raise DNSWireError('Transfer of %s failed: %s'
+                               % (zone_name, os_err or 'timeout')) from os_err
+
+class AsyncDigQuery:
+    """
+    asyncio front end to a DigQuery. Lookups and zone transfers are
+    made with AsyncDNSClient (in native mode) or by running dig as an
+    asyncio subprocess. Mirrored and cached zones are read from the
+    DigQuery in a worker thread of executor, since checking them for
+    changes can query the name server.
+    """
+
+    # Records passed back from a worker thread at a time, and the most
+    # of these batches waiting to be read (see _transfer_in_thread)
+    THREAD_BATCH = 500
+    THREAD_BATCHES = 4
+
+    def __init__(self, dig_instance, executor=None):
+        self.dig = dig_instance
+        self.executor = executor
+        self.native = None
+        if dig_instance.native:
+            self.native = AsyncDNSClient(dig_instance.native)
+
+    async def _in_thread(self, function, *args):
+        """
+        Run the (blocking) function in a worker thread
+        """
+        return await asyncio.get_event_loop().run_in_executor(self.executor, function, *args)
+
+    async def _call(self, query_name, query_type=None):
+        """
+        Asynchronous version of DigQuery._call, returns tuple of form:
+        (boolean:success_failure, string:stdout_stderr)
+        The query is recorded as a BackendCall, as DigQuery._call is.
+        """
+        with BackendCall('dig', query_type or 'A') as call:
+            result = await self._query(query_name, query_type)
+            call.failed = not result[0]
+            return result
+
+    async def _query(self, query_name, query_type=None):
+        """
+        Make the query of _call
+        """
+        if self.native:
+            try:
+                reply = await self.native.query(query_name, query_type or 'A')
+                return (True, '\n'.join(format_record(x) for x in reply.answer))
+            except DNSWireError as wire_err:
+                logging.debug('Native query failed: %s', wire_err)
+                if not self.dig.command:
+                    return (False, str(wire_err))
+                logging.debug('Falling back to dig')
+        dig_command = self.dig.command + [query_name]
+        if query_type:
+            dig_command.append(query_type)
+        dig_process = await asyncio.create_subprocess_exec(*(dig_command + self.dig.options),
+                                                           stdout=subprocess.PIPE,
+                                                           stderr=subprocess.PIPE)
+        (stdout, stderr) = await dig_process.communicate()
+        if dig_process.returncode == 0:
+            return (True, stdout.decode())
+        return (False, stderr.decode())
+
+    async def find_record(self, fqdn_or_ip, strict=False):
+        """
+        Asynchronous version of DigQuery.find_record
+        """
+        (query_name, query_type) = self.dig._query_for(fqdn_or_ip)
+        answer = None
+        if self.dig.mirror and self.dig.mirror.zone_of(query_name):
+            answer = await self._in_thread(self.dig.mirror.lookup, query_name,
+                                           query_type or 'A')
+        if answer is None:
+            answer = self.dig._parse_call(await self._call(query_name, query_type))
+        if strict:
+            return [line.split()[-1] for line in answer or []]
+        return answer
+
+    async def _transfer_in_thread(self, zone_name):
+        """
+        Asynchronous generator of DigQuery._transfer of the zone, run in
+        a worker thread that passes the records back a batch at a time
+        through a bounded asyncio.Queue. As with the other transfers, the
+        zone is not held in memory, and the transfer stops if the caller
+        stops reading.
+        """
+        loop = asyncio.get_event_loop()
+        batches = asyncio.Queue(self.THREAD_BATCHES)
+        stopped = threading.Event()
+        def put(item):
+            asyncio.run_coroutine_threadsafe(batches.put(item), loop).result()
+        def transfer():
+            records = self.dig._transfer(zone_name)
+            batch = []
+            try:
+                for record in records:
+                    batch.append(record)
+                    if len(batch) == self.THREAD_BATCH:
+                        put(batch)
+                        batch = []
+                        if stopped.is_set():
+                            return
+                put(batch)
+                put(None)
+            except Exception as xfr_err:  # pylint: disable=broad-except
+                if not stopped.is_set():
+                    put(xfr_err)
+            finally:
+                records.close()
+        loop.run_in_executor(self.executor, transfer)
+        try:
+            while True:
+                batch = await batches.get()
+                if batch is None:
+                    return
+                if isinstance(batch, Exception):
+                    raise batch
+                for record in batch:
+                    yield record
+        finally:
+            stopped.set()
+            # Make room for a batch the thread may be waiting to add
+            while not batches.empty():
+                batches.get_nowait()
+
+    async def _transfer(self, zone_name):
+        """
+        Asynchronous generator of the zone transfer lines. A transfer
+        from the server is recorded as a BackendCall (dig axfr), as in
+        DigQuery._stream_call.
+        """
+        if self.dig.cache or (self.dig.mirror and self.dig.mirror.zone_of(zone_name)):
+            records = self._transfer_in_thread(zone_name)
+        else:
+            records = self._axfr(zone_name)
+        try:
+            async for record in records:
+                yield record
+        finally:
+            await records.aclose()
+
+    async def _axfr(self, zone_name):
+        """
+        Asynchronous generator of the lines of a transfer of the zone
+        from the server
+        """
+        records = self._axfr_lines(zone_name)
+        with BackendCall('dig', 'axfr'):
+            try:
+                async for record in records:
+                    yield record
+            finally:
+                await records.aclose()
+
+    async def _axfr_lines(self, zone_name):
+        """
+        Asynchronous generator of the lines of a transfer of the zone,
+        natively or with dig
+        """
+        if self.native:
+            transferred = False
+            try:
+                async for record in self.native.axfr(zone_name):
+                    transferred = True
+                    yield format_record(record)
+                return
+            except DNSWireError as wire_err:
+                logging.debug('Native transfer failed: %s', wire_err)
+                if transferred:
+                    # As DigQuery._stream_call, a zone cut short is an error
+                    raise DigQueryError(str(wire_err)) from wire_err
+                if not self.dig.command:
+                    return
+                logging.debug('Falling back to dig')
+        dig_process = await asyncio.create_subprocess_exec(
+            *(self.dig.command + ['axfr', zone_name] + self.dig.options),
+            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        finished = False
+        transferred = False
+        try:
+            async for line in dig_process.stdout:
+                line = line.decode()
+                if line.startswith('; Transfer failed') and transferred:
+                    raise DigQueryError('Transfer of %s failed part way' % zone_name)
+                if line.startswith(';') or not line.strip():
+                    continue
+                transferred = True
+                yield line.rstrip('\n')
+            finished = True
+        finally:
+            # Stop dig if the caller stopped reading before the end
+            if not finished and dig_process.returncode is None:
+                dig_process.kill()
+            await dig_process.wait()
+
+    async def iter_domain(self, zone_name, search_string=None, negate=False):
+        """
+        Asynchronous version of DigQuery.iter_domain
+        """
+        async for record in self._transfer(zone_name):
+            record = self.dig._match(record, search_string, negate)
+            if record is not None:
+                yield record
+
+    async def find_range(self, address_range):
+        """
+        Asynchronous version of DigQuery.iter_range, returning a list.
+        The index is built or checked in a worker thread.
+        """
+        return await self._in_thread(lambda: list(self.dig.iter_range(address_range)))
+
+    async def hostlist(self, zone_name):
+        """
+        Asynchronous version of DigQuery.hostlist
+        """
+        async for record in self._transfer(zone_name):
+            if self.dig._valid_type(record):
+                yield record
@@ -0,0 +1,1003 @@
+"""
+Benchmarks mmbop without a BIND server, so that changes can be
+measured (and regressions caught) on any machine.
+
+mmbop is run in its native modes against stand-ins started in this
+process: a small authoritative name server (queries, AXFR/IXFR and
+TSIG signed UPDATE) and an rndc control channel (status, addzone,
+delzone, zonestatus and dumpdb). Both serve the same synthetic zones:
+
+    bench.example          --records A records (host0000001...)
+    10.in-addr.arpa        the PTR records of bench.example
+    s<size>.bench.example  one zone of each --sizes, for search_domain
+    z<n>.dump.bench.example  --dump-zones small zones, for list_zones
+    catalog.bench.example  the catalog zone
+
+The zones of --sizes are encoded once for transfer and are read-only.
+Every benchmark reports throughput and latency percentiles, and the
+number of requests the stand-ins answered per operation. The start-cli
+and start-api benchmarks measure the cold start of the entry points,
+each run in a new Python process (a query with mmbop.py, and importing
+mmbop_api). serve-query and start-cli-serve make queries through the
+mmbop daemon (mmbop.py serve), over its socket and with the CLI.
+
+Usage: python3 mmbop_bench.py [--only query,search-100000] [--json]
+"""
+import argparse
+import base64
+import grp
+import hashlib
+import io
+import ipaddress
+import json
+import os
+import pwd
+import random
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+from time import perf_counter, sleep
+import mmbop_core
+from mmbop_core import DNSMessage, DNSRecord
+
+# The stand-ins use the message encoding internals of the mmbop clients
+# pylint: disable=protected-access
+
+BENCH_ZONE = 'bench.example'
+REVERSE_ZONE = '10.in-addr.arpa'
+CATALOG_ZONE = 'catalog.bench.example'
+# Records in each message of a zone transfer
+TRANSFER_BATCH = 200
+# Configuration keys that are read from the [RNDC] section
+RNDC_KEYS = ('server', 'port', 'keyfile', 'path')
+MMBOP_DIR = os.path.dirname(os.path.abspath(__file__))
+RCODE_NXDOMAIN = 3
+RCODE_REFUSED = 5
+RCODE_NOTAUTH = 9
+RCODE_NOTZONE = 10
+
+class BenchError(Exception):
+    """
+    Raised when an operation being measured does not succeed
+    """
+
+def _key(name):
+    """
+    Names are kept lower case, without the trailing dot
+    """
+    return name.lower().rstrip('.')
+
+class StandInZone:
+    """
+    A zone served by the stand-ins: its records by name, and the
+    encoded messages of its zone transfer (made when first needed,
+    and again after every change)
+    """
+
+    def __init__(self, name, serial=1):
+        self.name = _key(name)
+        self.serial = serial
+        self.static = False
+        self.records = {self.name: [DNSRecord(self.name + '.', 3600, 'IN', 'NS',
+                                              'ns1.' + BENCH_ZONE + '.')]}
+        self.wire = None
+
+    def soa(self):
+        """
+        The SOA record of the zone at its current serial
+        """
+        return DNSRecord(self.name + '.', 3600, 'IN', 'SOA',
+                         'ns1.%s. hostmaster.%s. %d 3600 600 86400 300'
+                         % (BENCH_ZONE, BENCH_ZONE, self.serial))
+
+    def add(self, record):
+        """
+        Add a record (ignoring an exact duplicate)
+        """
+        rrset = self.records.setdefault(_key(record.name), [])
+        for existing in rrset:
+            if existing.rtype == record.rtype and _key(existing.value) == _key(record.value):
+                return
+        rrset.append(record)
+
+    def delete(self, record):
+        """
+        Apply the delete in an update section record: the whole name
+        (type ANY), an rrset (class ANY) or one record (class NONE)
+        """
+        name = _key(record.name)
+        rrset = self.records.get(name, [])
+        if record.rtype == 'ANY':
+            rrset = []
+        elif record.rclass == 'ANY':
+            rrset = [x for x in rrset if x.rtype != record.rtype]
+        else:
+            rrset = [x for x in rrset if not (x.rtype == record.rtype and
+                                               _key(x.value) == _key(record.value))]
+        if rrset:
+            self.records[name] = rrset
+        else:
+            self.records.pop(name, None)
+
+    def encode(self, records=None):
+        """
+        Encode the zone transfer (of records, if given, instead of the
+        records of the zone), so that it is sent without re-encoding
+        """
+        soa = self.soa()
+        if records is None:
+            records = (x for rrset in self.records.values() for x in rrset)
+        self.wire = []
+        batch = [soa]
+        for record in records:
+            batch.append(record)
+            if len(batch) == TRANSFER_BATCH:
+                self.wire.append(self._message(batch))
+                batch = []
+        batch.append(soa)
+        self.wire.append(self._message(batch))
+        return self.wire
+
+    @staticmethod
+    def _message(records):
+        """
+        One message of a zone transfer (its id is filled in when sent)
+        """
+        message = DNSMessage(0, flags=mmbop_core.FLAG_QR | mmbop_core.FLAG_AA)
+        message.answer = records
+        return message.to_wire()
+
+class StandInZones:
+    """
+    The zones served by the stand-ins, and counts of the requests made
+    """
+
+    def __init__(self):
+        self.zones = {}
+        self.dump = None
+        self.lock = threading.Lock()
+        self.requests = {'query': 0, 'transfer': 0, 'update': 0, 'rndc': 0}
+
+    def count(self, kind):
+        """
+        Count one request of kind (query, transfer, update or rndc)
+        """
+        with self.lock:
+            self.requests[kind] += 1
+
+    def total(self):
+        """
+        Total number of requests answered so far
+        """
+        return sum(self.requests.values())
+
+    def add_zone(self, name, records=(), static=False):
+        """
+        Add a zone holding records. A static zone is encoded for transfer
+        as the records are read (so they are not kept), and cannot be
+        updated.
+        """
+        zone = StandInZone(name)
+        if static:
+            zone.static = True
+            zone.encode(records)
+        else:
+            for record in records:
+                zone.add(record)
+        with self.lock:
+            self.zones[zone.name] = zone
+            self.dump = None
+        return zone
+
+    def delete_zone(self, name):
+        """
+        Remove a zone, returning False if there is no such zone
+        """
+        with self.lock:
+            self.dump = None
+            return self.zones.pop(_key(name), None) is not None
+
+    def zone_of(self, name):
+        """
+        The zone that name belongs to (None if not served)
+        """
+        name = _key(name)
+        while True:
+            if name in self.zones:
+                return self.zones[name]
+            if '.' not in name:
+                return None
+            name = name.split('.', 1)[1]
+
+    def answer(self, query):
+        """
+        Return the reply DNSMessage to a query
+        """
+        reply = DNSMessage(query.msg_id, flags=mmbop_core.FLAG_QR | mmbop_core.FLAG_AA)
+        reply.question = query.question
+        (qname, qtype, _) = query.question[0]
+        with self.lock:
+            zone = self.zone_of(qname)
+            if zone is None:
+                reply.rcode = RCODE_REFUSED
+                return reply
+            rrset = zone.records.get(_key(qname))
+            if qtype == 'SOA' and _key(qname) == zone.name:
+                reply.answer = [zone.soa()]
+            elif rrset is None:
+                reply.rcode = RCODE_NXDOMAIN
+                reply.authority = [zone.soa()]
+            else:
+                reply.answer = [x for x in rrset if x.rtype in (qtype, 'CNAME')]
+                if not reply.answer:
+                    reply.authority = [zone.soa()]
+        return reply
+
+    def transfer(self, question, authority):
+        """
+        Return the encoded messages of a zone transfer, or None if the
+        zone is not served. An IXFR from the current serial is answered
+        with the SOA alone, any other IXFR with the whole zone.
+        """
+        (zone_name, qtype, _) = question
+        with self.lock:
+            zone = self.zones.get(_key(zone_name))
+            if zone is None:
+                return None
+            if qtype == 'IXFR' and authority and authority[0].rtype == 'SOA':
+                if int(authority[0].value.split()[2]) == zone.serial:
+                    return [StandInZone._message([zone.soa()])]
+            return zone.wire or zone.encode()
+
+    def update(self, message):
+        """
+        Apply the update section of an UPDATE message, returning the rcode
+        """
+        with self.lock:
+            zone = self.zones.get(_key(message.question[0][0]))
+            if zone is None or zone.static:
+                return RCODE_NOTAUTH
+            for record in message.authority:
+                name = _key(record.name)
+                if not (name == zone.name or name.endswith('.' + zone.name)):
+                    return RCODE_NOTZONE
+            for record in message.authority:
+                if record.rclass == 'IN':
+                    zone.add(record)
+                else:
+                    zone.delete(record)
+            zone.serial += 1
+            zone.wire = None
+            self.dump = None
+        return 0
+
+    def dump_text(self):
+        """
+        The contents of the file written by 'rndc dumpdb -zones'
+        """
+        with self.lock:
+            if self.dump is None:
+                lines = [';\n; Start view _default\n;\n']
+                for zone in self.zones.values():
+                    lines.append("; Zone dump of '%s/IN'\n" % zone.name)
+                    lines.append(mmbop_core.format_record(zone.soa()) + '\n')
+                    if not zone.static:
+                        lines.extend(mmbop_core.format_record(x) + '\n'
+                                     for rrset in zone.records.values() for x in rrset)
+                lines.append('; Dump complete\n')
+                self.dump = ''.join(lines).encode()
+            return self.dump
+
+class _QueryHandler(socketserver.BaseRequestHandler):
+    """
+    Answers a query received over UDP
+    """
+
+    def handle(self):
+        (data, sock) = self.request
+        zones = self.server.zones
+        try:
+            query = DNSMessage.from_wire(data)
+        except mmbop_core.DNSWireError:
+            return
+        zones.count('query')
+        reply = zones.answer(query)
+        wire = reply.to_wire()
+        if len(wire) > mmbop_core.EDNS_PAYLOAD:
+            reply.answer = []
+            reply.flags |= mmbop_core.FLAG_TC
+            wire = reply.to_wire()
+        sock.sendto(wire, self.client_address)
+
+class _StreamHandler(socketserver.BaseRequestHandler):
+    """
+    Answers the queries, zone transfers and updates received on
+    one TCP connection, until the client closes it
+    """
+
+    def handle(self):
+        zones = self.server.zones
+        while True:
+            try:
+                data = mmbop_core.DNSClient.read_tcp(self.request)
+                message = DNSMessage.from_wire(data)
+            except (mmbop_core.DNSWireError, OSError):
+                return
+            if message.opcode == mmbop_core.OPCODE_UPDATE:
+                zones.count('update')
+                wire = self._update(data, message)
+                if wire is None:
+                    return
+                mmbop_core.DNSClient.send_tcp(self.request, wire)
+            elif message.question and message.question[0][1] in ('AXFR', 'IXFR'):
+                zones.count('transfer')
+                chunks = zones.transfer(message.question[0], message.authority)
+                if chunks is None:
+                    reply = DNSMessage(message.msg_id, flags=mmbop_core.FLAG_QR)
+                    reply.rcode = RCODE_NOTAUTH
+                    chunks = [reply.to_wire()]
+                msg_id = struct.pack('!H', message.msg_id)
+                for chunk in chunks:
+                    mmbop_core.DNSClient.send_tcp(self.request, msg_id + chunk[2:])
+            else:
+                zones.count('query')
+                mmbop_core.DNSClient.send_tcp(self.request, zones.answer(message).to_wire())
+
+    def _update(self, data, message):
+        """
+        Verify and apply an update, returning the signed reply
+        (None if the update is not correctly signed)
+        """
+        try:
+            mac = self.server.tsig_key.verify(data, message)
+        except mmbop_core.DNSWireError:
+            return None
+        reply = DNSMessage(message.msg_id, opcode=mmbop_core.OPCODE_UPDATE,
+                           flags=mmbop_core.FLAG_QR)
+        reply.question = message.question
+        reply.rcode = self.server.zones.update(message)
+        return self.server.tsig_key.sign(reply, mac)[0]
+
+class _ControlHandler(socketserver.BaseRequestHandler):
+    """
+    Answers the rndc commands received on one control channel
+    connection, until the client closes it
+    """
+
+    def handle(self):
+        channel = mmbop_core.RNDCClient(key_file=self.server.key_file)
+        nonce = None
+        while True:
+            try:
+                (length, _) = struct.unpack('!II', mmbop_core._recv_exact(self.request, 8))
+                request = channel._verify(mmbop_core._recv_exact(self.request, length - 4))
+            except (mmbop_core.DNSWireError, mmbop_core.RNDCError, OSError, struct.error):
+                return
+            if nonce is not None and request.get('_ctrl', {}).get('_nonce') != nonce:
+                return
+            self.server.zones.count('rndc')
+            command = request.get('_data', {}).get('type', b'').decode()
+            data = self.server.standin.command(command)
+            data['type'] = command
+            if nonce is None:
+                nonce = str(random.randint(1, 1 << 31)).encode()
+            channel.nonce = nonce
+            try:
+                self.request.sendall(channel._build(data))
+            except OSError:
+                return
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    """
+    Threaded TCP server that does not wait for its handlers on exit
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+class StandIns:
+    """
+    Starts the name server and control channel stand-ins on
+    localhost (on free ports), serving zones
+    """
+
+    def __init__(self, zones, key_file, dump_dir):
+        self.zones = zones
+        self.key_file = key_file
+        self.dump_file = os.path.join(dump_dir, 'named_dump.db')
+        tsig_key = mmbop_core.TSIGKey.from_file(key_file)
+        # The UDP and TCP name servers share a port, as they do in BIND
+        for _ in range(10):
+            self.dns_tcp = _TCPServer(('127.0.0.1', 0), _StreamHandler)
+            self.dns_port = self.dns_tcp.server_address[1]
+            try:
+                self.dns_udp = socketserver.UDPServer(('127.0.0.1', self.dns_port),
+                                                      _QueryHandler)
+                break
+            except OSError:
+                self.dns_tcp.server_close()
+        else:
+            raise OSError('Unable to find a free port for the name server')
+        self.control = _TCPServer(('127.0.0.1', 0), _ControlHandler)
+        self.control_port = self.control.server_address[1]
+        for server in (self.dns_tcp, self.dns_udp, self.control):
+            server.zones = zones
+            server.tsig_key = tsig_key
+            server.key_file = key_file
+            server.standin = self
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    def command(self, command):
+        """
+        Run an rndc command, returning the _data of the reply
+        """
+        words = command.split()
+        name = words[0] if words else ''
+        data = {'result': '0'}
+        if name == 'status':
+            data['text'] = 'version: mmbop stand-in\nserver is up and running'
+        elif name == 'addzone' and len(words) > 1:
+            if _key(words[1]) in self.zones.zones:
+                data['err'] = 'already exists'
+            else:
+                self.zones.add_zone(words[1])
+        elif name == 'delzone' and len(words) > 1:
+            if self.zones.delete_zone(words[1]):
+                data['text'] = 'zone %s scheduled for removal.' % _key(words[1])
+            else:
+                data['err'] = "zone '%s' not found" % _key(words[1])
+        elif name == 'zonestatus' and len(words) > 1:
+            zone = self.zones.zones.get(_key(words[1]))
+            if zone:
+                data['text'] = 'name: %s\ntype: primary\nserial: %d' % (zone.name, zone.serial)
+            else:
+                data['err'] = 'not found'
+        elif name == 'dumpdb':
+            self._write_dump()
+        elif name != 'null':
+            data['err'] = 'unknown command'
+        if 'err' in data:
+            data['result'] = '1'
+        return data
+
+    def _write_dump(self):
+        """
+        Write the dump file, replacing the previous one at once
+        (as a finished dump, so list_zones does not wait on it)
+        """
+        temp_file = self.dump_file + '.tmp'
+        with open(temp_file, 'wb') as dump:
+            dump.write(self.zones.dump_text())
+        os.replace(temp_file, self.dump_file)
+
+    def close(self):
+        """
+        Stop the stand-ins
+        """
+        for server in (self.dns_tcp, self.dns_udp, self.control):
+            server.shutdown()
+            server.server_close()
+
+def host_records(zone_name, count, first_address, cname_every=0):
+    """
+    Generator of count A records host0000001.zone_name..., with
+    consecutive addresses, and (if cname_every) a CNAME record for
+    every cname_every hosts
+    """
+    for index in range(1, count + 1):
+        name = 'host%07d.%s.' % (index, zone_name)
+        if cname_every and index % cname_every == 0:
+            yield DNSRecord('www%07d.%s.' % (index, zone_name), 3600, 'IN', 'CNAME', name)
+        else:
+            yield DNSRecord(name, 3600, 'IN', 'A', str(first_address + index))
+
+def ptr_records(records):
+    """
+    Generator of the PTR records of A records
+    """
+    for record in records:
+        if record.rtype == 'A':
+            pointer = ipaddress.ip_address(record.value).reverse_pointer
+            yield DNSRecord(pointer + '.', 3600, 'IN', 'PTR', record.name)
+
+def write_key_file(key_file):
+    """
+    Write a key file with a new random secret, used for both
+    TSIG and the control channel
+    """
+    with open(key_file, 'w') as k_file:
+        k_file.write('key "bench-key" {\n\talgorithm hmac-sha256;\n\tsecret "%s";\n};\n'
+                     % base64.b64encode(os.urandom(32)).decode())
+
+def percentile(ordered, pct):
+    """
+    The pct percentile (nearest rank) of a sorted list
+    """
+    if not ordered:
+        return 0.0
+    rank = max(int(round(pct / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+def measure(name, operation, count, zones, items=1):
+    """
+    Call operation(i) for i in range(count), timing each call.
+    Returns a dict of the results, items being the records (or zones)
+    handled by each call.
+    """
+    latencies = []
+    requests = zones.total()
+    started = perf_counter()
+    for index in range(count):
+        call_start = perf_counter()
+        operation(index)
+        latencies.append(perf_counter() - call_start)
+    elapsed = perf_counter() - started
+    latencies.sort()
+    return {'name': name,
+            'ops': count,
+            'seconds': elapsed,
+            'ops_per_sec': count / elapsed if elapsed else 0.0,
+            'items_per_sec': count * items / elapsed if elapsed else 0.0,
+            'p50_ms': percentile(latencies, 50) * 1000,
+            'p90_ms': percentile(latencies, 90) * 1000,
+            'p99_ms': percentile(latencies, 99) * 1000,
+            'max_ms': latencies[-1] * 1000 if latencies else 0.0,
+            'requests_per_op': (zones.total() - requests) / count if count else 0.0}
+
+def _check(result, what):
+    """
+    Raise BenchError unless result, a (boolean, message) tuple, succeeded
+    """
+    if not result[0]:
+        raise BenchError('%s failed: %s' % (what, result[1]))
+
+class Benchmarks:
+    """
+    The benchmarks, run against mmbop instances set up (from
+    config) to use the stand-ins
+    """
+
+    def __init__(self, args, zones, config, work_dir):
+        self.args = args
+        self.zones = zones
+        self.work_dir = work_dir
+        self.random = random.Random(args.seed)
+        self.dig = mmbop_core.DigQuery.create(**config)
+        self.rndc = mmbop_core.RNDC.create(dig=self.dig, **config)
+        self.nsupdate = self.rndc.my_nsupdate
+        self.added_ranges = 0
+        self.added_zones = 0
+        self.daemon = None
+
+    def query(self):
+        """
+        find_record of a random host name
+        """
+        names = ['host%07d.%s' % (self.random.randint(1, self.args.records), BENCH_ZONE)
+                 for _ in range(self.args.queries)]
+        self._lookup(names[0])
+        return measure('query', lambda i: self._lookup(names[i]), len(names), self.zones)
+
+    def query_ip(self):
+        """
+        find_record (PTR) of a random host address
+        """
+        first = ipaddress.ip_address('10.0.0.0')
+        addresses = [str(first + self.random.randint(1, self.args.records))
+                     for _ in range(self.args.queries)]
+        self._lookup(addresses[0])
+        return measure('query-ip', lambda i: self._lookup(addresses[i]), len(addresses),
+                       self.zones)
+
+    def _lookup(self, name):
+        """
+        Look up a name that has to exist
+        """
+        if not self.dig.find_record(name):
+            raise BenchError('No record found for %s' % name)
+
+    def search(self, size):
+        """
+        search_domain of a zone of size records
+        """
+        zone_name = 's%d.%s' % (size, BENCH_ZONE)
+        def operation(_):
+            if not self.dig.search_domain(zone_name, self.args.search):
+                raise BenchError('No records in %s matched %s' % (zone_name, self.args.search))
+        operation(None)
+        return measure('search-%d' % size, operation, self.args.iterations, self.zones, size)
+
+    def _range_start(self, index):
+        """
+        The first name and address of the index'th range of hosts
+        """
+        first = ipaddress.ip_address('10.128.0.0') + index * self.args.batch + 1
+        return ('bulk%dx00001.%s' % (index, BENCH_ZONE), str(first))
+
+    def hostadd_range(self):
+        """
+        hostadd_range of --batch hosts
+        """
+        def operation(index):
+            (fqdn, address) = self._range_start(index)
+            _check(mmbop_core.hostadd_range(self.nsupdate, fqdn, address, self.args.batch),
+                   'hostadd_range %s' % fqdn)
+        result = measure('hostadd-range', operation, self.args.iterations, self.zones,
+                         self.args.batch)
+        self.added_ranges = self.args.iterations
+        return result
+
+    def hostdel_range(self):
+        """
+        hostdel_range of the hosts added by hostadd_range (which are
+        added first, unmeasured, if that benchmark was not run)
+        """
+        for index in range(self.added_ranges, self.args.iterations):
+            (fqdn, address) = self._range_start(index)
+            _check(mmbop_core.hostadd_range(self.nsupdate, fqdn, address, self.args.batch),
+                   'hostadd_range %s' % fqdn)
+        def operation(index):
+            (fqdn, _) = self._range_start(index)
+            _check(mmbop_core.hostdel_range(self.nsupdate, fqdn, self.args.batch),
+                   'hostdel_range %s' % fqdn)
+        self.added_ranges = 0
+        return measure('hostdel-range', operation, self.args.iterations, self.zones,
+                       self.args.batch)
+
+    def _import(self, name):
+        """
+        import of a CSV file of --import-records hosts, into a zone of
+        their own (the file and zone are made by the first call)
+        """
+        zone_name = 'import.' + BENCH_ZONE
+        path = os.path.join(self.work_dir, 'import.csv')
+        if not os.path.exists(path):
+            self.zones.add_zone(zone_name)
+            with open(path, 'w') as csv_file:
+                csv_file.write('fqdn,addr\n')
+                for record in host_records(zone_name, self.args.import_records,
+                                           ipaddress.ip_address('10.160.0.0')):
+                    csv_file.write('%s,%s\n' % (record.name, record.value))
+        def operation(_):
+            out = io.StringIO()
+            mmbop_core.import_records(self.nsupdate, path, log_file=path + '.log', out=out)
+            if ' 0 failed' not in out.getvalue():
+                raise BenchError('import failed: %s' % out.getvalue().strip())
+        return measure(name, operation, 1, self.zones, self.args.import_records)
+
+    def import_file(self):
+        """
+        import of --import-records new hosts
+        """
+        return self._import('import')
+
+    def import_again(self):
+        """
+        import of the same hosts again, which all exist
+        """
+        return self._import('import-again')
+
+    def zonelist(self):
+        """
+        list_zones, with a dump file of all the zones
+        """
+        def operation(_):
+            if not self.rndc.list_zones():
+                raise BenchError('list_zones found no zones')
+        operation(None)
+        return measure('zonelist', operation, self.args.iterations, self.zones,
+                       len(self.zones.zones))
+
+    @staticmethod
+    def _zone_name(index):
+        """
+        Name of the index'th zone added by zoneadd
+        """
+        return 'add%05d.%s' % (index, BENCH_ZONE)
+
+    def zoneadd(self):
+        """
+        RNDC.add of a new zone (zone file, addzone and catalog update)
+        """
+        def operation(index):
+            _check(self.rndc.add(self._zone_name(index)), 'add %s' % self._zone_name(index))
+        result = measure('zoneadd', operation, self.args.zone_ops, self.zones)
+        self.added_zones = self.args.zone_ops
+        return result
+
+    def zonedel(self):
+        """
+        RNDC.delete of the zones added by zoneadd (which are added
+        first, unmeasured, if that benchmark was not run)
+        """
+        for index in range(self.added_zones, self.args.zone_ops):
+            _check(self.rndc.add(self._zone_name(index)), 'add %s' % self._zone_name(index))
+        def operation(index):
+            _check(self.rndc.delete(self._zone_name(index)),
+                   'delete %s' % self._zone_name(index))
+        self.added_zones = 0
+        return measure('zonedel', operation, self.args.zone_ops, self.zones)
+
+    def _start(self, name, command):
+        """
+        Time command (run in a new Python process, in work_dir) for the
+        start-cli and start-api benchmarks
+        """
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+            [MMBOP_DIR] + [x for x in [os.environ.get('PYTHONPATH')] if x]))
+        def operation(_):
+            started = subprocess.run(command, cwd=self.work_dir, env=env,
+                                     stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            if started.returncode:
+                raise BenchError('%s failed: %s' % (name, started.stderr.decode().strip()))
+        return measure(name, operation, self.args.starts, self.zones)
+
+    def start_cli(self):
+        """
+        mmbop.py query of one host, in a new process
+        """
+        return self._start('start-cli', [sys.executable, os.path.join(MMBOP_DIR, 'mmbop.py'),
+                                         '-c', os.path.join(self.work_dir, 'mmbop.ini'),
+                                         'query', 'host0000001.' + BENCH_ZONE])
+
+    def _daemon_socket(self):
+        """
+        Start 'mmbop.py serve' (once) for the serve benchmarks, returning
+        the path of its socket
+        """
+        path = os.path.join(self.work_dir, 'mmbop.sock')
+        if not self.daemon:
+            self.daemon = subprocess.Popen([sys.executable, os.path.join(MMBOP_DIR, 'mmbop.py'),
+                                            '-c', os.path.join(self.work_dir, 'mmbop.ini'),
+                                            'serve', '--socket', path],
+                                           stderr=subprocess.DEVNULL)
+            deadline = perf_counter() + 10
+            while not os.path.exists(path):
+                if self.daemon.poll() is not None or perf_counter() > deadline:
+                    raise BenchError('mmbop.py serve did not start')
+                sleep(0.01)
+        return path
+
+    def serve_query(self):
+        """
+        Query of a random host name sent to the mmbop daemon (as a shell
+        script using the socket would, without starting the CLI)
+        """
+        path = self._daemon_socket()
+        names = ['host%07d.%s' % (self.random.randint(1, self.args.records), BENCH_ZONE)
+                 for _ in range(self.args.queries)]
+        def operation(index):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+                client.connect(path)
+                client.sendall(('query %s\n' % names[index]).encode())
+                reply = b''
+                while True:
+                    chunk = client.recv(65536)
+                    if not chunk:
+                        break
+                    reply += chunk
+            if not reply.endswith(b'\x000\n') or reply.startswith(b'Error'):
+                raise BenchError('Query of %s failed: %s' % (names[index], reply.decode()))
+        return measure('serve-query', operation, len(names), self.zones)
+
+    def start_cli_serve(self):
+        """
+        mmbop.py query of one host, in a new process, sent on to the
+        mmbop daemon (which reads the same mmbop.ini, in work_dir)
+        """
+        return self._start('start-cli-serve', [sys.executable,
+                                               os.path.join(MMBOP_DIR, 'mmbop.py'),
+                                               '-s', self._daemon_socket(),
+                                               'query', 'host0000001.' + BENCH_ZONE])
+
+    def close(self):
+        """
+        Stop the mmbop daemon, if it was started
+        """
+        if self.daemon:
+            self.daemon.terminate()
+            self.daemon.wait()
+
+    def start_api(self):
+        """
+        Importing mmbop_api (reading mmbop.ini in work_dir), in a new
+        process. Returns None if falcon is not installed.
+        """
+        try:
+            import falcon  # pylint: disable=import-outside-toplevel,unused-import
+        except ImportError:
+            sys.stderr.write('Skipping start-api: falcon is not installed\n')
+            return None
+        return self._start('start-api', [sys.executable, '-c', 'import mmbop_api'])
+
+    def run(self, selected):
+        """
+        Generator of the results of the selected benchmarks (all if
+        selected is empty), in order
+        """
+        benchmarks = [('query', self.query), ('query-ip', self.query_ip)]
+        for size in self.args.sizes:
+            benchmarks.append(('search-%d' % size, lambda size=size: self.search(size)))
+        benchmarks.extend([('hostadd-range', self.hostadd_range),
+                           ('hostdel-range', self.hostdel_range),
+                           ('import', self.import_file),
+                           ('import-again', self.import_again),
+                           ('zonelist', self.zonelist),
+                           ('zoneadd', self.zoneadd),
+                           ('zonedel', self.zonedel),
+                           ('start-cli', self.start_cli),
+                           ('start-api', self.start_api),
+                           ('serve-query', self.serve_query),
+                           ('start-cli-serve', self.start_cli_serve)])
+        for (name, benchmark) in benchmarks:
+            if not selected or name in selected:
+                result = benchmark()
+                if result:
+                    yield result
+
+def load_zones(args):
+    """
+    Return the StandInZones holding the synthetic zones
+    """
+    zones = StandInZones()
+    forward = list(host_records(BENCH_ZONE, args.records, ipaddress.ip_address('10.0.0.0')))
+    zones.add_zone(BENCH_ZONE, forward)
+    zones.add_zone(REVERSE_ZONE, ptr_records(forward))
+    zones.add_zone(CATALOG_ZONE)
+    for size in args.sizes:
+        zone_name = 's%d.%s' % (size, BENCH_ZONE)
+        zones.add_zone(zone_name, host_records(zone_name, size,
+                                               ipaddress.ip_address('10.64.0.0'), 10),
+                       static=True)
+    for index in range(args.dump_zones):
+        zone_name = 'z%05d.dump.%s' % (index, BENCH_ZONE)
+        zones.add_zone(zone_name, host_records(zone_name, 4, ipaddress.ip_address('10.96.0.0')))
+    return zones
+
+def bench_config(standins, work_dir, options):
+    """
+    The mmbop configuration (as read_config returns it) for the stand-ins,
+    with options (list of KEY=VALUE) applied over it
+    """
+    missing = os.path.join(work_dir, 'missing')
+    config = {'server': '127.0.0.1',
+              'port': str(standins.control_port),
+              'keyfile': standins.key_file,
+              'path': missing,
+              'digpath': missing,
+              'querymode': 'native',
+              'updatemode': 'native',
+              'controlmode': 'native',
+              'dnsserver': '127.0.0.1',
+              'dnsport': str(standins.dns_port),
+              'namedir': work_dir,
+              'nameown': pwd.getpwuid(os.getuid()).pw_name,
+              'namegrp': grp.getgrgid(os.getgid()).gr_name,
+              'require': ['.' + BENCH_ZONE],
+              'catalog': CATALOG_ZONE,
+              'reversezones': REVERSE_ZONE}
+    for option in options:
+        (key, value) = option.split('=', 1)
+        if '|' in value:
+            value = value.split('|')
+        config[key.strip().lower()] = value
+    return config
+
+def write_config(config, work_dir, token='mmbop-bench'):
+    """
+    Write mmbop.ini (from the mmbop configuration dict) and mmbop_api.ini
+    (with the hash of token) in work_dir
+    """
+    sections = {'RNDC': [], 'BACKEND': []}
+    for (key, value) in sorted(config.items()):
+        if isinstance(value, list):
+            value = '|'.join(value)
+        sections['RNDC' if key in RNDC_KEYS else 'BACKEND'].append('%s: %s' % (key, value))
+    with open(os.path.join(work_dir, 'mmbop.ini'), 'w') as conf_file:
+        for (section, lines) in sections.items():
+            conf_file.write('[%s]\n%s\n' % (section, '\n'.join(lines)))
+    with open(os.path.join(work_dir, 'mmbop_api.ini'), 'w') as token_file:
+        token_file.write('[DEFAULT]\ntoken: %s\n' % hashlib.sha224(token.encode()).hexdigest())
+
+def print_results(results, out=sys.stdout):
+    """
+    Print the results as a table, as each one arrives
+    """
+    out.write('%-16s %6s %10s %12s %9s %9s %9s %9s %8s\n'
+              % ('benchmark', 'ops', 'ops/s', 'items/s', 'p50 ms', 'p90 ms', 'p99 ms',
+                 'max ms', 'req/op'))
+    for result in results:
+        out.write('%-16s %6d %10.1f %12.1f %9.2f %9.2f %9.2f %9.2f %8.1f\n'
+                  % (result['name'], result['ops'], result['ops_per_sec'],
+                     result['items_per_sec'], result['p50_ms'], result['p90_ms'],
+                     result['p99_ms'], result['max_ms'], result['requests_per_op']))
+        out.flush()
+
+def parse_arguments():
+    """
+    Uses argparse to define and parse command-line arguments
+    """
+    help_width = lambda prog: argparse.HelpFormatter(prog, max_help_position=30)
+    parser = argparse.ArgumentParser(description='Benchmark mmbop against local stand-ins '
+                                     'for BIND', formatter_class=help_width)
+    parser.add_argument('--records', metavar='N', type=int, default=10000,
+                        help='Hosts in the zone used for queries (default: 10000)')
+    parser.add_argument('--sizes', metavar='N,N', default='10000,100000',
+                        help='Sizes of the zones to search (default: 10000,100000)')
+    parser.add_argument('--search', metavar='TERM', default='host00001',
+                        help='What to search the zones for (default: host00001)')
+    parser.add_argument('--queries', metavar='N', type=int, default=2000,
+                        help='Lookups made by the query benchmarks (default: 2000)')
+    parser.add_argument('--iterations', metavar='N', type=int, default=5,
+                        help='Searches, zone lists and ranges added (default: 5)')
+    parser.add_argument('--batch', metavar='N', type=int, default=200,
+                        help='Hosts in each range added and deleted (default: 200)')
+    parser.add_argument('--import-records', metavar='N', type=int, default=20000,
+                        help='Hosts in the file of the import benchmarks (default: 20000)')
+    parser.add_argument('--dump-zones', metavar='N', type=int, default=10000,
+                        help='Extra zones in the dump file for zonelist (default: 10000)')
+    parser.add_argument('--zone-ops', metavar='N', type=int, default=50,
+                        help='Zones added and deleted (default: 50)')
+    parser.add_argument('--starts', metavar='N', type=int, default=10,
+                        help='Processes started by the start benchmarks (default: 10)')
+    parser.add_argument('--only', metavar='NAME,NAME',
+                        help='Run only these benchmarks (query, query-ip, search-SIZE, '
+                        'hostadd-range, hostdel-range, import, import-again, zonelist, '
+                        'zoneadd, zonedel, start-cli, start-api, serve-query, '
+                        'start-cli-serve)')
+    parser.add_argument('-o', '--option', metavar='KEY=VALUE', action='append', default=[],
+                        help='Set an mmbop configuration option (e.g. zonecache=256)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the random lookups')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON, one benchmark per line')
+    args = parser.parse_args()
+    try:
+        args.sizes = [int(x) for x in args.sizes.split(',') if x.strip()]
+    except ValueError:
+        parser.error('--sizes must be a list of numbers')
+    for option in args.option:
+        if '=' not in option:
+            parser.error('--option must be of form KEY=VALUE')
+    if min([args.records, args.queries, args.iterations, args.batch, args.zone_ops,
+            args.starts, args.import_records] + args.sizes) < 1:
+        parser.error('counts must be at least 1')
+    return args
+
+def main():
+    """
+    Direct calling function
+    """
+    args = parse_arguments()
+    selected = set(x.strip() for x in (args.only or '').split(',') if x.strip())
+    with tempfile.TemporaryDirectory(prefix='mmbop-bench-') as work_dir:
+        key_file = os.path.join(work_dir, 'bench.key')
+        write_key_file(key_file)
+        sys.stderr.write('Loading zones...\n')
+        zones = load_zones(args)
+        standins = StandIns(zones, key_file, work_dir)
+        benchmarks = None
+        try:
+            config = bench_config(standins, work_dir, args.option)
+            write_config(config, work_dir)
+            benchmarks = Benchmarks(args, zones, config, work_dir)
+            results = benchmarks.run(selected)
+            if args.json:
+                for result in results:
+                    print(json.dumps(result))
+                    sys.stdout.flush()
+            else:
+                print_results(results)
+        except (BenchError, mmbop_core.DigQueryError, mmbop_core.RNDCError,
+                mmbop_core.NSUpdateError, socket.error) as bench_err:
+            sys.stderr.write('Error: %s\n' % bench_err)
+            sys.exit(1)
+        finally:
+            if benchmarks:
+                benchmarks.close()
+            standins.close()
+
+if __name__ == "__main__":
+    main()
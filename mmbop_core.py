@@ -0,0 +1,5002 @@
+"""
+
+mmbop_core.py
+
+mmbop manages BIND over Python
+
+While entries in a zone file can be managed using Dynamic DNS, the creation and removal
+of zones has to be done through editing the named.conf file or with rndc.
+
+However rndc itself requires that the template zone file already exists, which necessitates
+some kind of helper/wrapper function so that the creation (and removal) of zones
+can be performed in an atomic manner. This script performs that function.
+
+This also supports the use of catalog zones, so that (through nsupdate) the catalog zone
+can be modified and the secondary servers will serve the new zones automatically.
+
+An attempt was made to rely only on Python standard library modules (which is why
+nsupdate is used, instead of dnspython, to update the catalog zone).
+
+The script can run directly or as a REST API service (with the -r <port> flag)
+
+This is all of mmbop but the command line client (mmbop.py), which
+sends commands to the mmbop daemon when there is one, and otherwise
+runs main here. "import mmbop" gives this module.
+
+Author: Scott Strattner (sstrattn@us.ibm.com)
+
+"""
+
+import argparse
+import base64
+import bisect
+import collections
+import concurrent.futures
+import configparser
+import csv
+import functools
+import grp
+import hashlib
+import heapq
+import hmac
+import io
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import pwd
+import random
+import re
+import shlex
+import signal
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+from time import monotonic, sleep, time
+
+class DNSWireError(Exception):
+    """
+    Error class for DNSClient
+    """
+
+# Record types and classes mmbop needs to handle by name
+RR_TYPES = {'A': 1, 'NS': 2, 'CNAME': 5, 'SOA': 6, 'PTR': 12, 'MX': 15, 'TXT': 16,
+            'AAAA': 28, 'SRV': 33, 'DNAME': 39, 'OPT': 41, 'TSIG': 250, 'IXFR': 251,
+            'AXFR': 252, 'ANY': 255}
+RR_CLASSES = {'IN': 1, 'NONE': 254, 'ANY': 255}
+RCODES = {0: 'NOERROR', 1: 'FORMERR', 2: 'SERVFAIL', 3: 'NXDOMAIN', 4: 'NOTIMP',
+          5: 'REFUSED', 6: 'YXDOMAIN', 7: 'YXRRSET', 8: 'NXRRSET', 9: 'NOTAUTH',
+          10: 'NOTZONE', 16: 'BADSIG', 17: 'BADKEY', 18: 'BADTIME'}
+OPCODE_QUERY = 0
+OPCODE_UPDATE = 5
+FLAG_QR = 0x8000
+FLAG_AA = 0x0400
+FLAG_TC = 0x0200
+FLAG_RD = 0x0100
+# Largest UDP reply we advertise (through EDNS) that we can accept
+EDNS_PAYLOAD = 4096
+
+# A single resource record. The value is the presentation (text) format
+# of the rdata, the same as dig would print it.
+DNSRecord = collections.namedtuple('DNSRecord', ['name', 'ttl', 'rclass', 'rtype', 'value'])
+
+_RANDOM = random.SystemRandom()
+
+def format_record(record):
+    """
+    Return the record as a line of text, in the same format
+    that 'dig +noall +answer' uses
+    """
+    return '%s\t%s\t%s\t%s\t%s' % record
+
+def _type_code(rtype):
+    """
+    Convert a record type mnemonic (or TYPEnnn) to its number
+    """
+    rtype = rtype.upper()
+    if rtype in RR_TYPES:
+        return RR_TYPES[rtype]
+    if rtype.startswith('TYPE') and rtype[4:].isdigit():
+        return int(rtype[4:])
+    raise DNSWireError('Unknown record type %s' % rtype)
+
+def _type_name(code):
+    """
+    Convert a record type number to its mnemonic
+    """
+    for (name, value) in RR_TYPES.items():
+        if value == code:
+            return name
+    return 'TYPE%d' % code
+
+def _class_code(rclass):
+    """
+    Convert a class mnemonic to its number. OPT records use the
+    class field for the payload size, so integers pass through.
+    """
+    if isinstance(rclass, int):
+        return rclass
+    rclass = rclass.upper()
+    if rclass in RR_CLASSES:
+        return RR_CLASSES[rclass]
+    if rclass.startswith('CLASS') and rclass[5:].isdigit():
+        return int(rclass[5:])
+    raise DNSWireError('Unknown record class %s' % rclass)
+
+def _class_name(code):
+    """
+    Convert a class number to its mnemonic
+    """
+    for (name, value) in RR_CLASSES.items():
+        if value == code:
+            return name
+    return 'CLASS%d' % code
+
+def _escape_bytes(raw, special):
+    """
+    Return raw bytes as text, escaping the special characters with a
+    backslash and anything unprintable in \\DDD form (RFC 1035 5.1)
+    """
+    text = []
+    for byte in raw:
+        if chr(byte) in special:
+            text.append('\\' + chr(byte))
+        elif 0x20 < byte < 0x7f:
+            text.append(chr(byte))
+        else:
+            text.append('\\%03d' % byte)
+    return ''.join(text)
+
+def _encode_name(name):
+    """
+    Convert a domain name to (uncompressed) wire format.
+    All names are treated as absolute.
+    """
+    wire = []
+    name = name.rstrip('.')
+    if name:
+        for label in name.split('.'):
+            try:
+                raw = label.encode('ascii')
+            except UnicodeEncodeError as encode_err:
+                raise DNSWireError('Name %s is not ASCII' % name) from encode_err
+            if not raw or len(raw) > 63:
+                raise DNSWireError('Invalid label in name %s' % name)
+            wire.append(bytes([len(raw)]) + raw)
+    wire.append(b'\x00')
+    return b''.join(wire)
+
+def _decode_name(message, offset):
+    """
+    Read a (possibly compressed) domain name from the message,
+    returning tuple of form: (string:name, int:offset_after_name)
+    """
+    labels = []
+    end = None
+    hops = 0
+    while True:
+        length = message[offset]
+        if length & 0xC0 == 0xC0:
+            if end is None:
+                end = offset + 2
+            hops += 1
+            if hops > 127:
+                raise DNSWireError('Compression loop in name')
+            offset = ((length & 0x3F) << 8) | message[offset + 1]
+            continue
+        offset += 1
+        if not length:
+            break
+        labels.append(_escape_bytes(message[offset:offset + length], '.\\"();@$'))
+        offset += length
+    if end is None:
+        end = offset
+    return ('.'.join(labels) + '.', end)
+
+def _decode_rdata(message, offset, rdlength, rtype):
+    """
+    Return the rdata at offset as text (presentation format)
+    """
+    rdata = message[offset:offset + rdlength]
+    if not rdlength:
+        return ''
+    if rtype == 'A' and rdlength == 4:
+        return str(ipaddress.IPv4Address(rdata))
+    if rtype == 'AAAA' and rdlength == 16:
+        return str(ipaddress.IPv6Address(rdata))
+    if rtype in ('NS', 'CNAME', 'PTR', 'DNAME'):
+        return _decode_name(message, offset)[0]
+    if rtype == 'SOA':
+        (mname, pos) = _decode_name(message, offset)
+        (rname, pos) = _decode_name(message, pos)
+        timers = struct.unpack('!5I', message[pos:pos + 20])
+        return ' '.join([mname, rname] + [str(x) for x in timers])
+    if rtype == 'MX':
+        preference = struct.unpack('!H', rdata[:2])[0]
+        return '%d %s' % (preference, _decode_name(message, offset + 2)[0])
+    if rtype == 'SRV':
+        (priority, weight, port) = struct.unpack('!3H', rdata[:6])
+        return '%d %d %d %s' % (priority, weight, port, _decode_name(message, offset + 6)[0])
+    if rtype == 'TXT':
+        strings = []
+        pos = 0
+        while pos < rdlength:
+            length = rdata[pos]
+            strings.append('"%s"' % _escape_bytes(rdata[pos + 1:pos + 1 + length], '"\\'))
+            pos += 1 + length
+        return ' '.join(strings)
+    # Unknown record type, use the generic format of RFC 3597
+    return '\\# %d %s' % (rdlength, rdata.hex().upper())
+
+def _encode_rdata(rtype, value):
+    """
+    Convert the text (presentation format) of the rdata to wire format.
+    An empty value gives empty rdata, as used by update deletes.
+    """
+    if not value:
+        return b''
+    try:
+        if value.startswith('\\#'):
+            return bytes.fromhex(''.join(value.split()[2:]))
+        if rtype == 'A':
+            return ipaddress.IPv4Address(value).packed
+        if rtype == 'AAAA':
+            return ipaddress.IPv6Address(value).packed
+        if rtype in ('NS', 'CNAME', 'PTR', 'DNAME'):
+            return _encode_name(value)
+        if rtype == 'SOA':
+            fields = value.split()
+            return (_encode_name(fields[0]) + _encode_name(fields[1]) +
+                    struct.pack('!5I', *[int(x) for x in fields[2:7]]))
+        if rtype == 'MX':
+            (preference, exchange) = value.split()
+            return struct.pack('!H', int(preference)) + _encode_name(exchange)
+        if rtype == 'TXT':
+            strings = re.findall(r'"((?:[^"\\]|\\.)*)"|(\S+)', value)
+            return b''.join(bytes([len(x)]) + x for x in
+                            [(quoted or bare).encode() for (quoted, bare) in strings])
+    except (ValueError, IndexError, struct.error) as val_err:
+        raise DNSWireError('Invalid %s rdata %s: %s' % (rtype, value, val_err)) from val_err
+    raise DNSWireError('Unsupported record type %s' % rtype)
+
+def _recv_exact(sock, length):
+    """
+    Read exactly length bytes from a stream socket
+    """
+    data = b''
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise DNSWireError('Connection closed by name server')
+        data += chunk
+    return data
+
+class DNSMessage:
+    """
+    A DNS message (RFC 1035 section 4), either built to be sent
+    to the name server or parsed from its reply.
+
+    Questions are tuples of form (name, type, class), the other
+    sections are lists of DNSRecord.
+    """
+
+    def __init__(self, msg_id=None, opcode=OPCODE_QUERY, flags=0):
+        if msg_id is None:
+            msg_id = _RANDOM.randint(0, 0xFFFF)
+        self.msg_id = msg_id
+        self.opcode = opcode
+        self.flags = flags
+        self.rcode = 0
+        self.question = []
+        self.answer = []
+        self.authority = []
+        self.additional = []
+        self.tsig = None
+
+    @property
+    def truncated(self):
+        """
+        True if the server set the TC bit (reply too large for UDP)
+        """
+        return bool(self.flags & FLAG_TC)
+
+    @property
+    def rcode_name(self):
+        """
+        The response code as text (NOERROR, NXDOMAIN, ...)
+        """
+        return RCODES.get(self.rcode, 'RCODE%d' % self.rcode)
+
+    @staticmethod
+    def _record_to_wire(record):
+        """
+        Wire format of a DNSRecord
+        """
+        rdata = _encode_rdata(record.rtype, record.value)
+        return (_encode_name(record.name) +
+                struct.pack('!HHIH', _type_code(record.rtype), _class_code(record.rclass),
+                            int(record.ttl), len(rdata)) + rdata)
+
+    def to_wire(self):
+        """
+        Return the message in wire format (no name compression)
+        """
+        header_flags = (self.flags & 0x87F0) | (self.opcode << 11) | (self.rcode & 0xF)
+        wire = [struct.pack('!6H', self.msg_id, header_flags, len(self.question),
+                            len(self.answer), len(self.authority), len(self.additional))]
+        for (qname, qtype, qclass) in self.question:
+            wire.append(_encode_name(qname) +
+                        struct.pack('!HH', _type_code(qtype), _class_code(qclass)))
+        for section in (self.answer, self.authority, self.additional):
+            for record in section:
+                wire.append(self._record_to_wire(record))
+        return b''.join(wire)
+
+    @classmethod
+    def from_wire(cls, data):
+        """
+        Parse a message received from the name server
+        """
+        try:
+            (msg_id, header_flags, qdcount, ancount, nscount, arcount) = \
+                struct.unpack('!6H', data[:12])
+            message = cls(msg_id, (header_flags >> 11) & 0xF, header_flags & 0x87F0)
+            message.rcode = header_flags & 0xF
+            offset = 12
+            for _ in range(qdcount):
+                (qname, offset) = _decode_name(data, offset)
+                (qtype, qclass) = struct.unpack('!HH', data[offset:offset + 4])
+                offset += 4
+                message.question.append((qname, _type_name(qtype), _class_name(qclass)))
+            for (section, count) in ((message.answer, ancount),
+                                     (message.authority, nscount),
+                                     (message.additional, arcount)):
+                for _ in range(count):
+                    record_start = offset
+                    (name, offset) = _decode_name(data, offset)
+                    (rtype, rclass, ttl, rdlength) = struct.unpack('!HHIH',
+                                                                   data[offset:offset + 10])
+                    offset += 10
+                    if offset + rdlength > len(data):
+                        raise DNSWireError('Record data runs past end of message')
+                    rtype = _type_name(rtype)
+                    if rtype == 'TSIG':
+                        # Kept aside (as offset, rdata) for TSIGKey.verify
+                        message.tsig = (record_start, data[offset:offset + rdlength])
+                        offset += rdlength
+                        continue
+                    section.append(DNSRecord(name, ttl, _class_name(rclass), rtype,
+                                             _decode_rdata(data, offset, rdlength, rtype)))
+                    offset += rdlength
+        except (IndexError, struct.error, ValueError) as parse_err:
+            raise DNSWireError('Malformed DNS message: %s' % parse_err) from parse_err
+        return message
+
+class DNSClient:
+    """
+    Speaks the DNS wire protocol directly to a single name server
+    (by default the local BIND instance), without calling dig
+    """
+
+    def __init__(self, server='127.0.0.1', port=53, timeout=5):
+        try:
+            if ipaddress.ip_address(server).version == 6:
+                self.family = socket.AF_INET6
+            else:
+                self.family = socket.AF_INET
+        except ValueError as addr_err:
+            raise DNSWireError('Invalid name server address %s' % server) from addr_err
+        self.address = (server, int(port))
+        self.timeout = float(timeout)
+
+    def _connect(self):
+        """
+        Return a TCP socket connected to the name server
+        """
+        sock = socket.socket(self.family, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    @staticmethod
+    def send_tcp(sock, wire):
+        """
+        Send one message over TCP (prefixed with its length)
+        """
+        sock.sendall(struct.pack('!H', len(wire)) + wire)
+
+    @staticmethod
+    def read_tcp(sock):
+        """
+        Read one (length prefixed) message from TCP, as raw bytes
+        """
+        (length,) = struct.unpack('!H', _recv_exact(sock, 2))
+        return _recv_exact(sock, length)
+
+    def _exchange_udp(self, message):
+        """
+        Send the message over UDP, returning the matching reply
+        """
+        with socket.socket(self.family, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+            sock.send(message.to_wire())
+            while True:
+                reply = DNSMessage.from_wire(sock.recv(65535))
+                if reply.msg_id == message.msg_id:
+                    return reply
+                logging.debug('Ignoring reply with mismatched id %s', reply.msg_id)
+
+    def _exchange_tcp(self, message):
+        """
+        Send the message over TCP, returning the reply
+        """
+        with self._connect() as sock:
+            self.send_tcp(sock, message.to_wire())
+            return DNSMessage.from_wire(self.read_tcp(sock))
+
+    def query(self, qname, qtype='A'):
+        """
+        Query the name server, using UDP and retrying over TCP if
+        the reply was truncated. Returns the reply DNSMessage.
+        """
+        message = DNSMessage(flags=FLAG_RD)
+        message.question.append((qname, qtype, 'IN'))
+        message.additional.append(DNSRecord('.', 0, EDNS_PAYLOAD, 'OPT', ''))
+        try:
+            reply = self._exchange_udp(message)
+            if reply.truncated:
+                logging.debug('Reply for %s truncated, retrying over TCP', qname)
+                reply = self._exchange_tcp(message)
+        except OSError as os_err:
+            raise DNSWireError('Query for %s %s failed: %s' % (qname, qtype, os_err)) from os_err
+        logging.debug('Query for %s %s: %s, %d answers', qname, qtype,
+                      reply.rcode_name, len(reply.answer))
+        return reply
+
+    def axfr(self, zone_name):
+        """
+        Generator that performs a zone transfer over TCP, yielding each
+        DNSRecord (starting and ending with the zone SOA) as it arrives.
+        As with dig, a refused transfer simply yields nothing.
+        """
+        return self.transfer(zone_name)
+
+    def transfer(self, zone_name, serial=None):
+        """
+        Generator for a zone transfer: AXFR, or IXFR (RFC 1995) of the
+        changes since serial if given. The records are yielded exactly as
+        received; an IXFR reply is either a single SOA (no changes), the
+        whole zone (as AXFR) or the sequence of differences.
+        """
+        message = DNSMessage()
+        if serial is None:
+            message.question.append((zone_name, 'AXFR', 'IN'))
+        else:
+            message.question.append((zone_name, 'IXFR', 'IN'))
+            message.authority.append(DNSRecord(zone_name, 0, 'IN', 'SOA',
+                                               '. . %d 0 0 0 0' % serial))
+        # The transfer ends with the SOA of the new serial, which an
+        # incremental reply also uses to start its last set of additions
+        new_serial = None
+        incremental = False
+        soa_seen = 0
+        count = 0
+        try:
+            with self._connect() as sock:
+                self.send_tcp(sock, message.to_wire())
+                while True:
+                    reply = DNSMessage.from_wire(self.read_tcp(sock))
+                    if reply.rcode and count:
+                        raise DNSWireError('Transfer of %s failed part way: %s'
+                                           % (zone_name, reply.rcode_name))
+                    if reply.rcode:
+                        logging.debug('Transfer of %s failed: %s', zone_name, reply.rcode_name)
+                        return
+                    for record in reply.answer:
+                        count += 1
+                        yield record
+                        if record.rtype != 'SOA':
+                            continue
+                        record_serial = int(record.value.split()[2])
+                        if count == 1:
+                            new_serial = record_serial
+                            continue
+                        if count == 2:
+                            incremental = record_serial != new_serial
+                        if record_serial == new_serial:
+                            soa_seen += 1
+                        if soa_seen == (2 if incremental else 1):
+                            return
+                    if serial is not None and count == 1:
+                        return
+        except OSError as os_err:
+            raise DNSWireError('Transfer of %s failed: %s' % (zone_name, os_err)) from os_err
+
+    def find_zone(self, name):
+        """
+        Return the name of the zone that name belongs to, taken from
+        the SOA record in the answer (or authority) section of an SOA
+        query. This is how nsupdate finds the zone to update.
+        """
+        reply = self.query(name, 'SOA')
+        for record in reply.answer + reply.authority:
+            if record.rtype == 'SOA':
+                return record.name
+        raise DNSWireError('Unable to find zone for %s: %s' % (name, reply.rcode_name))
+
+# TSIG algorithm names (RFC 8945) and the hashlib digest they use
+TSIG_ALGORITHMS = {'hmac-md5': ('hmac-md5.sig-alg.reg.int.', 'md5'),
+                   'hmac-sha1': ('hmac-sha1.', 'sha1'),
+                   'hmac-sha224': ('hmac-sha224.', 'sha224'),
+                   'hmac-sha256': ('hmac-sha256.', 'sha256'),
+                   'hmac-sha384': ('hmac-sha384.', 'sha384'),
+                   'hmac-sha512': ('hmac-sha512.', 'sha512')}
+# Seconds of clock skew allowed between mmbop and the server
+TSIG_FUDGE = 300
+
+def read_key_file(key_file, key_name=None):
+    """
+    Read a BIND key file (as created by rndc-confgen or tsig-keygen),
+    returning tuple of form: (string:name, string:algorithm, bytes:secret)
+    The first key is used, unless key_name is given.
+    """
+    try:
+        with open(key_file) as k_file:
+            contents = k_file.read()
+    except (OSError, IOError) as io_os_err:
+        raise DNSWireError('Unable to read key file %s: %s' % (key_file, io_os_err)) from io_os_err
+    # Comments end the line, unless in quotes (a base64 secret can have //)
+    contents = re.sub(r'("[^"]*")|(?:#|//).*', lambda x: x.group(1) or '', contents)
+    for matcher in re.finditer(r'key\s+"?([^"\s{]+)"?\s*\{(.*?)\}\s*;', contents, re.DOTALL):
+        if key_name and matcher.group(1) != key_name:
+            continue
+        algorithm = re.search(r'algorithm\s+"?([\w-]+)"?\s*;', matcher.group(2))
+        secret = re.search(r'secret\s+"([^"]+)"\s*;', matcher.group(2))
+        if not (algorithm and secret):
+            break
+        try:
+            return (matcher.group(1), algorithm.group(1).lower(),
+                    base64.b64decode(secret.group(1)))
+        except ValueError:
+            break
+    raise DNSWireError('No usable key found in %s' % key_file)
+
+class TSIGKey:
+    """
+    Signs requests and verifies replies with TSIG (RFC 8945)
+    """
+
+    def __init__(self, name, algorithm, secret):
+        if algorithm not in TSIG_ALGORITHMS:
+            raise DNSWireError('Unsupported TSIG algorithm %s' % algorithm)
+        self.name = name.lower().rstrip('.') + '.'
+        (self.algorithm, self.digest) = TSIG_ALGORITHMS[algorithm]
+        self.secret = secret
+
+    @classmethod
+    def from_file(cls, key_file, key_name=None):
+        """
+        Return a TSIGKey using the key in a BIND key file
+        """
+        return cls(*read_key_file(key_file, key_name))
+
+    def _variables(self, time_signed, fudge, error, other):
+        """
+        The TSIG variables that are added to the digest
+        """
+        return (_encode_name(self.name) + struct.pack('!HI', RR_CLASSES['ANY'], 0) +
+                _encode_name(self.algorithm) +
+                struct.pack('!HIHHH', time_signed >> 32, time_signed & 0xFFFFFFFF, fudge,
+                            error, len(other)) + other)
+
+    @staticmethod
+    def _request_mac(request_mac):
+        """
+        A reply digest starts with the mac of the request it answers
+        """
+        if request_mac is None:
+            return b''
+        return struct.pack('!H', len(request_mac)) + request_mac
+
+    def sign(self, message, request_mac=None):
+        """
+        Return tuple of form: (bytes:signed_wire, bytes:mac) for the
+        DNSMessage. The mac is needed to verify the reply. When signing
+        a reply, request_mac is the mac of the request.
+        """
+        wire = message.to_wire()
+        time_signed = int(time())
+        mac = hmac.new(self.secret, self._request_mac(request_mac) + wire +
+                       self._variables(time_signed, TSIG_FUDGE, 0, b''),
+                       self.digest).digest()
+        rdata = (_encode_name(self.algorithm) +
+                 struct.pack('!HIHH', time_signed >> 32, time_signed & 0xFFFFFFFF,
+                             TSIG_FUDGE, len(mac)) +
+                 mac + struct.pack('!HHH', message.msg_id, 0, 0))
+        tsig_record = (_encode_name(self.name) +
+                       struct.pack('!HHIH', RR_TYPES['TSIG'], RR_CLASSES['ANY'], 0, len(rdata)) +
+                       rdata)
+        arcount = struct.unpack('!H', wire[10:12])[0] + 1
+        return (wire[:10] + struct.pack('!H', arcount) + wire[12:] + tsig_record, mac)
+
+    def verify(self, wire, reply, request_mac=None):
+        """
+        Check the TSIG record of a reply (both the wire format and
+        the parsed DNSMessage), raise DNSWireError if invalid.
+        Returns the mac of the message. request_mac is the mac of
+        the request the reply answers (None when checking a request).
+        """
+        if not reply.tsig:
+            raise DNSWireError('Reply is not signed (%s)' % reply.rcode_name)
+        (tsig_start, rdata) = reply.tsig
+        try:
+            (algorithm, pos) = _decode_name(rdata, 0)
+            (time_high, time_low, fudge, mac_size) = struct.unpack('!HIHH', rdata[pos:pos + 10])
+            pos += 10
+            mac = rdata[pos:pos + mac_size]
+            pos += mac_size
+            (original_id, error, other_len) = struct.unpack('!HHH', rdata[pos:pos + 6])
+            other = rdata[pos + 6:pos + 6 + other_len]
+        except (IndexError, struct.error) as parse_err:
+            raise DNSWireError('Malformed TSIG record: %s' % parse_err) from parse_err
+        if error:
+            raise DNSWireError('Server rejected signature: %s' % RCODES.get(error, error))
+        if algorithm.lower() != self.algorithm:
+            raise DNSWireError('Reply signed with unexpected algorithm %s' % algorithm)
+        arcount = struct.unpack('!H', wire[10:12])[0] - 1
+        unsigned = (struct.pack('!H', original_id) + wire[2:10] + struct.pack('!H', arcount) +
+                    wire[12:tsig_start])
+        time_signed = (time_high << 32) | time_low
+        expected = hmac.new(self.secret, self._request_mac(request_mac) + unsigned +
+                            self._variables(time_signed, fudge, error, other),
+                            self.digest).digest()
+        if not hmac.compare_digest(mac, expected):
+            raise DNSWireError('Signature does not match')
+        if abs(time() - time_signed) > fudge:
+            raise DNSWireError('Signature time is outside of allowed fudge')
+        return mac
+
+class DNSUpdater:
+    """
+    Sends TSIG signed dynamic updates (RFC 2136) to the primary name
+    server, reusing one TCP connection for as long as the server keeps
+    it open. Accepts the same scripts that are given to nsupdate.
+    """
+
+    def __init__(self, client, tsig_key):
+        self.client = client
+        self.tsig_key = tsig_key
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def close(self):
+        """
+        Close the connection to the server (if open)
+        """
+        if self.sock:
+            self.sock.close()
+            self.sock = None
+
+    def _exchange(self, message):
+        """
+        Send the signed message and return the verified reply. If the
+        existing connection has gone stale, reconnect and try once more.
+        """
+        (wire, mac) = self.tsig_key.sign(message)
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    if not self.sock:
+                        self.sock = self.client._connect()
+                    self.client.send_tcp(self.sock, wire)
+                    reply_wire = self.client.read_tcp(self.sock)
+                    break
+                except (OSError, DNSWireError) as conn_err:
+                    self.close()
+                    if attempt == 2:
+                        raise DNSWireError('Unable to send update: %s' % conn_err) from conn_err
+                    logging.debug('Update connection lost (%s), reconnecting', conn_err)
+        reply = DNSMessage.from_wire(reply_wire)
+        if reply.msg_id != message.msg_id:
+            self.close()
+            raise DNSWireError('Reply id %s does not match update' % reply.msg_id)
+        self.tsig_key.verify(reply_wire, reply, mac)
+        return reply
+
+    def send_update(self, zone_name, updates):
+        """
+        Send one UPDATE message with the list of DNSRecord updates for
+        the zone (found from the first record if zone_name is None).
+        Returns tuple of form: (boolean, None|string:error)
+        """
+        if not zone_name:
+            zone_name = self.client.find_zone(updates[0].name)
+        message = DNSMessage(opcode=OPCODE_UPDATE)
+        message.question.append((zone_name, 'SOA', 'IN'))
+        message.authority.extend(updates)
+        logging.debug('Sending update of %d records to zone %s', len(updates), zone_name)
+        reply = self._exchange(message)
+        if reply.rcode:
+            return (False, 'update failed: %s' % reply.rcode_name)
+        return (True, None)
+
+    @staticmethod
+    def parse_update(words):
+        """
+        Convert the words of an nsupdate 'update add|delete' line
+        into the DNSRecord that goes in the update section
+        """
+        action = words[0].lower()
+        name = words[1]
+        words = words[2:]
+        ttl = 0
+        if words and words[0].isdigit():
+            ttl = int(words.pop(0))
+        if words and words[0].upper() in RR_CLASSES:
+            words.pop(0)
+        if action == 'add':
+            if len(words) < 2:
+                raise DNSWireError('Missing type or data to add for %s' % name)
+            return DNSRecord(name, ttl, 'IN', words[0].upper(), ' '.join(words[1:]))
+        if action in ('delete', 'del'):
+            if not words:
+                return DNSRecord(name, 0, 'ANY', 'ANY', '')
+            if len(words) == 1:
+                return DNSRecord(name, 0, 'ANY', words[0].upper(), '')
+            return DNSRecord(name, 0, 'NONE', words[0].upper(), ' '.join(words[1:]))
+        raise DNSWireError('Unknown update action %s' % action)
+
+    def run_script(self, script):
+        """
+        Handle the subset of nsupdate input that mmbop creates
+        (zone, update add, update delete and send), sending each
+        group of updates as one message.
+        Returns tuple of form: (boolean, None|string:error)
+        """
+        zone_name = None
+        updates = []
+        for line in script.split('\n'):
+            words = line.split()
+            if not words or words[0].startswith(';'):
+                continue
+            command = words[0].lower()
+            if command == 'zone':
+                zone_name = words[1]
+            elif command == 'update':
+                updates.append(self.parse_update(words[1:]))
+            elif command == 'send':
+                if updates:
+                    (success, message) = self.send_update(zone_name, updates)
+                    if not success:
+                        return (success, message)
+                zone_name = None
+                updates = []
+            else:
+                raise DNSWireError('Unsupported nsupdate command %s' % command)
+        if updates:
+            return self.send_update(zone_name, updates)
+        return (True, None)
+
+class Metrics:
+    """
+    Counters, gauges and histograms (of seconds) kept in memory, and
+    rendered in the Prometheus text format. Each series is keyed by the
+    metric name and a tuple of label values, so recording a value is a
+    dictionary update under a lock. Caches registered with watch_cache
+    (any object with hits and misses counts) are read when rendered.
+    """
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.metrics = collections.OrderedDict()
+        self.caches = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def define(self, name, metric_type, help_text, labels=()):
+        """
+        Add a metric (counter, gauge or histogram), unless it exists
+        """
+        with self.lock:
+            self.metrics.setdefault(name, (metric_type, help_text, tuple(labels), {}))
+
+    def inc(self, name, labels=(), value=1):
+        """
+        Add value to the series of a counter or gauge
+        """
+        with self.lock:
+            series = self.metrics[name][3]
+            series[labels] = series.get(labels, 0) + value
+
+    def observe(self, name, labels, seconds):
+        """
+        Record a duration in the series of a histogram
+        """
+        bucket = bisect.bisect_left(self.BUCKETS, seconds)
+        with self.lock:
+            series = self.metrics[name][3]
+            if labels not in series:
+                series[labels] = [[0] * (len(self.BUCKETS) + 1), 0.0]
+            series[labels][0][bucket] += 1
+            series[labels][1] += seconds
+
+    def watch_cache(self, name, cache):
+        """
+        Export the hits and misses of cache (replacing any previous
+        cache of the same name)
+        """
+        with self.lock:
+            self.caches[name] = cache
+
+    @staticmethod
+    def _labels(names, values):
+        """
+        Return the label set of a series, such as {backend="dig"}
+        """
+        if not names:
+            return ''
+        escaped = (str(x).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                   for x in values)
+        return '{%s}' % ','.join('%s="%s"' % pair for pair in zip(names, escaped))
+
+    def _snapshot(self):
+        """
+        Return a copy of the metrics (including those of the caches),
+        as a list of tuples of form (name, type, help, labels, series)
+        """
+        with self.lock:
+            metrics = [(name, metric_type, help_text, labels,
+                        {key: ([list(x[0]), x[1]] if metric_type == 'histogram' else x)
+                         for (key, x) in series.items()})
+                       for (name, (metric_type, help_text, labels, series))
+                       in self.metrics.items()]
+            caches = list(self.caches.items())
+        lookups = {}
+        ratios = {}
+        for (cache_name, cache) in caches:
+            (hits, misses) = (cache.hits, cache.misses)
+            lookups[(cache_name, 'hit')] = hits
+            lookups[(cache_name, 'miss')] = misses
+            ratios[(cache_name,)] = hits / (hits + misses) if hits + misses else 0.0
+        metrics.append(('mmbop_cache_lookups_total', 'counter', 'Cache lookups by result',
+                        ('cache', 'result'), lookups))
+        metrics.append(('mmbop_cache_hit_ratio', 'gauge', 'Fraction of cache lookups that hit',
+                        ('cache',), ratios))
+        return metrics
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        for (name, metric_type, help_text, labels, series) in self._snapshot():
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for (values, value) in sorted(series.items()):
+                if metric_type != 'histogram':
+                    lines.append('%s%s %s' % (name, self._labels(labels, values), value))
+                    continue
+                cumulative = 0
+                for (bound, count) in zip(self.BUCKETS + ('+Inf',), value[0]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (name, self._labels(labels + ('le',),
+                                                                        values + (bound,)),
+                                                     cumulative))
+                lines.append('%s_sum%s %r' % (name, self._labels(labels, values), value[1]))
+                lines.append('%s_count%s %d' % (name, self._labels(labels, values), cumulative))
+        return '\n'.join(lines) + '\n'
+
+METRICS = Metrics()
+METRICS.define('mmbop_backend_call_seconds', 'histogram',
+               'Duration of calls to dig, nsupdate and rndc (or their native versions)',
+               ('backend', 'command'))
+METRICS.define('mmbop_backend_failures_total', 'counter',
+               'Calls to dig, nsupdate and rndc that failed', ('backend', 'command'))
+METRICS.define('mmbop_backend_in_flight', 'gauge',
+               'Calls to dig, nsupdate and rndc in progress', ('backend',))
+
+def _failed(result):
+    """
+    True if the result of a backend call is a failure, that is a
+    (False, message) tuple or a process with a non-zero exit status
+    """
+    if isinstance(result, tuple):
+        return not result[0]
+    return getattr(result, 'returncode', 0) != 0
+
+class Trace:
+    """
+    Tree of the timed steps (spans) of one request or command. A trace
+    is active in the threads running it (see run, activate and wrap),
+    and a Span adds to the active trace of its thread, doing nothing
+    if there is none. Each span is a dict with its name, start time,
+    duration (seconds) and child spans.
+    """
+    _active = threading.local()
+
+    def __init__(self, name='total'):
+        self.root = self._node(name)
+        self.stacks = {}
+
+    @staticmethod
+    def _node(name):
+        """
+        Return a new (running) span
+        """
+        return {'name': name, 'start': monotonic(), 'seconds': None, 'children': []}
+
+    @classmethod
+    def current(cls):
+        """
+        Return the active trace of the calling thread, None if there is none
+        """
+        return getattr(cls._active, 'trace', None)
+
+    def activate(self, parent=None):
+        """
+        Make this the active trace of the calling thread, adding
+        its spans under parent (the root span by default)
+        """
+        self._active.trace = self
+        self.stacks[threading.get_ident()] = [parent or self.root]
+
+    def deactivate(self):
+        """
+        Stop adding the spans of the calling thread to this trace
+        """
+        self._active.trace = None
+        self.stacks.pop(threading.get_ident(), None)
+
+    def run(self, function, *args, **kwargs):
+        """
+        Return function(*args, **kwargs), run with this trace active
+        """
+        self.activate()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.deactivate()
+
+    def wrap(self, function):
+        """
+        Return function, made to run (in a worker thread) with this
+        trace active, its spans under the current span of this thread
+        """
+        parent = self.stacks.get(threading.get_ident(), [self.root])[-1]
+        @functools.wraps(function)
+        def traced(*args, **kwargs):
+            self.activate(parent)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.deactivate()
+        return traced
+
+    def open(self, name):
+        """
+        Start a span, under the current span of the calling thread
+        """
+        stack = self.stacks[threading.get_ident()]
+        node = self._node(name)
+        stack[-1]['children'].append(node)
+        stack.append(node)
+        return node
+
+    def close(self, node):
+        """
+        End a span started with open
+        """
+        node['seconds'] = monotonic() - node['start']
+        stack = self.stacks.get(threading.get_ident())
+        if stack and stack[-1] is node:
+            stack.pop()
+
+    def finish(self):
+        """
+        End the trace (the root span), return self
+        """
+        if self.root['seconds'] is None:
+            self.root['seconds'] = monotonic() - self.root['start']
+        return self
+
+    def totals(self):
+        """
+        Return a dict of span name: [seconds, count] over all of the
+        spans (but the root), in the order they first started
+        """
+        totals = collections.OrderedDict()
+        nodes = list(self.root['children'])
+        while nodes:
+            node = nodes.pop(0)
+            total = totals.setdefault(node['name'], [0.0, 0])
+            total[0] += node['seconds'] or 0.0
+            total[1] += 1
+            nodes.extend(node['children'])
+        return totals
+
+    def server_timing(self):
+        """
+        Return the trace as the value of a Server-Timing header, the
+        total duration then that of each span name (in milliseconds)
+        """
+        entries = ['%s;dur=%.1f' % (self.root['name'], (self.root['seconds'] or 0) * 1000)]
+        for (name, (seconds, count)) in self.totals().items():
+            entries.append('%s;dur=%.1f;desc="%s x%d"' % (
+                re.sub(r"[^A-Za-z0-9!#$%&'*+.^_`|~-]", '-', name), seconds * 1000, name, count))
+        return ', '.join(entries)
+
+    def tree(self):
+        """
+        Return the trace as text, one line for each span, indented under
+        its parent. Sibling spans with the same name are shown as one,
+        with their count and total duration.
+        """
+        lines = []
+        self._tree_lines([self.root], 0, lines)
+        return '\n'.join(lines) + '\n'
+
+    def _tree_lines(self, nodes, depth, lines):
+        """
+        Add the lines of the tree for nodes (siblings) to lines
+        """
+        groups = collections.OrderedDict()
+        for node in nodes:
+            groups.setdefault(node['name'], []).append(node)
+        for (name, group) in groups.items():
+            seconds = sum(x['seconds'] or 0.0 for x in group)
+            count = ' (x%d)' % len(group) if len(group) > 1 else ''
+            lines.append('%9.1f ms  %s%s%s' % (seconds * 1000, '  ' * depth, name, count))
+            self._tree_lines([x for node in group for x in node['children']], depth + 1, lines)
+
+class Span:
+    """
+    Context manager timing a step of the active trace (see Trace)
+    """
+
+    def __init__(self, name):
+        self.trace = Trace.current()
+        self.name = name
+        self.node = None
+
+    def __enter__(self):
+        if self.trace:
+            self.node = self.trace.open(self.name)
+        return self
+
+    def __exit__(self, *_):
+        if self.node:
+            self.trace.close(self.node)
+
+def spanned(name):
+    """
+    Decorator timing each call of the function as a Span
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def traced(function):
+    """
+    Return function, wrapped to add its spans to the active trace of
+    the calling thread if there is one (for running in a worker thread)
+    """
+    trace = Trace.current()
+    if trace:
+        return trace.wrap(function)
+    return function
+
+def counted(function, progress, total):
+    """
+    Return function, wrapped to call progress(done, total) after each
+    call, where done is the number of calls finished so far (in any
+    thread)
+    """
+    done = itertools.count(1)
+    lock = threading.Lock()
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        result = function(*args, **kwargs)
+        with lock:
+            progress(next(done), total)
+        return result
+    return wrapper
+
+class BackendCall(Span):
+    """
+    Context manager for one call of a backend, recording its duration
+    and whether it failed in METRICS, labelled by backend and command,
+    and timing it as a Span. The call has failed if it raises an
+    exception (other than GeneratorExit, for a transfer that is not
+    read to the end), or if failed is set.
+    """
+
+    def __init__(self, backend, command):
+        super().__init__('%s %s' % (backend, command))
+        self.labels = (backend, command)
+        self.failed = False
+        self.started = None
+
+    def __enter__(self):
+        METRICS.inc('mmbop_backend_in_flight', self.labels[:1])
+        self.started = monotonic()
+        return super().__enter__()
+
+    def __exit__(self, exc_type, *_):
+        super().__exit__()
+        METRICS.observe('mmbop_backend_call_seconds', self.labels, monotonic() - self.started)
+        if self.failed or exc_type not in (None, GeneratorExit):
+            METRICS.inc('mmbop_backend_failures_total', self.labels)
+        METRICS.inc('mmbop_backend_in_flight', self.labels[:1], -1)
+
+def instrumented(backend, command_of):
+    """
+    Decorator for the methods that call the backends, recording each
+    call as a BackendCall, labelled by backend and command_of(arguments
+    of the call)
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with BackendCall(backend, command_of(*args, **kwargs)) as call:
+                result = method(self, *args, **kwargs)
+                call.failed = _failed(result)
+                return result
+        return wrapper
+    return decorator
+
+def _rndc_command(rndc_command):
+    """
+    Return the name of an rndc command (without its arguments)
+    """
+    if not isinstance(rndc_command, str):
+        rndc_command = ' '.join(rndc_command)
+    return rndc_command.split(' ', 1)[0]
+
+class ZoneCache:
+    """
+    Least recently used cache of zone transfers (the lines of dig output),
+    each tagged with the SOA serial of the zone when it was transferred.
+    The total size of the cached records is kept under max_bytes.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = int(max_bytes)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries = collections.OrderedDict()
+        self.entries_size = {}
+        self.lock = threading.Lock()
+        METRICS.watch_cache('zone', self)
+
+    @staticmethod
+    def _key(name):
+        """
+        Cache keys are lower case names, without the trailing dot
+        """
+        return name.lower().rstrip('.')
+
+    def __contains__(self, zone_name):
+        return self._key(zone_name) in self.entries
+
+    def get(self, zone_name, serial):
+        """
+        Return the cached records of the zone, or None if the zone is
+        not cached or was cached at a different serial
+        """
+        key = self._key(zone_name)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[0] == serial:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            if entry:
+                self._drop(key)
+        return None
+
+    def put(self, zone_name, serial, records, size):
+        """
+        Cache the records (taking size bytes) of the zone, evicting
+        the least recently used zones to make room
+        """
+        if size > self.max_bytes:
+            return
+        key = self._key(zone_name)
+        with self.lock:
+            if key in self.entries:
+                self._drop(key)
+            while self.entries and self.size + size > self.max_bytes:
+                (evicted, _) = self.entries.popitem(last=False)
+                self.size -= self.entries_size.pop(evicted)
+                logging.debug('Evicted zone %s from cache', evicted)
+            self.entries[key] = (serial, records)
+            self.entries_size[key] = size
+            self.size += size
+
+    def _drop(self, key):
+        """
+        Remove a zone from the cache (lock must be held)
+        """
+        del self.entries[key]
+        self.size -= self.entries_size.pop(key)
+
+    def invalidate(self, name):
+        """
+        Remove the cached zone(s) that name belongs to
+        """
+        name = self._key(name)
+        with self.lock:
+            for key in list(self.entries):
+                if name == key or name.endswith('.' + key):
+                    logging.debug('Dropping zone %s from cache', key)
+                    self._drop(key)
+
+class ZoneMirror:
+    """
+    Keeps a local replica of selected zones, loaded once with a zone
+    transfer and then kept current with incremental (IXFR) transfers
+    of the changes since the serial held. Lookups and searches of
+    these zones are answered from memory.
+
+    Replicas are refreshed (one SOA query, plus an IXFR if the serial
+    changed) when they are read, or every refresh_interval seconds
+    by a background thread.
+    """
+
+    def __init__(self, dig_instance, zone_names, refresh_interval=0):
+        self.dig = dig_instance
+        self.zones = {}
+        self.lock = threading.Lock()
+        for zone_name in zone_names:
+            self.zones[self._key(zone_name)] = {'serial': None, 'soa': None, 'names': {},
+                                                'stale': True, 'lock': threading.Lock()}
+        self.refresh_interval = float(refresh_interval)
+        if self.refresh_interval > 0:
+            refresher = threading.Thread(target=self._refresh_loop, daemon=True,
+                                         name='mmbop-zone-mirror')
+            refresher.start()
+
+    @staticmethod
+    def _key(name):
+        """
+        Names are held lower case, without the trailing dot
+        """
+        return name.lower().rstrip('.')
+
+    def zone_of(self, name):
+        """
+        Return the mirrored zone that name falls in (the longest match), or None
+        """
+        labels = self._key(name).split('.')
+        for start in range(len(labels)):
+            zone_name = '.'.join(labels[start:])
+            if zone_name in self.zones:
+                return zone_name
+        return None
+
+    def mark_stale(self, name):
+        """
+        Force the next read of the zone that name is in to check for changes
+        """
+        zone_name = self.zone_of(name)
+        if zone_name:
+            self.zones[zone_name]['stale'] = True
+
+    def _refresh_loop(self):
+        """
+        Background thread, refreshing every mirrored zone in turn
+        """
+        while True:
+            for zone_name in list(self.zones):
+                try:
+                    self._update(zone_name)
+                except Exception as refresh_err:  # pylint: disable=broad-except
+                    logging.debug('Refresh of mirrored zone %s failed: %s',
+                                  zone_name, refresh_err)
+            sleep(self.refresh_interval)
+
+    def refresh(self, zone_name):
+        """
+        Bring the replica of the zone up to date (unless a background
+        thread does that). Returns True if the zone is mirrored and
+        the replica is usable.
+        """
+        zone_name = self._key(zone_name)
+        zone = self.zones.get(zone_name)
+        if not zone:
+            return False
+        if zone['serial'] is None or zone['stale'] or self.refresh_interval <= 0:
+            try:
+                self._update(zone_name)
+            except DNSWireError as wire_err:
+                logging.debug('Refresh of mirrored zone %s failed: %s', zone_name, wire_err)
+        return zone['serial'] is not None
+
+    @staticmethod
+    def _fields(line):
+        """
+        Split a line of dig output into (name, ttl, class, type, value)
+        """
+        fields = line.split(None, 4)
+        if len(fields) < 5:
+            fields.append('')
+        return fields
+
+    def _update(self, zone_name):
+        """
+        Check the zone serial and, if it changed, transfer the changes
+        (or the whole zone, when there is no replica yet)
+        """
+        zone = self.zones[zone_name]
+        with zone['lock']:
+            zone['stale'] = False
+            if zone['serial'] is not None:
+                serial = self.dig.zone_serial(zone_name)
+                if serial is None:
+                    raise DNSWireError('Unable to get serial of %s' % zone_name)
+                if serial == zone['serial']:
+                    return
+                command = ['ixfr=%d' % zone['serial'], zone_name]
+            else:
+                command = ['axfr', zone_name]
+            try:
+                complete = self._apply(zone, self.dig._stream_call(command))
+            except (DNSWireError, DigQueryError, IndexError, ValueError) as xfr_err:
+                logging.debug('Transfer for mirrored zone %s failed: %s', zone_name, xfr_err)
+                complete = False
+            if not complete:
+                # Partly applied changes cannot be trusted, start over
+                logging.debug('Discarding replica of %s', zone_name)
+                zone['serial'] = None
+                zone['stale'] = True
+                with self.lock:
+                    zone['names'] = {}
+
+    def _apply(self, zone, lines):
+        """
+        Apply a zone transfer (AXFR, or any of the forms of IXFR reply)
+        to the replica. Returns True if the transfer was complete.
+        """
+        lines = iter(lines)
+        first = next(lines, None)
+        if first is None or self._fields(first)[3] != 'SOA':
+            return False
+        new_serial = int(self._fields(first)[4].split()[2])
+        second = next(lines, None)
+        if second is None:
+            # Only the SOA: the replica is already up to date
+            return zone['serial'] == new_serial
+        second_fields = self._fields(second)
+        if second_fields[3] != 'SOA' or int(second_fields[4].split()[2]) == new_serial:
+            # Whole zone (from AXFR, or an IXFR the server could not do incrementally)
+            names = {}
+            complete = second_fields[3] == 'SOA'
+            if not complete:
+                names.setdefault(self._key(second_fields[0]), []).append(second)
+                for line in lines:
+                    fields = self._fields(line)
+                    if fields[3] == 'SOA':
+                        complete = True
+                        break
+                    names.setdefault(self._key(fields[0]), []).append(line)
+            if not complete:
+                return False
+            logging.debug('Loaded replica of %s at serial %d', first.split()[0], new_serial)
+        else:
+            # Sequences of differences (old SOA, deletions, new SOA, additions),
+            # then the new SOA again. They are applied to a copy, which
+            # replaces the replica only once the last of them has arrived.
+            with self.lock:
+                names = dict(zone['names'])
+            deleting = True
+            last_serial = None
+            for line in lines:
+                fields = self._fields(line)
+                if fields[3] == 'SOA':
+                    deleting = not deleting
+                    last_serial = int(fields[4].split()[2])
+                    continue
+                last_serial = None
+                key = self._key(fields[0])
+                existing = names.get(key, [])
+                if deleting:
+                    kept = [x for x in existing if self._fields(x)[3:] != fields[3:]]
+                    if kept:
+                        names[key] = kept
+                    else:
+                        names.pop(key, None)
+                else:
+                    names[key] = existing + [line]
+            # A transfer cut short can also end while deleting, but not on the new SOA
+            if not deleting or last_serial != new_serial:
+                return False
+            logging.debug('Applied changes to replica of %s, now at serial %d',
+                          first.split()[0], new_serial)
+        with self.lock:
+            zone['names'] = names
+            zone['soa'] = first
+            zone['serial'] = new_serial
+        return True
+
+    def transfer(self, zone_name):
+        """
+        Generator of the replica, in the same form as a zone transfer
+        """
+        zone = self.zones[self._key(zone_name)]
+        with self.lock:
+            soa = zone['soa']
+            records = [line for lines in zone['names'].values() for line in lines]
+        if not soa:
+            return
+        yield soa
+        yield from records
+        yield soa
+
+    def lookup(self, name, query_type, depth=0):
+        """
+        Answer a query from the replica, following CNAMEs as the server
+        would. Returns None if the answer has to come from the server
+        (the name is not mirrored, is delegated or the replica is unusable).
+        """
+        zone_name = self.zone_of(name)
+        if not zone_name or depth > 8 or not self.refresh(zone_name):
+            return None
+        zone = self.zones[zone_name]
+        key = self._key(name)
+        labels = key.split('.')
+        with self.lock:
+            # A delegation (NS records below the apex) means a child zone answers
+            for start in range(len(labels) - len(zone_name.split('.'))):
+                for line in zone['names'].get('.'.join(labels[start:]), []):
+                    if self._fields(line)[3] == 'NS':
+                        return None
+            lines = list(zone['names'].get(key, []))
+        answer = [x for x in lines if self._fields(x)[3] == query_type]
+        if answer:
+            return answer
+        for line in lines:
+            if self._fields(line)[3] == 'CNAME':
+                target = self.lookup(self._fields(line)[4], query_type, depth + 1)
+                if target is None:
+                    return None
+                return [line] + target
+        return []
+
+class DigQueryError(Exception):
+    """
+    Error class for DigQuery
+    """
+
+class DigQuery:
+    """
+    Instantiates a DNS querier using system dig, or the native
+    DNSClient (in which case dig, if present, is the fallback)
+    """
+
+    VALID_RECORD_TYPES = [' A ', ' CNAME ', ' PTR ', '\tA\t', '\tCNAME\t', '\tPTR\t']
+    # Most names whose zone find_zone remembers (least recently used go first)
+    MAX_ZONE_NAMES = 10000
+
+    @classmethod
+    def create(cls, **kwargs):
+        """
+        Return a DigQuery instance set up from the mmbop configuration.
+        Arguments that are used (and their default value if not specified):
+
+            querymode: Either native or dig (dig)
+            digpath:   The full path to dig executable (/usr/bin/dig)
+            dnsserver: The IP of the DNS server to query (127.0.0.1)
+            dnsport:   The port the DNS server listens on (53)
+            timeout:   Seconds to wait for a reply (5)
+            zonecache: Megabytes of zone transfers to cache, 0 to disable (0)
+            mirror:    List of zones to keep a local replica of ([])
+            mirrorrefresh: Seconds between background refreshes of the
+                       replicas, 0 to refresh when they are read (0)
+            jobs:      Most lookups find_records runs at once (8)
+            reversezones: List of reverse zones to search for address
+                       ranges, instead of finding them with SOA queries ([])
+        """
+        dig_instance = cls(path_to_dig=kwargs.get('digpath', '/usr/bin/dig'),
+                           mode=kwargs.get('querymode', 'dig'),
+                           server=kwargs.get('dnsserver', '127.0.0.1'),
+                           port=kwargs.get('dnsport', 53),
+                           timeout=kwargs.get('timeout', 5),
+                           cache_mb=kwargs.get('zonecache', 0),
+                           jobs=kwargs.get('jobs', 8))
+        mirror_zones = kwargs.get('mirror', [])
+        if isinstance(mirror_zones, str):
+            mirror_zones = [mirror_zones]
+        if mirror_zones:
+            dig_instance.mirror = ZoneMirror(dig_instance, mirror_zones,
+                                             kwargs.get('mirrorrefresh', 0))
+        dig_instance.addresses = AddressIndex(dig_instance, kwargs.get('reversezones'))
+        return dig_instance
+
+    def __init__(self, path_to_dig='/usr/bin/dig', mode='dig', server='127.0.0.1',
+                 port=53, timeout=5, cache_mb=0, jobs=8):
+        self.native = None
+        self.jobs = max(int(jobs), 1)
+        self.command = None
+        self.cache = None
+        self.mirror = None
+        # Zone of each name looked up by find_zone, shared by all threads
+        self.zones = collections.OrderedDict()
+        self.zones_lock = threading.Lock()
+        self.addresses = AddressIndex(self)
+        if float(cache_mb) > 0:
+            self.cache = ZoneCache(float(cache_mb) * 1024 * 1024)
+        self.options = ['+noall', '+answer']
+        if mode == 'native':
+            try:
+                self.native = DNSClient(server, port, timeout)
+            except DNSWireError as wire_err:
+                raise DigQueryError(str(wire_err)) from wire_err
+        elif mode != 'dig':
+            raise DigQueryError('Invalid query mode %s' % mode)
+        if os.path.exists(path_to_dig) and os.path.isfile(path_to_dig):
+            self.command = [path_to_dig, '@' + server, '-p', str(port)]
+        elif not self.native:
+            raise DigQueryError('Invalid path to dig')
+
+    def _native_call(self, command_to_dig, query_type=None):
+        """
+        Answer a dig style request using DNSClient, returning the
+        records as the text that 'dig +noall +answer' would print
+        """
+        if command_to_dig[0] == 'axfr':
+            records = self.native.axfr(command_to_dig[1])
+        else:
+            records = self.native.query(command_to_dig[0], query_type or 'A').answer
+        return '\n'.join(format_record(x) for x in records)
+
+    @instrumented('dig', lambda command_to_dig, query_type=None: query_type or 'A')
+    def _call(self, command_to_dig, query_type=None):
+        """
+        Makes subprocess call to dig (or the native equivalent),
+        returns tuple of form:
+        (boolean:success_failure, string:stdout_stderr)
+        """
+        if isinstance(command_to_dig, str):
+            command_to_dig = [command_to_dig]
+        if self.native:
+            try:
+                return (True, self._native_call(command_to_dig, query_type))
+            except DNSWireError as wire_err:
+                logging.debug('Native query failed: %s', wire_err)
+                if not self.command:
+                    return (False, str(wire_err))
+                logging.debug('Falling back to dig')
+        if query_type:
+            dig_command = self.command + command_to_dig +[query_type] + self.options
+        else:
+            dig_command = self.command + command_to_dig + self.options
+        reply = subprocess.run(dig_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                               check=True, universal_newlines=True)
+        if reply.returncode == 0:
+            return (True, reply.stdout)
+        return (False, reply.stderr)
+
+    @staticmethod
+    def _parse_call(dig_response):
+        """
+        If the response is blank lines, return None
+        otherwise, return the non-empty line(s)
+        """
+        (success, message) = dig_response
+        logging.debug(message)
+        return_lines = []
+        if not success:
+            return None
+        answer_lines = message.split('\n')
+        logging.debug(str(len(answer_lines)))
+        for line in answer_lines:
+            if line.startswith(';'):
+                continue
+            if not line.strip():
+                continue
+            return_lines.append(line)
+        return return_lines
+
+    @staticmethod
+    def _query_for(fqdn_or_ip):
+        """
+        Return the (name, type) to query for fqdn_or_ip: the PTR record
+        of an IP, or (with type None, meaning A) the name itself
+        """
+        try:
+            return (ipaddress.ip_address(fqdn_or_ip).reverse_pointer, 'PTR')
+        except ValueError:
+            return (fqdn_or_ip, None)
+
+    def find_record(self, fqdn_or_ip, strict=False):
+        """
+        Return result (or None if not found)
+        """
+        (query_name, query_type) = self._query_for(fqdn_or_ip)
+        answer = None
+        if self.mirror:
+            answer = self.mirror.lookup(query_name, query_type or 'A')
+        if answer is None:
+            answer = self._parse_call(self._call(query_name, query_type))
+        if strict:
+            strict_answer = []
+            for line in answer:
+                strict_answer.append(line.split()[-1])
+            return strict_answer
+        return answer
+
+    def find_records(self, fqdns_or_ips, strict=False):
+        """
+        find_record for each of the names/IPs, with up to self.jobs
+        lookups running at once. Returns the results in the same order.
+        """
+        if self.jobs == 1 or len(fqdns_or_ips) < 2:
+            return [self.find_record(x, strict) for x in fqdns_or_ips]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            return list(executor.map(traced(lambda x: self.find_record(x, strict)),
+                                     fqdns_or_ips))
+
+    def _stream_call(self, command_to_dig):
+        """
+        Generator version of _call for (potentially large) zone transfers,
+        yielding the non-comment lines of dig output one at a time instead
+        of reading the whole reply into memory. Raises DigQueryError if
+        the transfer fails after records have been yielded, so a zone
+        cut short is not taken for the whole of it. The transfer is
+        recorded as a BackendCall (dig axfr or dig ixfr), until the last
+        line has been read.
+        """
+        with BackendCall('dig', command_to_dig[0].split('=')[0]):
+            yield from self._stream_lines(command_to_dig)
+
+    def _stream_lines(self, command_to_dig):
+        """
+        The lines of _stream_call
+        """
+        if self.native:
+            transferred = False
+            serial = None
+            if command_to_dig[0].startswith('ixfr='):
+                serial = int(command_to_dig[0][5:])
+            try:
+                for record in self.native.transfer(command_to_dig[1], serial):
+                    transferred = True
+                    yield format_record(record)
+                return
+            except DNSWireError as wire_err:
+                logging.debug('Native transfer failed: %s', wire_err)
+                if transferred:
+                    raise DigQueryError(str(wire_err)) from wire_err
+                if not self.command:
+                    return
+                logging.debug('Falling back to dig')
+        dig_process = subprocess.Popen(self.command + command_to_dig + self.options,
+                                       stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                       universal_newlines=True)
+        transferred = False
+        try:
+            for line in dig_process.stdout:
+                if line.startswith('; Transfer failed') and transferred:
+                    raise DigQueryError('Transfer of %s failed part way' % command_to_dig[-1])
+                if line.startswith(';') or not line.strip():
+                    continue
+                transferred = True
+                yield line.rstrip('\n')
+        finally:
+            dig_process.stdout.close()
+            if dig_process.poll() is None:
+                dig_process.kill()
+            dig_process.wait()
+
+    @staticmethod
+    def _soa_serial(soa_record):
+        """
+        Return the serial number from an SOA record (line of dig output)
+        """
+        try:
+            return int(soa_record.split()[6])
+        except (IndexError, ValueError):
+            return None
+
+    def zone_serial(self, zone_name):
+        """
+        Return the current SOA serial of the zone (None if not found)
+        """
+        for record in self._parse_call(self._call(zone_name, 'SOA')) or []:
+            if record.split()[3] == 'SOA':
+                return self._soa_serial(record)
+        return None
+
+    def find_zone(self, name):
+        """
+        Return the name of the zone that name belongs to (None if it
+        cannot be found), from the SOA record in the answer or authority
+        section of an SOA query. Answers are remembered, since bulk
+        changes ask about the same few domains over and over (up to
+        MAX_ZONE_NAMES of them).
+        """
+        name = name.rstrip('.').lower()
+        with self.zones_lock:
+            if name in self.zones:
+                self.zones.move_to_end(name)
+                return self.zones[name]
+        zone_name = None
+        if self.native:
+            try:
+                zone_name = self.native.find_zone(name)
+            except DNSWireError as wire_err:
+                logging.debug('Native zone lookup failed: %s', wire_err)
+        if zone_name is None and self.command:
+            reply = subprocess.run(self.command + [name, 'SOA', '+noall', '+answer',
+                                                   '+authority'],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                   check=False, universal_newlines=True)
+            for record in self._parse_call((reply.returncode == 0, reply.stdout)) or []:
+                fields = record.split()
+                if len(fields) > 3 and fields[3] == 'SOA':
+                    zone_name = fields[0]
+                    break
+        if zone_name is None:
+            return None
+        zone_name = zone_name.rstrip('.').lower()
+        logging.debug('Zone for %s is %s', name, zone_name)
+        with self.zones_lock:
+            self.zones[name] = zone_name
+            self.zones.move_to_end(name)
+            while len(self.zones) > self.MAX_ZONE_NAMES:
+                self.zones.popitem(last=False)
+        return zone_name
+
+    def invalidate(self, name):
+        """
+        Called when mmbop changes name, so that the zone it is in
+        will be transferred again rather than read from the cache.
+        If name is a zone being added or removed, names at and below
+        it may now be in a different zone, so find_zone is asked again.
+        """
+        name = name.rstrip('.').lower()
+        with self.zones_lock:
+            for known_name in list(self.zones):
+                if known_name == name or known_name.endswith('.' + name):
+                    self.zones.pop(known_name, None)
+        if self.cache:
+            self.cache.invalidate(name)
+        if self.mirror:
+            self.mirror.mark_stale(name)
+
+    def _transfer(self, zone_name):
+        """
+        Generator of the zone transfer lines. If caching is enabled, a
+        cached copy is used when the zone serial has not changed since,
+        and a complete transfer is added to the cache.
+        """
+        if self.mirror and self.mirror.refresh(zone_name):
+            yield from self.mirror.transfer(zone_name)
+            return
+        if not self.cache:
+            yield from self._stream_call(['axfr', zone_name])
+            return
+        if zone_name in self.cache:
+            cached = self.cache.get(zone_name, self.zone_serial(zone_name))
+            if cached is not None:
+                logging.debug('Using cached transfer of %s', zone_name)
+                yield from cached
+                return
+        records = []
+        size = 0
+        for record in self._stream_call(['axfr', zone_name]):
+            if records is not None:
+                records.append(record)
+                size += sys.getsizeof(record)
+                if size > self.cache.max_bytes:
+                    logging.debug('Zone %s too large to cache', zone_name)
+                    records = None
+            yield record
+        # A complete transfer starts and ends with the SOA record
+        if records and len(records) > 1 and records[-1].split()[3] == 'SOA':
+            self.cache.put(zone_name, self._soa_serial(records[0]), records, size)
+
+    @classmethod
+    def _valid_type(cls, record):
+        """
+        True if the record (line of dig output) is an A, CNAME or PTR record
+        """
+        for record_type in cls.VALID_RECORD_TYPES:
+            if record_type in record:
+                return True
+        return False
+
+    def iter_domain(self, zone_name, search_string=None, negate=False):
+        """
+        Generator version of search_domain. Records are filtered as the
+        zone transfer arrives, so memory use does not grow with the zone.
+        """
+        for record in self._transfer(zone_name):
+            record = self._match(record, search_string, negate)
+            if record is not None:
+                yield record
+
+    @classmethod
+    def _match(cls, record, search_string=None, negate=False):
+        """
+        Return the record (line of dig output) as iter_domain yields it
+        if it matches search_string (or does not, if negate is True),
+        otherwise None. With no search_string every record matches.
+        """
+        if not search_string:
+            return record
+        if not cls._valid_type(record):
+            return None
+        record = record.replace('\t', ' ')
+        if (search_string in record) != negate:
+            return record
+        return None
+
+    def hostlist(self, zone_name):
+        """
+        Generator of the A, CNAME and PTR records of the zone
+        """
+        for record in self._transfer(zone_name):
+            if self._valid_type(record):
+                yield record
+
+    def search_domain(self, zone_name, search_string=None, negate=False):
+        """
+        Perform a dig transfer and grep through results, returning
+        those that match search_string.
+        If negate is True, return entries that do not match the string.
+        """
+        return list(self.iter_domain(zone_name, search_string, negate))
+
+    def iter_range(self, address_range):
+        """
+        Return an iterator of the PTR records for the addresses in
+        address_range (see parse_address_range), in address order,
+        from the address index of the reverse zones.
+        Raises ValueError if address_range is not valid.
+        """
+        (first, last) = parse_address_range(address_range)
+        return self.addresses.lookup(first, last)
+
+class AliasIndex:
+    """
+    Index of the CNAME records in a zone by the name they point to.
+    Each zone is indexed with a single pass over a zone transfer, and
+    the index is kept current with the changes mmbop itself makes
+    (as long as nothing else changed the zone at the same time), so
+    finding the aliases of a name is a dictionary lookup (after one
+    SOA query to make sure nothing else changed the zone since the
+    serial it was indexed, or last changed by mmbop, at).
+    """
+
+    def __init__(self, dig_instance):
+        self.dig = dig_instance
+        self.zones = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        METRICS.watch_cache('alias', self)
+
+    @staticmethod
+    def _key(name):
+        """
+        Names are indexed lower case, without the trailing dot
+        """
+        return name.lower().rstrip('.')
+
+    @classmethod
+    def _add(cls, index, alias_name, target):
+        """
+        Add an alias to the index of a zone (replacing any previous target)
+        """
+        cls._remove(index, alias_name)
+        alias_name = alias_name.rstrip('.') + '.'
+        index['aliases'][cls._key(alias_name)] = cls._key(target)
+        index['targets'].setdefault(cls._key(target), set()).add(alias_name)
+
+    @classmethod
+    def _remove(cls, index, alias_name):
+        """
+        Remove an alias from the index of a zone
+        """
+        target = index['aliases'].pop(cls._key(alias_name), None)
+        if target is not None:
+            index['targets'][target] = {x for x in index['targets'][target]
+                                        if cls._key(x) != cls._key(alias_name)}
+            if not index['targets'][target]:
+                del index['targets'][target]
+
+    @spanned('index aliases')
+    def _build(self, zone_name):
+        """
+        Index the CNAME records of the zone. The serial is left None (so
+        the index is not kept) unless the transfer ended with the SOA.
+        """
+        index = {'serial': None, 'aliases': {}, 'targets': {}}
+        serial = None
+        complete = False
+        for record in self.dig._transfer(zone_name):
+            fields = record.split()
+            if len(fields) < 5:
+                continue
+            # A complete transfer starts and ends with the SOA record
+            complete = fields[3] == 'SOA' and serial is not None
+            if fields[3] == 'SOA' and serial is None:
+                serial = int(fields[6])
+            elif fields[3] == 'CNAME':
+                self._add(index, fields[0], fields[4])
+        if complete:
+            index['serial'] = serial
+        logging.debug('Indexed %d aliases in zone %s', len(index['aliases']), zone_name)
+        return index
+
+    def aliases_of(self, fqdn):
+        """
+        Return the alias (CNAME) names, in the zone of fqdn, that refer to fqdn
+        """
+        zone_name = self._key(fqdn.split('.', 1)[1])
+        serial = self.dig.zone_serial(zone_name)
+        with self.lock:
+            index = self.zones.get(zone_name)
+            if index and serial is not None and index['serial'] == serial:
+                self.hits += 1
+                return sorted(index['targets'].get(self._key(fqdn), ()))
+            self.misses += 1
+        index = self._build(zone_name)
+        if index['serial'] is not None:
+            with self.lock:
+                self.zones[zone_name] = index
+        return sorted(index['targets'].get(self._key(fqdn), ()))
+
+    def record_changes(self, commands):
+        """
+        Update the indexes with the changes in the nsupdate commands
+        (which have been sent successfully). Each update message that
+        changes a zone moves its serial on by one, so if the serial of
+        the zone is now that many steps past the serial of the index,
+        nothing else changed the zone and the index is kept at the new
+        serial. Otherwise the index is dropped, and built again when it
+        is next used (the other change may have added or removed aliases).
+        """
+        steps = collections.Counter()
+        # Zones changed by the update message not yet sent
+        pending = set()
+        for line in commands.split('\n'):
+            words = line.split()
+            if not words or words[0] == 'send':
+                steps.update(pending)
+                pending = set()
+                continue
+            if len(words) < 3 or words[0] != 'update':
+                continue
+            try:
+                record = DNSUpdater.parse_update(words[1:])
+            except DNSWireError:
+                continue
+            name = self._key(record.name)
+            with self.lock:
+                for (zone_name, index) in self.zones.items():
+                    if not (name == zone_name or name.endswith('.' + zone_name)):
+                        continue
+                    pending.add(zone_name)
+                    if record.rclass == 'IN' and record.rtype == 'CNAME':
+                        self._add(index, record.name, record.value)
+                    elif record.rclass != 'IN' and record.rtype in ('ANY', 'CNAME'):
+                        self._remove(index, record.name)
+        steps.update(pending)
+        for (zone_name, count) in steps.items():
+            serial = self.dig.zone_serial(zone_name)
+            with self.lock:
+                index = self.zones.get(zone_name)
+                if index is None:
+                    continue
+                if (serial is not None and index['serial'] is not None
+                        and serial == (index['serial'] + count) % (1 << 32)):
+                    index['serial'] = serial
+                else:
+                    logging.debug('Zone %s changed at serial %s (index at %s), dropping its '
+                                  'alias index', zone_name, serial, index['serial'])
+                    del self.zones[zone_name]
+
+class AddressIndex:
+    """
+    Index of the PTR records of reverse zones, as sorted lists of the
+    addresses (integers) they are for, so the records in an address
+    range are found with a binary search rather than by matching the
+    text of every record. Each zone is indexed with a single pass over
+    a zone transfer, and indexed again once its serial changes.
+    The zones of a range are those of reverse_zones that overlap it,
+    or if there are none, found with SOA queries.
+    """
+    # Most SOA queries made to find the zones of a range
+    MAX_ZONE_LOOKUPS = 256
+
+    def __init__(self, dig_instance, reverse_zones=None):
+        self.dig = dig_instance
+        if isinstance(reverse_zones, str):
+            reverse_zones = [reverse_zones]
+        self.reverse_zones = [x.rstrip('.').lower() for x in reverse_zones or []]
+        self.zones = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        METRICS.watch_cache('address', self)
+
+    @staticmethod
+    def zone_network(zone_name):
+        """
+        Return the network (ipaddress) of the addresses a reverse zone
+        (or PTR record name) is for, None if it is not one. Only whole
+        label (octet or nibble) zones are recognized.
+        """
+        labels = zone_name.rstrip('.').lower().split('.')
+        try:
+            if labels[-2:] == ['in-addr', 'arpa'] and 2 < len(labels) <= 6:
+                octets = list(reversed(labels[:-2]))
+                padded = octets + ['0'] * (4 - len(octets))
+                return ipaddress.IPv4Network('%s/%d' % ('.'.join(padded), 8 * len(octets)))
+            if labels[-2:] == ['ip6', 'arpa'] and 2 < len(labels) <= 34:
+                nibbles = list(reversed(labels[:-2]))
+                if any(len(x) != 1 for x in nibbles):
+                    return None
+                return ipaddress.IPv6Network((int(''.join(nibbles).ljust(32, '0'), 16),
+                                              4 * len(nibbles)))
+        except ValueError:
+            pass
+        return None
+
+    @spanned('index addresses')
+    def _build(self, zone_name):
+        """
+        Index the PTR records of the zone. The serial is left None (so
+        the index is not kept) unless the transfer ended with the SOA.
+        """
+        index = {'serial': None, 'addresses': [], 'records': []}
+        entries = []
+        serial = None
+        complete = False
+        for record in self.dig._transfer(zone_name):
+            fields = record.split()
+            if len(fields) < 5:
+                continue
+            # A complete transfer starts and ends with the SOA record
+            complete = fields[3] == 'SOA' and serial is not None
+            if fields[3] == 'SOA' and serial is None:
+                serial = int(fields[6])
+            elif fields[3] == 'PTR':
+                network = self.zone_network(fields[0])
+                if network is not None and network.num_addresses == 1:
+                    entries.append((int(network.network_address), record))
+        entries.sort()
+        if complete:
+            index['serial'] = serial
+        index['addresses'] = [x[0] for x in entries]
+        index['records'] = [x[1] for x in entries]
+        logging.debug('Indexed %d addresses in zone %s', len(entries), zone_name)
+        return index
+
+    def _index(self, zone_name):
+        """
+        Return the index of the zone, building it if there is none or
+        the zone has changed since
+        """
+        serial = self.dig.zone_serial(zone_name)
+        with self.lock:
+            index = self.zones.get(zone_name)
+            if index and serial is not None and index['serial'] == serial:
+                self.hits += 1
+                return index
+            self.misses += 1
+        index = self._build(zone_name)
+        if index['serial'] is not None:
+            with self.lock:
+                self.zones[zone_name] = index
+        return index
+
+    def _zones_for(self, first, last):
+        """
+        Return the names of the reverse zones with addresses from first
+        to last. Raises ValueError if finding them would take more than
+        MAX_ZONE_LOOKUPS queries.
+        """
+        zones = []
+        for zone_name in self.reverse_zones:
+            network = self.zone_network(zone_name)
+            if (network and network.version == first.version
+                    and network.network_address <= last and network.broadcast_address >= first):
+                zones.append(zone_name)
+        if zones:
+            return zones
+        # Zones are found a /24 (IPv4) or /64 (IPv6) at a time, skipping
+        # over the rest of each zone found
+        step = 2 ** (first.max_prefixlen - (24 if first.version == 4 else 64))
+        address = int(first)
+        for _ in range(self.MAX_ZONE_LOOKUPS):
+            if address > int(last):
+                return zones
+            pointer = type(first)(address).reverse_pointer
+            zone_name = self.dig.find_zone(pointer.split('.', 1)[1])
+            network = self.zone_network(zone_name) if zone_name else None
+            if network is None or network.version != first.version \
+                    or not (int(network.network_address) <= address
+                            <= int(network.broadcast_address)):
+                address = (address // step + 1) * step
+                continue
+            zones.append(zone_name)
+            address = int(network.broadcast_address) + 1
+        if address > int(last):
+            return zones
+        raise ValueError('Range spans too many reverse zones to find, set reversezones')
+
+    def lookup(self, first, last):
+        """
+        Return an iterator of the PTR records (lines of dig output) for
+        the addresses (ipaddress) from first to last, in address order.
+        Raises ValueError if the reverse zones cannot be found.
+        """
+        slices = []
+        for zone_name in self._zones_for(first, last):
+            index = self._index(zone_name)
+            start = bisect.bisect_left(index['addresses'], int(first))
+            end = bisect.bisect_right(index['addresses'], int(last))
+            slices.append(zip(index['addresses'][start:end], index['records'][start:end]))
+        return (record for (_, record) in heapq.merge(*slices))
+
+class NSUpdateError(Exception):
+    """
+    Error class for NSUpdate
+    """
+
+class NSUpdate:
+    """
+    Handles communication with nsupdate, or sends the
+    updates natively with DNSUpdater
+    """
+
+    CATALOG_ENTRY = 'update {action} {hname}.zones.{czone} 3600 IN PTR {zname}.\n'
+    FORWARD = 'update {action} {fqdn} 86400 A {addr}\n'
+    REVERSE = 'update {action} {addr} 86400 PTR {fqdn}.\n'
+    TEMP_DIR = '/tmp'
+    # An UPDATE message can be at most 64k, leave room for the header and TSIG
+    MAX_UPDATE_BYTES = 60000
+
+    @classmethod
+    def create(cls, **kwargs):
+        """
+        Return an NSUpdate instance set up from the mmbop configuration.
+        Arguments that are used (and their default value if not specified):
+
+            keyfile:   The key updates are signed with (/etc/bind/rndc.key)
+            dig:       DigQuery instance to use (None)
+            updatemode: Either native or nsupdate (nsupdate)
+            dnsserver: The IP of the DNS server to update (127.0.0.1)
+            dnsport:   The port the DNS server listens on (53)
+            timeout:   Seconds to wait for a reply (5)
+            maxbatch:  Most records sent in one update (500)
+            reversezones: List of reverse zones PTR records are sent to ([])
+        """
+        return cls(key=kwargs.get('keyfile', '/etc/bind/rndc.key'), dig=kwargs.get('dig'),
+                   mode=kwargs.get('updatemode', 'nsupdate'),
+                   server=kwargs.get('dnsserver', '127.0.0.1'),
+                   port=kwargs.get('dnsport', 53),
+                   timeout=kwargs.get('timeout', 5),
+                   max_batch=kwargs.get('maxbatch', 500),
+                   reverse_zones=kwargs.get('reversezones'))
+
+    def __init__(self, path='/usr/bin/nsupdate', key=None, dig=None, mode='nsupdate',
+                 server='127.0.0.1', port=53, timeout=5, max_batch=500,
+                 reverse_zones=None):
+        """
+        Raise NSUpdateError if the path to nsupdate is invalid (unless
+        mode is native, where nsupdate is only used as a fallback).
+        In native mode updates are signed with key and sent to server.
+        Uses the DigQuery instance given by dig if provided. Otherwise,
+        if unable to create a DigQuery instance, set to None, which
+        means modifying host records will not be possible.
+        Bulk changes send at most max_batch records in one update.
+        PTR records are sent to the zone in reverse_zones they fall in,
+        if any, or else to the zone found with an SOA query.
+        """
+        self.command = None
+        self.native = None
+        self.max_batch = max(int(max_batch), 1)
+        if isinstance(reverse_zones, str):
+            reverse_zones = [reverse_zones]
+        # Longest first, so the most specific zone matches
+        self.reverse_zones = sorted((x.rstrip('.').lower() for x in reverse_zones or []),
+                                    key=len, reverse=True)
+        if mode == 'native':
+            if not key:
+                raise NSUpdateError('Native update mode requires a key file')
+            try:
+                self.native = DNSUpdater(DNSClient(server, port, timeout), TSIGKey.from_file(key))
+            except DNSWireError as wire_err:
+                raise NSUpdateError(str(wire_err)) from wire_err
+        elif mode != 'nsupdate':
+            raise NSUpdateError('Invalid update mode %s' % mode)
+        if os.path.exists(path) and os.path.isfile(path):
+            # set nsupdate to always use TCP and enforce local mode
+            self.command = [path, '-v', '-l']
+            if key:
+                self.command.extend(['-k', key])
+        elif not self.native:
+            raise NSUpdateError('Invalid path %s' % path)
+        self.dig = dig
+        if not self.dig:
+            try:
+                self.dig = DigQuery()
+            except DigQueryError:
+                self.dig = None
+        self.aliases = None
+        if self.dig:
+            self.aliases = AliasIndex(self.dig)
+
+    def _native_call(self, commands):
+        """
+        Send the nsupdate commands with DNSUpdater. Returns None
+        (instead of a result tuple) if the native update could not be
+        sent and nsupdate should be tried instead.
+        """
+        try:
+            (success, message) = self.native.run_script(commands)
+        except DNSWireError as wire_err:
+            logging.debug('Native update failed: %s', wire_err)
+            if self.command:
+                logging.debug('Falling back to nsupdate')
+                return None
+            return (False, str(wire_err))
+        if success:
+            logging.debug('Native update completed successfully')
+        else:
+            logging.debug('Native update failed: %s', message)
+        return (success, message)
+
+    def _send(self, commands):
+        """
+        Send the commands (nsupdate input) natively if configured,
+        otherwise (or if that cannot be done) with nsupdate
+        """
+        if self.native:
+            native_reply = self._native_call(commands)
+            if native_reply:
+                return native_reply
+        reply = subprocess.run(self.command, encoding='utf-8', input=commands,
+                               check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if reply.returncode == 0:
+            logging.debug('nsupdate completed successfully: %s', reply.stdout)
+            return (True, None)
+        logging.debug('nsupdate failed: %s', reply.stderr)
+        return (False, reply.stderr)
+
+    @staticmethod
+    def _changed_names(commands):
+        """
+        Return the set of names (and zones) that the nsupdate commands touch
+        """
+        names = set()
+        for line in commands.split('\n'):
+            words = line.split()
+            if len(words) > 1 and words[0] == 'zone':
+                names.add(words[1])
+            elif len(words) > 2 and words[0] == 'update':
+                names.add(words[2])
+        return names
+
+    def _invalidate(self, commands, result):
+        """
+        Tell DigQuery that the zones touched by the commands have changed,
+        so cached copies of them are not used, and (if the update
+        succeeded) update the alias index
+        """
+        if self.dig:
+            for name in self._changed_names(commands):
+                self.dig.invalidate(name)
+        if self.aliases and result[0]:
+            self.aliases.record_changes(commands)
+
+    @instrumented('nsupdate', lambda catalog_zone, domain, action='add': 'zone ' + action)
+    def call_zone(self, catalog_zone, domain, action='add'):
+        """
+        Call nsupdate to modify the catalog zone. domain can be a list
+        of domains, which are changed with one update (or one for
+        every max_batch domains).
+        """
+        if isinstance(domain, str):
+            domain = [domain]
+        result = (True, None)
+        for start in range(0, len(domain), self.max_batch):
+            nsupdate_form = self.format_catalog(catalog_zone,
+                                                domain[start:start + self.max_batch], action)
+            batch_result = self._send(nsupdate_form)
+            self._invalidate(nsupdate_form, batch_result)
+            if not batch_result[0]:
+                result = batch_result
+        return result
+
+    @instrumented('nsupdate', lambda commands: 'modify')
+    def call_modify(self, commands):
+        """
+        Send commands to nsupdate (for add/delete of A/CNAME/PTR records)
+        """
+        result = self._send(commands)
+        self._invalidate(commands, result)
+        return result
+
+    def add_zone(self, catalog_zone, domain_to_add):
+        """
+        Add the specified domain to catalog
+        """
+        return self.call_zone(catalog_zone, domain_to_add)
+
+    def delete_zone(self, catalog_zone, domain_to_remove):
+        """
+        Remove the specified domain from catalog
+        """
+        return self.call_zone(catalog_zone, domain_to_remove, 'delete')
+
+    @spanned('lookup existing')
+    def _existing_record_info(self, fqdn_or_ip):
+        """
+        Used by add and delete methods, performs checks on the
+        find_record results from dig and returns a dict of the form:
+        {
+            'record_type': A|CNAME|PTR,
+            'record_ansr': The_full_answer_to_query
+            'record_last': The_strict_answer_to_query
+        }
+        If record is not found, dict will be empty.
+        """
+        dig_reply = self.dig.find_record(fqdn_or_ip)
+        logging.debug('Reply from dig: %s', dig_reply)
+        reply_dict = {}
+        if not dig_reply:
+            return None
+        first_response = dig_reply[0].replace('\t', ' ')
+        if ' CNAME ' in first_response:
+            logging.debug('Entry is alias - CNAME - record')
+            reply_dict = {
+                'record_type': 'CNAME',
+                'record_ansr': first_response,
+                'record_last': first_response.split()[-1]
+                }
+        elif ' A ' in first_response:
+            logging.debug('Entry is forward - A - record')
+            reply_dict = {
+                'record_type': 'A',
+                'record_ansr': dig_reply,
+                'record_last': [x.split()[-1] for x in dig_reply]
+                }
+        elif ' PTR ' in first_response:
+            logging.debug('Entry is reverse - PTR - record')
+            reply_dict = {
+                'record_type': 'PTR',
+                'record_ansr': dig_reply,
+                'record_last': [x.split()[-1] for x in dig_reply]
+                }
+        return reply_dict
+
+    @spanned('find aliases')
+    def _find_assoc_alias(self, fqdn):
+        """
+        Given fqdn, look up the alias (CNAME) entries in its
+        zone that refer to it.
+        """
+        return self.aliases.aliases_of(fqdn)
+
+    @spanned('add record')
+    def add_record(self, fqdn, addr, force=False):
+        """
+        Add both A and PTR records for the specified host
+        This checks to make sure:
+            1. There is not an existing A or CNAME record for fqdn
+            2. There is not an existing PTR record for ip_addr
+        If there is an existing record, then:
+            1. If force is False, the add is cancelled
+            2. If force is True, the existing records are
+               deleted and the add is attempted
+        Returns a tuple of form: (Boolean, String), where
+        boolean indicates success/failure of the add, and string
+        provides message indicating why.
+        """
+        adds = []
+        logging.debug('Request to add A record %s %s', fqdn, addr)
+        existing_forward = self._existing_record_info(fqdn)
+        if existing_forward:
+            if not force:
+                return (False, 'Existing A record found, use force to replace')
+            (for_del_status, for_del_message) = self.delete_record(fqdn, force)
+            if not for_del_status:
+                return (False, 'Error deleting existing: ' + for_del_message)
+        if isinstance(addr, str):
+            addr = [addr]
+        for ip_addr in addr:
+            existing_reverse = self._existing_record_info(ip_addr)
+            if existing_reverse:
+                if not force:
+                    return (False, 'Existing PTR record found, use force to replace')
+                (rev_del_status, rev_del_message) = self.delete_record(ip_addr, force)
+                if not rev_del_status:
+                    return (False, 'Error deleting existing: ' + rev_del_message)
+            adds.append((fqdn, ip_addr))
+        return self._make_add_call(adds)
+
+    @spanned('add alias')
+    def add_alias(self, alias_name, real_name, force=False):
+        """
+        Create a CNAME record pointing to an existing A record
+        """
+        adds = []
+        logging.debug('Request to add CNAME record %s %s', alias_name, real_name)
+        existing_alias = self._existing_record_info(alias_name)
+        existing_real = self._existing_record_info(real_name)
+        if not existing_real:
+            return (False, 'Real record %s does not exist' % real_name)
+        if existing_alias:
+            if not force:
+                return (False, 'Existing CNAME record found, use force to replace')
+            (alias_del_status, alias_del_message) = self.delete_record(alias_name, force)
+            if not alias_del_status:
+                return (False, 'Error deleting existing: ' + alias_del_message)
+        adds.append((alias_name, real_name))
+        return self._make_add_call(adds)
+
+    def _zone_of(self, name):
+        """
+        Return the zone to send the update for name to. This is the
+        longest of the configured reverse zones that name is in, if any.
+        Otherwise it is found from the parent domain of name (hosts are
+        not zone apexes, and a range of hosts shares one parent, so this
+        is one lookup for all of them).
+        """
+        name = name.rstrip('.').lower()
+        for zone_name in self.reverse_zones:
+            if name.endswith('.' + zone_name):
+                return zone_name
+        if not self.dig:
+            return None
+        return self.dig.find_zone(name.split('.', 1)[-1])
+
+    def _send_batches(self, updates):
+        """
+        Send the updates, a list of tuples of form (key, name, command),
+        grouped by the zone of name, as few update messages as possible
+        (bounded by max_batch records and MAX_UPDATE_BYTES). Each update
+        message is one transaction, so all of its records are added or
+        none are. Returns a dict of key: (success, message), where a key
+        with several updates fails if any of them did.
+        """
+        by_zone = collections.OrderedDict()
+        for update in updates:
+            by_zone.setdefault(self._zone_of(update[1]), []).append(update)
+        batches = []
+        for (zone_name, zone_updates) in by_zone.items():
+            batch = []
+            batch_bytes = 0
+            for update in zone_updates:
+                if batch and (len(batch) >= self.max_batch
+                              or batch_bytes + len(update[2]) > self.MAX_UPDATE_BYTES):
+                    batches.append((zone_name, batch))
+                    batch = []
+                    batch_bytes = 0
+                batch.append(update)
+                batch_bytes += len(update[2])
+            batches.append((zone_name, batch))
+        results = {}
+        for (zone_name, batch) in batches:
+            commands = [x[2] for x in batch] + ['send']
+            if zone_name:
+                commands.insert(0, 'zone ' + zone_name)
+            logging.debug('Sending %d updates for zone %s', len(batch), zone_name)
+            (success, message) = self.call_modify('\n'.join(commands))
+            if not success and zone_name and 'NOTZONE' in str(message):
+                # A name was not in the zone of its parent domain (such
+                # as a zone apex), let each update find its own zone
+                logging.debug('Zone %s was wrong, sending updates one at a time', zone_name)
+                for update in batch:
+                    self._merge_result(results, update[0],
+                                       self.call_modify(update[2] + '\nsend'))
+                continue
+            for update in batch:
+                self._merge_result(results, update[0], (success, message))
+        return results
+
+    @staticmethod
+    def _merge_result(results, key, result):
+        """
+        Record result for key, unless key has already failed
+        """
+        if results.get(key, (True, None))[0]:
+            results[key] = result
+
+    def _send_grouped(self, updates):
+        """
+        _send_batches, returning one tuple of form (boolean, None|string),
+        which is a failure if any update failed, and has the messages of
+        the failed updates
+        """
+        messages = []
+        for (success, message) in self._send_batches(updates).values():
+            if not success and message not in messages:
+                messages.append(message)
+        if messages:
+            return (False, ' '.join(str(x) for x in messages))
+        return (True, None)
+
+    def add_records(self, entries, force=False, strict=False, expire=86400):
+        """
+        Bulk version of add_record. entries is a list of tuples of form
+        (fqdn, addr), where addr is an IP or list of IPs. The same checks
+        are made as add_record, but the A records for each zone are
+        added with one update (or a few, for very large requests), and
+        the PTR records likewise for each reverse zone. The existing
+        records are looked up concurrently (see DigQuery.find_records).
+        If strict is True and any entry has existing records (and force
+        is False), nothing is added.
+        Returns a list (in the order of entries) of tuples of form:
+            (fqdn, addr, boolean, None|string)
+        """
+        return [result[1:] for result in
+                sorted(self.iter_add_records(entries, force, strict, expire))]
+
+    def iter_add_records(self, entries, force=False, strict=False, expire=86400):
+        """
+        Generator version of add_records, yielding a tuple of form
+            (index, fqdn, addr, boolean, None|string)
+        for each entry (index being its position in entries) as soon as
+        its result is known. Entries may also be of form (fqdn, addr,
+        force), to override force for that entry. The entries that fail
+        the existing record checks come first, then those of each zone
+        as the updates for the zone are made (see _iter_groups).
+        """
+        entries = [(entry[0], [entry[1]] if isinstance(entry[1], str) else list(entry[1]),
+                    entry[2] if len(entry) > 2 else force) for entry in entries]
+        with Span('check existing'):
+            results = self._check_existing(entries)
+        if strict and results:
+            logging.debug('Existing records and force not requested, denying add request')
+            for (index, (fqdn, addrs, _)) in enumerate(entries):
+                yield (index, fqdn, addrs, False,
+                       results.get(index, (False, 'Not added, other entries failed'))[1])
+            return
+        for index in sorted(results):
+            yield (index, entries[index][0], entries[index][1]) + results[index]
+        planned = []
+        for (index, (fqdn, addrs, _)) in enumerate(entries):
+            if index in results:
+                continue
+            reverse = []
+            for ip_addr in addrs:
+                try:
+                    rev_pointer = ipaddress.ip_address(ip_addr).reverse_pointer
+                except ValueError as val_err:
+                    logging.debug('Invalid IP %s, ignoring', val_err)
+                    continue
+                rev_name = fqdn if fqdn.endswith('.') else fqdn + '.'
+                reverse.append((rev_pointer, 'update add %s %s ptr %s' %
+                                (rev_pointer, str(expire), rev_name)))
+            planned.append((index, fqdn,
+                            ['update add %s %s a %s' % (fqdn, str(expire), x) for x in addrs],
+                            reverse))
+        for (index, success, message) in self._iter_groups(
+                planned, 'A record added, PTR record not: %s'):
+            yield (index, entries[index][0], entries[index][1], success, message)
+
+    def _check_existing(self, entries):
+        """
+        The existing record checks of iter_add_records, returning a dict
+        of index: (False, message) for the entries that cannot be added
+        """
+        results = {}
+        lookups = [x for (fqdn, addrs, _) in entries for x in [fqdn] + addrs]
+        found = iter(self.dig.find_records(lookups))
+        for (index, (fqdn, addrs, entry_force)) in enumerate(entries):
+            existing = [x for x in [fqdn] + addrs if next(found)]
+            if not addrs:
+                results[index] = (False, 'No address provided')
+                continue
+            if not existing:
+                continue
+            logging.debug('Existing records found for %s', existing)
+            if not entry_force:
+                results[index] = (False, 'Existing record found for %s, use force to replace'
+                                  % ', '.join(existing))
+                continue
+            for to_delete in existing:
+                (del_status, del_message) = self.delete_record(to_delete, entry_force)
+                # Deleting the A record also deletes the PTR records for it
+                if not del_status and del_message != 'Record does not exist':
+                    results[index] = (False, 'Error deleting existing: ' + del_message)
+                    break
+        return results
+
+    def iter_add_aliases(self, entries, force=False, expire=86400):
+        """
+        Bulk version of add_alias. entries is a list of tuples of form
+        (alias, real) or (alias, real, force). The records are looked up
+        concurrently, and the aliases of each zone added together, and
+        a tuple of form (index, alias, real, boolean, None|string) is
+        yielded for each entry as its result is known.
+        """
+        entries = [(entry[0], entry[1], entry[2] if len(entry) > 2 else force)
+                   for entry in entries]
+        found = iter(self.dig.find_records([x for entry in entries for x in entry[:2]]))
+        planned = []
+        for (index, (alias_name, real_name, entry_force)) in enumerate(entries):
+            (existing_alias, existing_real) = (next(found), next(found))
+            result = None
+            if not existing_real:
+                result = (False, 'Real record %s does not exist' % real_name)
+            elif existing_alias and not entry_force:
+                result = (False, 'Existing CNAME record found, use force to replace')
+            elif existing_alias:
+                (alias_del_status, alias_del_message) = self.delete_record(alias_name,
+                                                                           entry_force)
+                if not alias_del_status:
+                    result = (False, 'Error deleting existing: ' + alias_del_message)
+            if result:
+                yield (index, alias_name, real_name) + result
+                continue
+            planned.append((index, alias_name, ['update add %s %s cname %s' %
+                                                (alias_name, str(expire), real_name)], []))
+        for (index, success, message) in self._iter_groups(planned):
+            yield (index, entries[index][0], entries[index][1], success, message)
+
+    def iter_delete_records(self, entries, force=False):
+        """
+        Bulk version of delete_record. entries is a list of FQDNs or IPs,
+        or of tuples of form (fqdn_or_ip, force). The records to remove
+        are found concurrently, and the deletes of each zone made
+        together, and a tuple of form (index, fqdn_or_ip, boolean,
+        None|string) is yielded for each entry as its result is known.
+        """
+        entries = [(entry, force) if isinstance(entry, str) else tuple(entry)
+                   for entry in entries]
+        if self.dig.jobs == 1 or len(entries) < 2:
+            plans = [self._plan_delete(*entry) for entry in entries]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=self.dig.jobs) as executor:
+                plans = list(executor.map(traced(lambda entry: self._plan_delete(*entry)),
+                                          entries))
+        planned = []
+        for (index, (deletes, message)) in enumerate(plans):
+            if deletes is None:
+                yield (index, entries[index][0], False, message)
+                continue
+            (commands, reverse) = self._delete_commands(deletes)
+            name = commands[0].split()[2] if commands else reverse[0][0]
+            planned.append((index, name, commands, reverse))
+        for (index, success, message) in self._iter_groups(planned,
+                                                           'PTR record not deleted: %s'):
+            yield (index, entries[index][0], success, message)
+
+    def _iter_groups(self, planned, reverse_failed='%s'):
+        """
+        Make the updates planned for several entries, a list of tuples
+        of form (index, name, commands, reverse), where commands are the
+        forward updates and reverse a list of tuples of form (ptr,
+        command). The entries are grouped by the zone of name, and for
+        each zone the forward updates are sent together (see
+        _send_batches), then the reverse updates of the entries whose
+        forward updates succeeded. A tuple of form (index, boolean,
+        None|string) is yielded for each entry of a zone once its
+        updates are done, so callers can report progress zone by zone.
+        """
+        groups = collections.OrderedDict()
+        for entry in planned:
+            groups.setdefault(self._zone_of(entry[1]), []).append(entry)
+        for (zone_name, group) in groups.items():
+            logging.debug('Updating %d entries of zone %s', len(group), zone_name)
+            with Span('update zone'):
+                results = self._send_batches([(index, command.split()[2], command)
+                                              for (index, _, commands, _) in group
+                                              for command in commands])
+                reverse = [(index, ptr, command) for (index, _, _, ptrs) in group
+                           if results.get(index, (True, None))[0] for (ptr, command) in ptrs]
+                for (index, (rev_status, rev_message)) in self._send_batches(reverse).items():
+                    if not rev_status:
+                        results[index] = (False, reverse_failed % rev_message)
+            for entry in group:
+                yield (entry[0],) + results.get(entry[0], (True, None))
+
+    @spanned('delete record')
+    def delete_record(self, fqdn_or_ip, force=False):
+        """
+        Given a FQDN or IP address, remove the forward and reverse entries
+        associated with it.
+        Methodology:
+            1. If removing an A entry, make sure there are no aliases that
+               refer to it. If there are, fail unless force is True. If
+               force is True, also remove the associated alias records.
+            2. If removing a round-robin forward entry, delete all of the
+               forward and reverse entries
+            3. If removing a round-robin reverse entry, only remove
+               that specific reverse and associated forward entry
+            4. If removing an alias, just remove that (do not touch any
+               related A/PTR records)
+        """
+        if isinstance(fqdn_or_ip, str):
+            fqdn_or_ip = [fqdn_or_ip]
+        for fq_or_i in fqdn_or_ip:
+            (deletes, message) = self._plan_delete(fq_or_i, force)
+            if deletes is None:
+                return (False, message)
+            logging.debug('Making call to remove records: %s', deletes)
+            return self._make_delete_call(deletes)
+
+    @spanned('plan delete')
+    def _plan_delete(self, fq_or_i, force=False):
+        """
+        Find the records to remove for delete_record (see there).
+        Returns a tuple of form (dict|None, None|string), where dict has
+        the A, PTR and CNAME records to delete, or is None with the
+        reason the delete cannot be made.
+        """
+        logging.debug('Recieved request to delete %s', fq_or_i)
+        deletes = {'A': [], 'PTR': [], 'CNAME': []}
+        existing = self._existing_record_info(fq_or_i)
+        if existing:
+            logging.debug('Record found')
+            if existing['record_type'] == 'A':
+                logging.debug('Record type is A, looking for associated aliases')
+                associated_aliases = self._find_assoc_alias(fq_or_i)
+                if associated_aliases:
+                    logging.debug('Found aliases %s', associated_aliases)
+                    if not force:
+                        return (None, 'Found associated aliases, use force to delete')
+                    logging.debug('Adding aliases to delete request')
+                    deletes['CNAME'].extend(associated_aliases)
+                else:
+                    logging.debug('No associated aliases found')
+                logging.debug('Searching for matching PTR record')
+                for answer in existing['record_ansr']:
+                    ip_addr = answer.split()[-1]
+                    try:
+                        ip_addr = ipaddress.ip_address(ip_addr)
+                    except ValueError:
+                        logging.debug('Invalid IP address %s, ignoring', ip_addr)
+                        continue
+                    logging.debug('Looking for PTR record for %s', str(ip_addr))
+                    ptr_record = self.dig.find_record(str(ip_addr))
+                    if ptr_record:
+                        logging.debug('PTR record found')
+                        ptr_a_ref = ptr_record[0].split()[-1]
+                        if ptr_a_ref.endswith('.'):
+                            ptr_a_ref = ptr_a_ref[:-1]
+                        logging.debug('Verifying that PTR reference %s matches A record %s',
+                                      ptr_a_ref, fq_or_i)
+                        if fq_or_i == ptr_a_ref:
+                            logging.debug('Adding PTR record to delete request')
+                            deletes['PTR'].append(ip_addr.reverse_pointer)
+                        else:
+                            logging.debug('PTR reference and original request do not match')
+                deletes['A'].append(fq_or_i)
+            if existing['record_type'] == 'CNAME':
+                logging.debug('Record type is CNAME')
+                deletes['CNAME'].append(fq_or_i)
+            if existing['record_type'] == 'PTR':
+                try:
+                    ip_address = ipaddress.ip_address(fq_or_i)
+                except ValueError as val_err:
+                    logging.debug('Reverse record is somehow not a valid IP? : %s', val_err)
+                    return (None, 'Invalid IP address %s' % fq_or_i)
+                logging.debug('Record type is PTR, looking for matching A record')
+                fqdn = existing['record_last'][0]
+                a_record = self.dig.find_record(fqdn)
+                if a_record:
+                    logging.debug('A record found: %s', a_record[0])
+                    for a_entry in a_record:
+                        a_ptr_ref = a_entry.split()[-1]
+                        logging.debug('Comparing IP %s with A record ref %s',
+                                      fq_or_i, a_ptr_ref)
+                        if a_ptr_ref == fq_or_i:
+                            logging.debug('Adding A record to delete request')
+                            deletes['A'].append((fqdn, str(ip_address)))
+                            break
+                        logging.debug('A reference and original request do not match')
+                deletes['PTR'].append(ip_address.reverse_pointer)
+        else:
+            return (None, 'Record does not exist')
+        return (deletes, None)
+
+    @staticmethod
+    def _alias_request(request_tuple):
+        """
+        Return True if both records in the tuple are FQDNs
+        (or rather, if neither are valid IP addresses)
+        """
+        if not isinstance(request_tuple, tuple):
+            return None
+        try:
+            _ = ipaddress.ip_address(request_tuple[0])
+        except ValueError:
+            try:
+                _ = ipaddress.ip_address(request_tuple[1])
+            except ValueError:
+                return True
+        return False
+
+    def _make_add_call(self, records_to_modify, expire=86400):
+        """
+        Create the nsupdate commands and make requested changes
+        Return tuple of form:
+            (boolean, None|string) where boolean is success|failure status
+                                   and string is the error message from nsupdate.
+        records_to_modify should be an array of tuples, of form (fqdn, ip)
+        The PTR records are sent with one update for each reverse zone.
+        """
+        commands = []
+        for entry in records_to_modify:
+            logging.debug('Creating config to add %s %s', entry[0], entry[1])
+            if self._alias_request(entry):
+                commands.append('update add %s %s cname %s' % (entry[0], str(expire), entry[1]))
+            else:
+                commands.append('update add %s %s a %s' % (entry[0], str(expire), entry[1]))
+        commands.append('send')
+        nsupdate_commands = '\n'.join(commands)
+        logging.debug('Commands to nsupdate: %s', nsupdate_commands)
+        (forward_status, forward_message) = self.call_modify(nsupdate_commands)
+        if not forward_status:
+            return (forward_status, forward_message)
+        reverse = []
+        for rev_entry in records_to_modify:
+            try:
+                rev_ip = ipaddress.ip_address(rev_entry[1])
+            except ValueError as val_err:
+                logging.debug('Invalid IP %s, ignoring', val_err)
+                continue
+            rev_pointer = rev_ip.reverse_pointer
+            rev_name = rev_entry[0]
+            if not rev_name.endswith('.'):
+                rev_name += '.'
+            logging.debug('Creating config to add %s %s', rev_pointer, rev_name)
+            reverse.append((rev_pointer, rev_pointer, 'update add %s %s ptr %s' %
+                            (rev_pointer, str(expire), rev_name)))
+        return self._send_grouped(reverse)
+
+    def _make_delete_call(self, records_to_modify):
+        """
+        Create the nsupdate commands and make requested changes
+        Return tuple of form:
+            (boolean, None|string) where boolean is success|failure status
+                                   and string is the error message from nsupdate.
+        As multiple calls to nsupdate can be made, a failure in any
+        call will result in a failed return, and message will be a
+        concatenation of each of the calls.
+        All A and CNAME entries will be combined in one call, since
+        they are (by the nature of the previous search) part of the
+        same zone. PTR records may not be in the same zone, so they are
+        grouped by reverse zone, with one call for each.
+        """
+        (commands, reverse) = self._delete_commands(records_to_modify)
+        commands.append('send')
+        nsupdate_commands = '\n'.join(commands)
+        logging.debug('Sending following commands to nsupdate: %s', nsupdate_commands)
+        (success, message) = self.call_modify(nsupdate_commands)
+        logging.debug('Sending PTR deletes to nsupdate: %s', reverse)
+        (rev_success, rev_message) = self._send_grouped(
+            [(ptr, ptr, command) for (ptr, command) in reverse])
+        if not rev_success:
+            success = rev_success
+            if not message:
+                message = rev_message
+            else:
+                message += ' ' + rev_message
+        return (success, message)
+
+    @staticmethod
+    def _delete_commands(records_to_modify):
+        """
+        Return the nsupdate commands for the records found by
+        _plan_delete, as a tuple of form (commands, reverse), where
+        commands is a list of the A and CNAME deletes, and reverse is
+        a list of tuples of form (ptr, command) for the PTR deletes
+        """
+        commands = []
+        for a_rec in records_to_modify['A']:
+            if isinstance(a_rec, str):
+                fqdn = a_rec.split(' ')[0]
+                commands.append('update delete ' + fqdn + ' a')
+            elif isinstance(a_rec, tuple):
+                fqdn = a_rec[0].split(' ')[0]
+                commands.append('update delete ' + fqdn + ' a ' + a_rec[1])
+        for cname_rec in records_to_modify['CNAME']:
+            alias = cname_rec.split(' ')[0]
+            commands.append('update delete ' + alias + ' cname')
+        reverse = []
+        for ptr_rec in records_to_modify['PTR']:
+            ptr = ptr_rec.split(' ')[0]
+            reverse.append((ptr, 'update delete ' + ptr + ' ptr'))
+        return (commands, reverse)
+
+    @staticmethod
+    def hex_digest_format(domain_name):
+        """
+        Given a domain name, return the BIND wire format SHA1 hex digit
+        of the name
+        """
+        if not domain_name.endswith('.'):
+            domain_name += '.'
+        zone_labels = domain_name.split('.')
+        digest_labels = [chr(len(x)) + x for x in zone_labels]
+        byte_labels = [x.encode() for x in digest_labels]
+        byte_string = b''.join(byte_labels)
+        return hashlib.sha1(byte_string).hexdigest()
+
+    def format_catalog(self, catalog_zone, domain_to_add, action):
+        """
+        Fill out the nsupdate format for modifying the catalog zone
+        (domain_to_add can be a list, all changed in the one update)
+        """
+        if isinstance(domain_to_add, str):
+            domain_to_add = [domain_to_add]
+        catalog_form = 'zone %s\n' % catalog_zone
+        for domain in domain_to_add:
+            hashed_name = self.hex_digest_format(domain)
+            catalog_form += self.CATALOG_ENTRY.format(czone=catalog_zone, hname=hashed_name,
+                                                      zname=domain, action=action)
+        catalog_form += 'send\n'
+        logging.debug('Nsupdate update file contents: %s', catalog_form)
+        return catalog_form
+
+class RNDCError(Exception):
+    """
+    Error class for RNDC
+    """
+
+class RNDCClient:
+    """
+    Speaks the rndc control channel protocol directly to BIND,
+    keeping one authenticated connection open for every command
+    (and reconnecting when BIND closes it)
+    """
+
+    # Algorithm numbers sent in the hsha authenticator
+    ALGORITHMS = {'hmac-md5': 157, 'hmac-sha1': 161, 'hmac-sha224': 162,
+                  'hmac-sha256': 163, 'hmac-sha384': 164, 'hmac-sha512': 165}
+    # Element types in control channel messages
+    TYPE_BINARY = 1
+    TYPE_TABLE = 2
+    TYPE_LIST = 3
+
+    def __init__(self, server='127.0.0.1', port=953, key_file='/etc/bind/rndc.key',
+                 timeout=60):
+        try:
+            (_, self.algorithm, self.secret) = read_key_file(key_file)
+        except DNSWireError as wire_err:
+            raise RNDCError(str(wire_err)) from wire_err
+        if self.algorithm not in self.ALGORITHMS:
+            raise RNDCError('Unsupported rndc key algorithm %s' % self.algorithm)
+        self.digest = TSIG_ALGORITHMS[self.algorithm][1]
+        self.address = (server, int(port))
+        self.timeout = float(timeout)
+        self.serial = _RANDOM.randint(0, 1 << 24)
+        self.sock = None
+        self.nonce = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def _serialize(cls, table):
+        """
+        Convert a dict (of str, bytes or dict values) to the
+        control channel wire format
+        """
+        wire = []
+        for (key, value) in table.items():
+            if isinstance(value, dict):
+                (value_type, value) = (cls.TYPE_TABLE, cls._serialize(value))
+            elif isinstance(value, str):
+                (value_type, value) = (cls.TYPE_BINARY, value.encode())
+            else:
+                value_type = cls.TYPE_BINARY
+            key = key.encode()
+            wire.append(bytes([len(key)]) + key + struct.pack('!BI', value_type, len(value)) +
+                        value)
+        return b''.join(wire)
+
+    @classmethod
+    def _parse_value(cls, value_type, value):
+        """
+        Convert an element value from wire format
+        """
+        if value_type == cls.TYPE_TABLE:
+            return cls._parse(value)
+        if value_type == cls.TYPE_LIST:
+            items = []
+            pos = 0
+            while pos < len(value):
+                (item_type, length) = struct.unpack('!BI', value[pos:pos + 5])
+                items.append(cls._parse_value(item_type, value[pos + 5:pos + 5 + length]))
+                pos += 5 + length
+            return items
+        return value
+
+    @classmethod
+    def _parse(cls, data, first_only=False):
+        """
+        Convert the wire format to a dict. If first_only, return tuple
+        of form: (string:key, value, int:offset_after_element) for the
+        first element.
+        """
+        table = {}
+        pos = 0
+        try:
+            while pos < len(data):
+                key = data[pos + 1:pos + 1 + data[pos]].decode()
+                pos += 1 + data[pos]
+                (value_type, length) = struct.unpack('!BI', data[pos:pos + 5])
+                value = cls._parse_value(value_type, data[pos + 5:pos + 5 + length])
+                pos += 5 + length
+                if first_only:
+                    return (key, value, pos)
+                table[key] = value
+        except (IndexError, struct.error, UnicodeDecodeError) as parse_err:
+            raise RNDCError('Malformed control message: %s' % parse_err) from parse_err
+        return table
+
+    def _b64_digest(self, signed_data):
+        """
+        Base64 HMAC of the signed part of a message, padded out to
+        the length carried in the authenticator
+        """
+        digest = base64.b64encode(hmac.new(self.secret, signed_data, self.digest).digest())
+        if self.algorithm == 'hmac-md5':
+            return digest[:22]
+        return digest.ljust(88, b'\x00')
+
+    def _build(self, data):
+        """
+        Return a signed control message carrying the data dict
+        """
+        self.serial += 1
+        now = int(time())
+        ctrl = {'_ser': str(self.serial), '_tim': str(now), '_exp': str(now + 60)}
+        if self.nonce is not None:
+            ctrl['_nonce'] = self.nonce
+        body = self._serialize({'_ctrl': ctrl, '_data': data})
+        if self.algorithm == 'hmac-md5':
+            auth = {'hmd5': self._b64_digest(body)}
+        else:
+            auth = {'hsha': bytes([self.ALGORITHMS[self.algorithm]]) + self._b64_digest(body)}
+        wire = self._serialize({'_auth': auth}) + body
+        return struct.pack('!II', len(wire) + 4, 1) + wire
+
+    def _verify(self, data):
+        """
+        Check the authenticator of a received message, returning
+        the message as a dict
+        """
+        (key, auth, signed_start) = self._parse(data, first_only=True)
+        if key != '_auth' or not isinstance(auth, dict):
+            raise RNDCError('Reply from BIND is not signed')
+        expected = self._b64_digest(data[signed_start:])
+        if self.algorithm == 'hmac-md5':
+            received = auth.get('hmd5', b'')
+        else:
+            received = auth.get('hsha', b'')[1:]
+        if not hmac.compare_digest(received, expected):
+            raise RNDCError('Reply from BIND failed authentication')
+        message = self._parse(data[signed_start:])
+        message['_auth'] = auth
+        return message
+
+    def _exchange(self, data):
+        """
+        Send one request on the open connection, return the reply
+        """
+        self.sock.sendall(self._build(data))
+        (length, version) = struct.unpack('!II', _recv_exact(self.sock, 8))
+        if version != 1:
+            raise RNDCError('Unsupported control message version %d' % version)
+        reply = self._verify(_recv_exact(self.sock, length - 4))
+        ctrl = reply.get('_ctrl', {})
+        if self.nonce is not None and ctrl.get('_nonce') != self.nonce:
+            raise RNDCError('Reply from BIND has wrong nonce')
+        return reply
+
+    def _connect(self):
+        """
+        Open the connection and obtain the nonce that every
+        later request on it has to carry
+        """
+        self.close()
+        self.sock = socket.create_connection(self.address, self.timeout)
+        reply = self._exchange({'type': 'null'})
+        self.nonce = reply.get('_ctrl', {}).get('_nonce')
+        logging.debug('Connected to rndc control channel at %s:%s', *self.address)
+
+    def close(self):
+        """
+        Close the connection to BIND (if open)
+        """
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+        self.nonce = None
+
+    def command(self, rndc_command):
+        """
+        Run an rndc command (string, or list of words), returning the
+        _data dict of the reply. Reconnects once if the connection
+        has been closed.
+        """
+        if isinstance(rndc_command, list):
+            rndc_command = ' '.join(rndc_command)
+        with self.lock:
+            for attempt in (1, 2):
+                try:
+                    if not self.sock:
+                        self._connect()
+                    return self._exchange({'type': rndc_command}).get('_data', {})
+                except (OSError, DNSWireError) as conn_err:
+                    self.close()
+                    if attempt == 2:
+                        raise RNDCError('Unable to reach rndc control channel: %s'
+                                        % conn_err) from conn_err
+                    logging.debug('rndc connection lost (%s), reconnecting', conn_err)
+                except RNDCError:
+                    self.close()
+                    raise
+        return {}
+
+    def call(self, rndc_command):
+        """
+        Run an rndc command, returning a CompletedProcess instance
+        holding the same output (and exit status) as the rndc executable
+        """
+        data = self.command(rndc_command)
+        if isinstance(rndc_command, str):
+            rndc_command = [rndc_command]
+        name = ' '.join(rndc_command).split(' ', 1)[0]
+        text = data.get('text', b'').decode(errors='replace')
+        if text:
+            text += '\n'
+        if 'err' in data:
+            error = data['err'].decode(errors='replace')
+            return subprocess.CompletedProcess(rndc_command, 1, '', "rndc: '%s' failed: %s\n%s"
+                                               % (name, error, text))
+        return subprocess.CompletedProcess(rndc_command, 0, text, '')
+
+class RNDCClientPool:
+    """
+    Up to size RNDCClient connections to BIND, so that as many rndc
+    commands (such as the addzone calls of RNDC.add_zones) can run at
+    once. Connections are opened when needed, and kept open for later
+    commands; when all of them are in use, a command waits for one.
+    """
+
+    def __init__(self, size, server='127.0.0.1', port=953, key_file='/etc/bind/rndc.key'):
+        self.size = max(int(size), 1)
+        self.client_args = (server, port, key_file)
+        # One client is made now, so a bad key file is reported here
+        self.idle = [RNDCClient(*self.client_args)]
+        self.clients = 1
+        self.ready = threading.Condition()
+
+    def _take(self):
+        """
+        Return an idle client, or a new one if fewer than size are
+        open, or wait for one to be returned
+        """
+        with self.ready:
+            while not self.idle and self.clients >= self.size:
+                self.ready.wait()
+            if self.idle:
+                return self.idle.pop()
+            self.clients += 1
+        try:
+            return RNDCClient(*self.client_args)
+        except RNDCError:
+            with self.ready:
+                self.clients -= 1
+                self.ready.notify()
+            raise
+
+    def call(self, rndc_command):
+        """
+        Run an rndc command on one of the connections (see RNDCClient.call)
+        """
+        client = self._take()
+        try:
+            return client.call(rndc_command)
+        finally:
+            with self.ready:
+                self.idle.append(client)
+                self.ready.notify()
+
+class ZoneInventory:
+    """
+    In-memory list of the zones reported by RNDC.list_zones, so that
+    every request for the list does not make named dump its database.
+    The list is rebuilt when it is older than max_age seconds (or when
+    asked to), and every refresh_interval seconds by a background
+    thread. Zones that mmbop adds or deletes are changed in place, and
+    those changed while the list is being rebuilt are changed in the
+    new list too (the dump may have been made before the change).
+    """
+
+    def __init__(self, rndc_instance, max_age=0, refresh_interval=0):
+        self.rndc = rndc_instance
+        self.max_age = float(max_age)
+        self.zones = None
+        # (zone_name, added) of the changes made during a rebuild
+        self.changes = None
+        self.loaded = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        METRICS.watch_cache('zonelist', self)
+        # Only one dump of the database at a time
+        self.build_lock = threading.Lock()
+        self.refresh_interval = float(refresh_interval)
+        if self.refresh_interval > 0:
+            refresher = threading.Thread(target=self._refresh_loop, daemon=True,
+                                         name='mmbop-zone-inventory')
+            refresher.start()
+
+    def _refresh_loop(self):
+        """
+        Background thread, rebuilding the list every refresh_interval seconds
+        """
+        while True:
+            try:
+                self.rebuild()
+            except Exception as refresh_err:  # pylint: disable=broad-except
+                logging.debug('Refresh of zone list failed: %s', refresh_err)
+            sleep(self.refresh_interval)
+
+    def rebuild(self, since=None):
+        """
+        Read the list of zones from named, returns False if that failed.
+        If since is given and another thread has read the list starting
+        after since (while this one waited for it), that list is kept
+        instead of dumping the database again.
+        """
+        with self.build_lock:
+            with self.lock:
+                if since is not None and self.zones is not None and self.loaded > since:
+                    return True
+            started = time()
+            zone_list = None
+            with self.lock:
+                self.changes = []
+            try:
+                zone_list = self.rndc.list_zones()
+            finally:
+                with self.lock:
+                    if zone_list is not None:
+                        for (zone_name, added) in self.changes:
+                            self._change(zone_list, zone_name, added)
+                        self.zones = zone_list
+                        self.loaded = started
+                    self.changes = None
+        return zone_list is not None
+
+    def get(self, force=False):
+        """
+        Return the list of zones, rebuilt first if force is True or it
+        is older than max_age. Returns None if it could not be read.
+        Requests that find the list needs rebuilding at the same time
+        share one rebuild.
+        """
+        requested = time()
+        with self.lock:
+            fresh = self.zones is not None and time() - self.loaded < self.max_age
+            if force or not fresh:
+                self.misses += 1
+            else:
+                self.hits += 1
+        # A list read since the request (or, unless forced, one that
+        # was fresh enough for it) is as good as a new one
+        since = requested if force else requested - self.max_age
+        if (force or not fresh) and not self.rebuild(since):
+            return None
+        with self.lock:
+            return list(self.zones)
+
+    @staticmethod
+    def _change(zone_list, zone_name, added):
+        """
+        Add zone_name to (or remove it from) zone_list
+        """
+        if added and zone_name not in zone_list:
+            zone_list.append(zone_name)
+        elif not added and zone_name in zone_list:
+            zone_list.remove(zone_name)
+
+    def _record(self, zone_name, added):
+        """
+        Make the change to the list, and note it if a rebuild is running
+        """
+        with self.lock:
+            if self.zones is not None:
+                self._change(self.zones, zone_name, added)
+            if self.changes is not None:
+                self.changes.append((zone_name, added))
+
+    def added(self, zone_name):
+        """
+        Called when mmbop has added zone_name
+        """
+        self._record(zone_name, True)
+
+    def removed(self, zone_name):
+        """
+        Called when mmbop has deleted zone_name
+        """
+        self._record(zone_name, False)
+
+class RNDCControl:
+    """
+    Runs rndc commands, with the rndc executable or directly over the
+    control channel using RNDCClientPool. This is the part of RNDC that
+    needs no zone state, so it can be used on its own (see StatusCheck).
+    """
+
+    DEFAULTS = {'keyfile': '/etc/bind/rndc.key',
+                'server': '127.0.0.1',
+                'port': 953,
+                'path': '/usr/sbin/rndc',
+               }
+
+    def __init__(self, **kwargs):
+        """
+        arguments that are used (and their default value if not specified):
+
+            key:      The location of the rndc key file (/etc/bind/rndc.key)
+            server:   The IP of the DNS server rndc can connect to (127.0.0.1)
+            port:     The TCP port that rndc service runs on (953)
+            path:     The full path to rndc executable (/usr/sbin/rndc)
+            controlmode: Either native or rndc (rndc)
+            jobs:     The most control channel connections open at once,
+                      in native mode (8)
+        """
+        self.info = {}
+        for key, value in self.DEFAULTS.items():
+            self.info[key] = kwargs.get(key, value)
+        self.info['port'] = str(self.info['port'])
+        self.native = None
+        if not (os.path.exists(self.info['keyfile']) and os.path.isfile(self.info['keyfile'])):
+            raise RNDCError('Key file %s not found or invalid' % self.info['keyfile'])
+        control_mode = kwargs.get('controlmode', 'rndc')
+        if control_mode == 'native':
+            self.native = RNDCClientPool(kwargs.get('jobs', 8), self.info['server'],
+                                         self.info['port'], self.info['keyfile'])
+        elif control_mode != 'rndc':
+            raise RNDCError('Invalid control mode %s' % control_mode)
+        if not (os.path.exists(self.info['path']) and os.path.isfile(self.info['path'])):
+            if not self.native:
+                raise RNDCError('Invalid path to rndc: %s' % self.info['path'])
+            self.info['path'] = None
+
+    @instrumented('rndc', _rndc_command)
+    def call(self, rndc_command):
+        """
+        Use subprocess.run to make call to rndc (or the native control
+        channel client), return result as a CompletedProcess instance.
+        """
+        if self.native:
+            try:
+                return self.native.call(rndc_command)
+            except RNDCError as rndc_err:
+                logging.debug('Native rndc call failed: %s', rndc_err)
+                if not self.info['path']:
+                    return subprocess.CompletedProcess(rndc_command, 1, '', str(rndc_err))
+                logging.debug('Falling back to rndc executable')
+        command = [self.info['path']]
+        command.extend(['-k', self.info['keyfile'], '-s', self.info['server']])
+        command.extend(['-p', self.info['port']])
+        if isinstance(rndc_command, list):
+            command.extend(rndc_command)
+        elif isinstance(rndc_command, str):
+            command.append(rndc_command)
+        logging.debug('Calling rndc with following options: %s', command)
+        return subprocess.run(command, stdout=subprocess.PIPE, check=False,
+                              stderr=subprocess.PIPE, universal_newlines=True)
+
+    def status(self, check_conn_only=False):
+        """
+        Return result of 'rndc status' command.
+        If check_conn_only, return boolean if the connection was successful
+        or not.
+        """
+        status_response = self.call('status')
+        if status_response.returncode == 0:
+            if check_conn_only:
+                return True
+            return status_response.stdout
+        return status_response.stderr
+
+class RNDC:
+    """
+    Handles communication with rndc, or with BIND directly
+    over the control channel using RNDCClient
+    """
+
+    # Template for creating new zone file
+    # Adapted from example here: https://en.wikipedia.org/wiki/Zone_file
+    # Adjust the various timeout values to suit your environment
+    SKELETON_ZONE = '$ORIGIN {zone}.\n$TTL 1h\n'
+    SKELETON_ZONE += '{zone}. IN SOA {ns1}. {owner}. ( {serial} 1d 2h 4w 1h )\n'
+    SKELETON_ZONE += '{zone}. IN NS {ns1}.\n{zone}. IN NS {ns2}.\n'
+    # Last line of a completed 'rndc dumpdb', and the line starting each zone in it
+    DUMP_COMPLETE = b'; Dump complete'
+    DUMP_ZONE = re.compile(rb"^; Zone dump of '([^']+)/IN", re.MULTILINE)
+    # Seconds to wait for named to write the dump file
+    DUMP_TIMEOUT = 10
+    # Bytes of the dump file read at a time, and the most times it is
+    # read again when another dump rewrites it as it is read
+    DUMP_CHUNK = 1 << 20
+    DUMP_READS = 3
+
+    @classmethod
+    def create(cls, **kwargs):
+        """
+        Return an RNDC instance, only if it is valid (can make a successful
+        'rndc status' call), raise RNDCError otherwise.
+        """
+        rndc_instance = cls(**kwargs)
+        if rndc_instance.status(True):
+            return rndc_instance
+        raise RNDCError('Cannot communicate with BIND using rndc')
+
+    def __init__(self, **kwargs):
+        """
+        arguments that are used (and their default value if not specified):
+
+            key:      The location of the rndc key file (/etc/bind/rndc.key)
+            server:   The IP of the DNS server rndc can connect to (127.0.0.1)
+            port:     The TCP port that rndc service runs on (953)
+            path:     The full path to rndc executable (/usr/sbin/rndc)
+            controlmode: Either native or rndc (rndc)
+            dns1:     The name of the primary DNS server (ns1.example.com)
+            dns2:     The name of the secondary DNS server (ns2.example.com)
+            serial:   The starting serial number for a new zone (1)
+            view:     The view in named.conf where zones are located (None)
+            owner:    SOA contact for the zone (hostmaster.example.com)
+            protect:  List of domains that cannot be managed ([])
+            require:  List of substrings, one of which domain should match ([])
+            namedir:  Directory location for zone files (/etc/bind/)
+            nameown:  File owner for zone files (bind)
+            namegrp:  Group owner for zone files (bind)
+            nameper:  File permissions mask for zone files (0644)
+            options:  List of statements to add to zone definition ([])
+            dig:      DigQuery instance to share with nsupdate (None)
+            nsupdate: NSUpdate instance to use for the catalog zone (None,
+                      one is created)
+
+        key, server, port, path and controlmode are passed on to RNDCControl.
+        The [BACKEND] arguments (updatemode, dnsserver, dnsport, timeout,
+        maxbatch, reversezones) are passed on to NSUpdate.create, and zonelistage
+        and zonelistrefresh to ZoneInventory. jobs is the most zones that
+        add_zones and delete_zones work on at once.
+
+        Note that the default values for some arguments will probably
+        not work in your environment, and so should be specified when
+        calling this function (ie, added to the mmbop.ini configuration)
+        or modify the 'get' statements below to set fallback values
+        """
+        defaults = dict(RNDCControl.DEFAULTS)
+        defaults.update({'dns1': 'ns1.example.com',
+                         'dns2': 'ns2.example.com',
+                         'serial': 1,
+                         'view': None,
+                         'owner': 'hostmaster.example.com',
+                         'protect': [],
+                         'require': [],
+                         'namedir': '/etc/bind',
+                         'nameown': 'bind',
+                         'namegrp': 'bind',
+                         'nameper': '0644',
+                         'options': [],
+                         'catalog': None,
+                        })
+        self.info = {}
+        for key, value in defaults.items():
+            self.info.setdefault(key, kwargs.get(key, value))
+        self.info['port'] = str(self.info['port'])
+        self.info['serial'] = str(self.info['serial'])
+        if not self.info['namedir'].endswith('/'):
+            self.info['namedir'] += '/'
+        self.control = RNDCControl(**kwargs)
+        self.info['dns'] = [self.info['dns1'], self.info['dns2']]
+        if isinstance(self.info['protect'], str):
+            self.info['protect'] = [self.info['protect']]
+        if isinstance(self.info['require'], str):
+            self.info['require'] = [self.info['require']]
+        try:
+            self.info['nameper'] = int(self.info['nameper'], base=8)
+        except ValueError:
+            self.info['nameper'] = 0o644  # Octal format for Python3
+        if isinstance(self.info['options'], str):
+            self.info['options'] = [self.info['options']]
+        self.jobs = max(int(kwargs.get('jobs', 8)), 1)
+        self.inventory = ZoneInventory(self, kwargs.get('zonelistage', 0),
+                                       kwargs.get('zonelistrefresh', 0))
+        self.my_nsupdate = kwargs.get('nsupdate')
+        if not self.my_nsupdate:
+            self.my_nsupdate = NSUpdate.create(**dict(kwargs, keyfile=self.info['keyfile']))
+
+    def call(self, rndc_command):
+        """
+        Run an rndc command (see RNDCControl.call), return result as a
+        CompletedProcess instance.
+        """
+        return self.control.call(rndc_command)
+
+    def status(self, check_conn_only=False):
+        """
+        Return result of 'rndc status' command (see RNDCControl.status)
+        """
+        return self.control.status(check_conn_only)
+
+    def zonestatus(self, zone_name):
+        """
+        Return result of 'rndc zonestatus <zone>' command.
+        """
+        status_response = self.call(['zonestatus', zone_name])
+        if status_response.returncode == 0:
+            return status_response.stdout
+        return status_response.stderr
+
+    @staticmethod
+    def _dump_file_state(dump_file):
+        """
+        Return what identifies the current version of the dump
+        file (None if there is no dump file)
+        """
+        try:
+            file_stat = os.stat(dump_file)
+        except OSError:
+            return None
+        return (file_stat.st_ino, file_stat.st_size, file_stat.st_mtime_ns)
+
+    @classmethod
+    def _dump_file_is_ready(cls, dump_file):
+        """
+        Looks for last line of named dump file, indicating completion.
+        Only the end of the file is read.
+        """
+        try:
+            with open(dump_file, 'rb') as bind_dump:
+                bind_dump.seek(0, os.SEEK_END)
+                bind_dump.seek(max(bind_dump.tell() - 2 * len(cls.DUMP_COMPLETE), 0))
+                return bind_dump.read().rstrip().endswith(cls.DUMP_COMPLETE)
+        except OSError:
+            return False
+
+    @spanned('wait for dump')
+    def _wait_for_dump(self, dump_file, old_state):
+        """
+        Wait for named to finish writing a new dump file, one that is
+        not the file from before the dump was requested (old_state)
+        and ends with the completion line. The file is only read when
+        it has changed; its state is polled every few milliseconds,
+        backing off while it stays the same.
+        """
+        deadline = time() + self.DUMP_TIMEOUT
+        last_state = old_state
+        delay = 0.002
+        while time() < deadline:
+            state = self._dump_file_state(dump_file)
+            if state != last_state:
+                last_state = state
+                delay = 0.002
+                if state != old_state and self._dump_file_is_ready(dump_file):
+                    return True
+            else:
+                delay = min(delay * 2, 0.05)
+            sleep(delay)
+        return False
+
+    @classmethod
+    def _dump_zones(cls, dump_file):
+        """
+        Generator of the zone names in the dump file, found by scanning
+        it a large chunk at a time for the zone headers (the records in
+        between are not read line by line). The file is read rather than
+        memory-mapped, as named truncates and rewrites it in place for
+        each dump, which would kill a process with it mapped.
+        """
+        with open(dump_file, 'rb') as bind_dump:
+            rest = b''
+            while True:
+                chunk = bind_dump.read(cls.DUMP_CHUNK)
+                buffer = rest + chunk
+                # Only whole lines are scanned, the rest waits for the next chunk
+                end = buffer.rfind(b'\n') + 1 if chunk else len(buffer)
+                for matcher in cls.DUMP_ZONE.finditer(buffer, 0, end):
+                    yield matcher.group(1).decode()
+                if not chunk:
+                    return
+                rest = buffer[end:]
+
+    @spanned('list zones')
+    def list_zones(self):
+        """
+        Perform an rndc dumpdb, parse for zones matching required
+        stanzas, return list of those zones
+        """
+        zone_list = []
+        dump_file = self.info['namedir'] + 'named_dump.db'
+        old_state = self._dump_file_state(dump_file)
+        dump_response = self.call(['dumpdb', '-zones'])
+        if dump_response.returncode != 0:
+            logging.debug('Unable to create dump file. Cannot get list of zones.')
+            return None
+        if not self._wait_for_dump(dump_file, old_state):
+            logging.debug('Issue waiting on dump file to complete')
+            return None
+        try:
+            logging.debug('Attempting to view dump file %s', dump_file)
+            for _ in range(self.DUMP_READS):
+                state = self._dump_file_state(dump_file)
+                zone_names = list(self._dump_zones(dump_file))
+                if self._dump_file_state(dump_file) == state:
+                    break
+                # A dump for another process rewrote the file as it was read
+                logging.debug('Dump file changed while being read')
+                if not self._wait_for_dump(dump_file, state):
+                    return None
+            else:
+                return None
+        except (OSError, ValueError) as read_err:
+            logging.debug('Cannot read dump file: %s', read_err)
+            return None
+        for zone_name in zone_names:
+            if self.zone_is_valid(zone_name):
+                logging.debug('Found zone %s', zone_name)
+                zone_list.append(zone_name)
+        logging.debug('Found zones: %s', zone_list)
+        return zone_list
+
+    def zone_inventory(self, force=False):
+        """
+        The list_zones result, from the in-memory inventory if it is
+        recent enough (see ZoneInventory) and force is False
+        """
+        return self.inventory.get(force)
+
+    def _run_all(self, function, items, progress=None):
+        """
+        Return [function(x) for x in items], running up to self.jobs
+        of the calls at once. If given, progress is called with the
+        number of calls done and len(items) as each one finishes.
+        """
+        if progress:
+            function = counted(function, progress, len(items))
+        if self.jobs == 1 or len(items) < 2:
+            return [function(x) for x in items]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            return list(executor.map(traced(function), items))
+
+    def _zone_changed(self, zone_name, added):
+        """
+        Tell the zone inventory and DigQuery that zone_name has been added
+        (or deleted), since names in it now belong to a different zone
+        """
+        if added:
+            self.inventory.added(zone_name)
+        else:
+            self.inventory.removed(zone_name)
+        if self.my_nsupdate.dig:
+            self.my_nsupdate.dig.invalidate(zone_name)
+
+    @staticmethod
+    def _rndc_error(rndc_response):
+        """
+        Return the error message from the stderr of a failed rndc call
+        """
+        message_index = rndc_response.stderr.rfind(':') + 1
+        return rndc_response.stderr[message_index:].rstrip()
+
+    @spanned('add zone')
+    def _add_zone(self, zone_name):
+        """
+        Write the zone file and add the zone to named (but not to the
+        catalog zone). Returns a tuple of form: (boolean, string)
+        """
+        if not self.zone_is_valid(zone_name):
+            return (False, 'Not a valid zone name. Check configuration.')
+        empty_zone_file = self.SKELETON_ZONE.format(zone=zone_name, ns1=self.info['dns'][0],
+                                                    ns2=self.info['dns'][1],
+                                                    owner=self.info['owner'],
+                                                    serial=self.info['serial'])
+        file_name = self.write_zone_file(zone_name, empty_zone_file)
+        if not file_name:
+            return (False, 'Unable to place zone file in named directory. Check permissions.')
+        add_commands = 'addzone ' + zone_name + ' '
+        if self.info['view']:
+            add_commands += 'IN ' + self.info['view'] + ' '
+        add_commands += ' { type master; file "' + file_name + '"; '
+        for opt_line in self.info['options']:
+            add_commands += opt_line + ' '
+        add_commands += "};"
+        logging.debug('rndc command: %s', add_commands)
+        add_response = self.call([add_commands])
+        if add_response.returncode == 0:
+            logging.debug('Zone %s added successfully', zone_name)
+            self._zone_changed(zone_name, True)
+            return (True, add_response.stdout)
+        logging.debug('Zone %s add failed: %s', zone_name, add_response.stderr)
+        return (False, self._rndc_error(add_response))
+
+    def add_zones(self, zone_names, progress=None):
+        """
+        Add each of the requested zones. The zone files are written and
+        the zones added to named up to self.jobs at a time, then all of
+        the added zones are put in the catalog zone with one update.
+        Returns a list (in the order of zone_names) of tuples of form:
+            (zone_name, boolean, string)
+        with the same meaning as the tuple returned by add.
+        progress (if given) is called as each zone is added, see _run_all.
+        """
+        zone_results = self._run_all(self._add_zone, zone_names, progress)
+        results = [[zone_name] + list(result) for (zone_name, result)
+                   in zip(zone_names, zone_results)]
+        added = [x[0] for x in results if x[1]]
+        if self.info['catalog'] and added:
+            (success, message) = self.add_to_catalog(added)
+            for result in results:
+                if not result[1]:
+                    continue
+                if success:
+                    result[2] = '%s zone and catalog file added successfully' % result[0]
+                else:
+                    result[1:] = [False, '%s zone added but catalog add failed: %s'
+                                  % (result[0], message)]
+        return [tuple(x) for x in results]
+
+    def add(self, zone_name):
+        """
+        Add the requested zone
+        Returns a tuple of form: (boolean, string)
+        If the add was successful, boolean is True and string is rndc stdout (probably empty)
+        If the add failed, boolean is False and string is rndc stderr
+        """
+        return self.add_zones([zone_name])[0][1:]
+
+    @spanned('delete zone')
+    def _delete_zone(self, zone_name):
+        """
+        Remove the zone from named (but not from the catalog zone)
+        Returns a tuple of form: (boolean, string)
+        """
+        if not self.zone_is_valid(zone_name):
+            return (False, 'Not a valid zone name. Check configuration.')
+        del_commands = 'delzone ' + zone_name
+        del_response = self.call([del_commands])
+        if del_response.returncode == 0:
+            logging.debug('Zone %s removed successfully', zone_name)
+            self._zone_changed(zone_name, False)
+            return (True, del_response.stdout)
+        logging.debug('Zone %s delete failed: %s', zone_name, del_response.stderr)
+        return (False, self._rndc_error(del_response))
+
+    def delete_zones(self, zone_names, progress=None):
+        """
+        Delete each of the requested zones, up to self.jobs at a time,
+        then remove all of them from the catalog zone with one update.
+        Returns a list (in the order of zone_names) of tuples of form:
+            (zone_name, boolean, string)
+        with the same meaning as the tuple returned by delete.
+        progress (if given) is called as each zone is deleted, see _run_all.
+        """
+        zone_results = self._run_all(self._delete_zone, zone_names, progress)
+        results = [[zone_name] + list(result) for (zone_name, result)
+                   in zip(zone_names, zone_results)]
+        deleted = [x[0] for x in results if x[1]]
+        if self.info['catalog'] and deleted:
+            (success, message) = self.delete_from_catalog(deleted)
+            for result in results:
+                if not result[1]:
+                    continue
+                if not success:
+                    result[1:] = [False, '%s removed but catalog delete failed: %s'
+                                  % (result[0], message)]
+                elif not self.delete_zone_file(result[0]):
+                    result[2] = ('%s and catalog entry removed, unable to delete zone file'
+                                 % result[0])
+                else:
+                    result[2] = '%s and catalog entry removed successfully' % result[0]
+        return [tuple(x) for x in results]
+
+    def delete(self, zone_name):
+        """
+        Delete the requested zone
+        Returns a tuple of form: (boolean, string)
+        If the delete was successful, boolean is True and string is empty (or unimportant)
+        If the delete failed, boolean is False and string holds error message
+
+        A decision was made to return True if the zone file could not be removed,
+        as that does not affect the DNS service (it is a housekeeping issue). The
+        string message will indicate if that is the case.
+        """
+        return self.delete_zones([zone_name])[0][1:]
+
+    def add_to_catalog(self, zone_name):
+        """
+        Use nsupdate to modify the catalog zone file
+        (zone_name can be a list of zones, added with one update)
+        """
+        return self.my_nsupdate.add_zone(self.info['catalog'], zone_name)
+
+    def delete_from_catalog(self, zone_name):
+        """
+        Use nsupdate to remove the domain from the catalog zone file
+        (zone_name can be a list of zones, removed with one update)
+        """
+        return self.my_nsupdate.delete_zone(self.info['catalog'], zone_name)
+
+    @spanned('write zone file')
+    def write_zone_file(self, zone_name, zone_file):
+        """
+        Attempt to write file to named zone file directory, and
+        set appropriate owner/group and read/write permissions.
+        Return the name of the file if successfully written.
+        """
+        file_path = self.info['namedir'] + zone_name + '.db'
+        try:
+            uid = pwd.getpwnam(self.info['nameown']).pw_uid
+            gid = grp.getgrnam(self.info['namegrp']).gr_gid
+            with open(file_path, 'w') as z_file:
+                z_file.write(zone_file)
+            os.chown(file_path, uid, gid)
+            os.chmod(file_path, self.info['nameper'])
+        except (KeyError, OSError, IOError) as io_os_err:
+            logging.debug('Error in writing zone file %s', io_os_err)
+            return None
+        #return file_path
+        return zone_name + '.db'
+
+    def delete_zone_file(self, zone_name):
+        """
+        Return boolean on success of zone file removal
+        """
+        file_path = self.info['namedir'] + zone_name + '.db'
+        try:
+            os.remove(file_path)
+        except (OSError, IOError) as io_os_err:
+            logging.debug('Error in deleting zone file %s: %s', file_path, io_os_err)
+            return False
+        return True
+
+    def zone_is_valid(self, zone_name):
+        """
+        Returns True if zone is not part of protect list
+        and meets at least one of the criteria of require
+        list. Otherwise, returns False.
+        """
+        for protect_zone in self.info['protect']:
+            logging.debug('Checking zone %s against protected zone %s', zone_name, protect_zone)
+            if zone_name == protect_zone:
+                logging.debug('Zone %s is protected. Ignoring request.', zone_name)
+                return False
+        for req_name in self.info['require']:
+            logging.debug('Checking zone %s against required string %s', zone_name, req_name)
+            if zone_name.endswith(req_name):
+                logging.debug('Zone %s meets requirements and is valid', zone_name)
+                return True
+        logging.debug('Zone %s does not meet substring requirements. Ignoring request.', zone_name)
+        return False
+
+class ZoneSnapshot:
+    """
+    The A, CNAME and PTR records of a zone, read with one zone transfer,
+    for checking many changes to the zone without a lookup for each (see
+    RecordImport). The changes made by the import are recorded with add
+    and remove, so the snapshot stays current without another transfer.
+    complete is False if the transfer did not finish (for example, if
+    it was refused), in which case the snapshot is not to be used.
+    """
+
+    def __init__(self, dig_instance, zone_name):
+        self.zone_name = zone_name
+        self.records = {}
+        soa_count = 0
+        with Span('snapshot zone'):
+            for record in dig_instance._transfer(zone_name):
+                fields = record.split(None, 4)
+                if len(fields) < 5:
+                    continue
+                if fields[3] == 'SOA':
+                    soa_count += 1
+                elif fields[3] in ('A', 'CNAME', 'PTR'):
+                    self.add(fields[0], fields[3], fields[4])
+        # A complete transfer starts and ends with the zone SOA
+        self.complete = soa_count > 1
+        logging.debug('Snapshot of zone %s has %d names', zone_name, len(self.records))
+
+    @staticmethod
+    def key(name):
+        """
+        Names (and CNAME and PTR values) are kept lower case, without the
+        trailing dot
+        """
+        return name.strip().lower().rstrip('.')
+
+    def lookup(self, name):
+        """
+        Return the records of name, as a tuple of (type, value) tuples
+        """
+        return self.records.get(self.key(name), ())
+
+    def add(self, name, record_type, value):
+        """
+        Record that name has a record of record_type for value
+        """
+        if record_type != 'A':
+            value = self.key(value)
+        name = self.key(name)
+        records = self.records.get(name, ())
+        if (record_type, value) not in records:
+            self.records[name] = records + ((record_type, value),)
+
+    def remove(self, name, record_type=None, value=None):
+        """
+        Record that the records of name (only those of record_type, and
+        for value, if given) were removed
+        """
+        name = self.key(name)
+        if value is not None and record_type != 'A':
+            value = self.key(value)
+        records = tuple(x for x in self.records.get(name, ())
+                        if (record_type and x[0] != record_type)
+                        or (value is not None and x[1] != value))
+        if records:
+            self.records[name] = records
+        else:
+            self.records.pop(name, None)
+
+class RecordImport:
+    """
+    Adds host (A and PTR) and alias (CNAME) records in bulk, for the
+    import command. Records are read batch_size at a time and checked
+    against a snapshot of each zone they are in (see ZoneSnapshot),
+    made with one zone transfer the first time the zone is used and
+    kept for the rest of the import. The changes for each zone are
+    then sent together, in updates of at most maxbatch records, each
+    update being one transaction (see NSUpdate._send_batches).
+    A record that already exists as given is not changed, so importing
+    the same records again (such as after an interruption) is safe.
+    """
+
+    # Message of the records that were already there
+    EXISTS = 'Already exists'
+
+    def __init__(self, nsupdate_instance, batch_size=5000, force=False, expire=86400):
+        self.nsupdate = nsupdate_instance
+        self.dig = nsupdate_instance.dig
+        self.batch_size = max(int(batch_size), 1)
+        self.force = force
+        self.expire = expire
+        self.snapshots = {}
+
+    @staticmethod
+    def parse_record(record, force=False):
+        """
+        Return a tuple of form (name, value, force) for a record (dict) of
+        the import, which is either a host (fqdn and addr, which is
+        an address or a list of them, separated by '|' or spaces in CSV)
+        or an alias (alias and real), with an optional force (force is
+        used if it is not given). value is the list of addresses of a
+        host, or the real name of an alias. Raises ValueError if the
+        record is not valid.
+        """
+        if record.get('force') not in (None, ''):
+            force = record['force']
+            if isinstance(force, str):
+                force = force.strip().lower() in ('1', 'true', 'yes')
+        if record.get('alias') or record.get('real'):
+            if not (record.get('alias') and record.get('real')):
+                raise ValueError('alias and real are required')
+            return (str(record['alias']).strip(), str(record['real']).strip(), bool(force))
+        if not (record.get('fqdn') and record.get('addr')):
+            raise ValueError('fqdn and addr (or alias and real) are required')
+        addrs = record['addr']
+        if isinstance(addrs, str):
+            addrs = addrs.replace('|', ' ').split()
+        addrs = [str(ipaddress.ip_address(str(x).strip())) for x in addrs]
+        return (str(record['fqdn']).strip(), addrs, bool(force))
+
+    def _snapshot(self, name):
+        """
+        Return the ZoneSnapshot of the zone of name, or None if there is
+        no (complete) snapshot of it
+        """
+        zone_name = self.nsupdate._zone_of(name)
+        if zone_name is None:
+            return None
+        if zone_name not in self.snapshots:
+            snapshot = ZoneSnapshot(self.dig, zone_name)
+            self.snapshots[zone_name] = snapshot if snapshot.complete else None
+        return self.snapshots[zone_name]
+
+    def _existing(self, name, record_types, lookup=None):
+        """
+        Return the list of (type, value) records of name of record_types,
+        from the snapshot of its zone, or if there is none, by looking
+        up lookup (the address of a PTR record) or name
+        """
+        snapshot = self._snapshot(name)
+        if snapshot is not None:
+            return [x for x in snapshot.lookup(name) if x[0] in record_types]
+        found = []
+        for answer in self.dig.find_record(lookup or name) or []:
+            fields = answer.split(None, 4)
+            if len(fields) == 5 and fields[3] in record_types:
+                found.append((fields[3], fields[4] if fields[3] == 'A'
+                              else ZoneSnapshot.key(fields[4])))
+        return found
+
+    def _change(self, changes, undo=False):
+        """
+        Record changes, a list of tuples of form (add, name, type, value),
+        in the snapshots (or undo them, for changes that failed)
+        """
+        for (add, name, record_type, value) in changes:
+            snapshot = self._snapshot(name)
+            if snapshot is None:
+                continue
+            if add != undo:
+                snapshot.add(name, record_type, value)
+            else:
+                snapshot.remove(name, record_type, value)
+
+    def _replace(self, name, existing, lookup=None):
+        """
+        Delete the existing records of name (for force), returning a
+        tuple of form (boolean, list of changes for _change)
+        """
+        (del_status, del_message) = self.nsupdate.delete_record(lookup or name, True)
+        # Deleting an A record also deletes the PTR records for it
+        if not del_status and del_message != 'Record does not exist':
+            return (False, 'Error deleting existing: ' + del_message)
+        changes = [(False, name, None, None)]
+        for (record_type, value) in existing:
+            if record_type == 'A':
+                changes.append((False, ipaddress.ip_address(value).reverse_pointer, 'PTR',
+                                name))
+            elif record_type == 'PTR':
+                changes.append((False, value, 'A', lookup))
+        self._change(changes)
+        return (True, None)
+
+    def _plan_host(self, fqdn, addrs, force):
+        """
+        Check a host against the snapshots. Returns a tuple of form
+        (boolean|None, message, plan), where the boolean is None if the
+        records are to be added, and plan is a tuple of form (name,
+        commands, reverse, changes) (see NSUpdate._iter_groups)
+        """
+        existing = self._existing(fqdn, ('A', 'CNAME'))
+        reverse = [(ipaddress.ip_address(x).reverse_pointer, x) for x in addrs]
+        ptrs = [self._existing(ptr, ('PTR',), addr) for (ptr, addr) in reverse]
+        key = ZoneSnapshot.key(fqdn)
+        if (sorted(existing) == sorted(('A', x) for x in addrs)
+                and all(x == [('PTR', key)] for x in ptrs)):
+            return (True, self.EXISTS, None)
+        conflicts = [(fqdn, existing, None)] if existing else []
+        conflicts.extend((ptr, found, addr) for ((ptr, addr), found) in zip(reverse, ptrs)
+                         if found)
+        if conflicts and not force:
+            return (False, 'Existing record found for %s, use force to replace'
+                    % ', '.join(x[2] or x[0] for x in conflicts), None)
+        for (name, found, addr) in conflicts:
+            (success, message) = self._replace(name, found, addr)
+            if not success:
+                return (False, message, None)
+        commands = ['update add %s %s a %s' % (fqdn, self.expire, x) for x in addrs]
+        rev_name = fqdn if fqdn.endswith('.') else fqdn + '.'
+        ptr_commands = [(ptr, 'update add %s %s ptr %s' % (ptr, self.expire, rev_name))
+                        for (ptr, _) in reverse]
+        changes = ([(True, fqdn, 'A', x) for x in addrs]
+                   + [(True, ptr, 'PTR', fqdn) for (ptr, _) in reverse])
+        return (None, None, (fqdn, commands, ptr_commands, changes))
+
+    def _plan_alias(self, alias_name, real_name, force):
+        """
+        Check an alias against the snapshots, returning a tuple as
+        _plan_host does
+        """
+        existing = self._existing(alias_name, ('A', 'CNAME'))
+        if existing == [('CNAME', ZoneSnapshot.key(real_name))]:
+            return (True, self.EXISTS, None)
+        if not self._existing(real_name, ('A', 'CNAME')):
+            return (False, 'Real record %s does not exist' % real_name, None)
+        if existing:
+            if not force:
+                return (False, 'Existing CNAME record found, use force to replace', None)
+            (success, message) = self._replace(alias_name, existing)
+            if not success:
+                return (False, message, None)
+        commands = ['update add %s %s cname %s' % (alias_name, self.expire, real_name)]
+        return (None, None, (alias_name, commands, [], [(True, alias_name, 'CNAME',
+                                                         real_name)]))
+
+    def run(self, records):
+        """
+        Import records, an iterable of tuples of form (line, record),
+        record being a dict (see parse_record) or a string saying why
+        the line is not valid. Yields a tuple of form (line, name,
+        boolean, None|string) for each record as its result is known.
+        """
+        batch = []
+        for item in records:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                yield from self._run_batch(batch)
+                batch = []
+        if batch:
+            yield from self._run_batch(batch)
+
+    def _run_batch(self, batch):
+        """
+        Import a batch of records (see run)
+        """
+        results = []
+        planned = []
+        plans = {}
+        with Span('check records'):
+            for (line, record) in batch:
+                if not isinstance(record, dict):
+                    results.append((line, None, False, str(record)))
+                    continue
+                name = record.get('fqdn') or record.get('alias')
+                try:
+                    (name, value, force) = self.parse_record(record, self.force)
+                    if isinstance(value, list):
+                        (success, message, plan) = self._plan_host(name, value, force)
+                    else:
+                        (success, message, plan) = self._plan_alias(name, value, force)
+                except ValueError as val_err:
+                    (success, message, plan) = (False, 'Invalid record: %s' % val_err, None)
+                if plan is None:
+                    results.append((line, name, success, message))
+                    continue
+                # Later records of the batch are checked with this one added
+                self._change(plan[3])
+                plans[line] = plan
+                planned.append((line,) + plan[:3])
+        yield from results
+        for (line, success, message) in self.nsupdate._iter_groups(
+                planned, 'A record added, PTR record not: %s'):
+            if not success:
+                self._change(plans[line][3], undo=True)
+            yield (line, plans[line][0], success, message)
+
+class Backends:
+    """
+    Creates the DigQuery, NSUpdate and RNDC instances for an mmbop
+    configuration when each is first used, so that a command (or API
+    worker) only sets up the backends it needs, and starting up does
+    not wait on BIND. If check is True the RNDC instance is made with
+    RNDC.create, which makes sure BIND can be reached.
+    """
+
+    def __init__(self, config, check=True):
+        self.config = dict(config)
+        self.check = check
+        self._dig = None
+        self._nsupdate = None
+        self._rndc = None
+        self.lock = threading.RLock()
+
+    @property
+    def dig(self):
+        """
+        The DigQuery instance
+        """
+        with self.lock:
+            if self._dig is None:
+                self._dig = DigQuery.create(**self.config)
+            return self._dig
+
+    @property
+    def nsupdate(self):
+        """
+        The NSUpdate instance (sharing the DigQuery instance)
+        """
+        with self.lock:
+            if self._nsupdate is None:
+                self._nsupdate = NSUpdate.create(**dict(self.config, dig=self.dig))
+            return self._nsupdate
+
+    @property
+    def rndc(self):
+        """
+        The RNDC instance (sharing the DigQuery and NSUpdate instances)
+        """
+        with self.lock:
+            if self._rndc is None:
+                factory = RNDC.create if self.check else RNDC
+                self._rndc = factory(**dict(self.config, dig=self.dig, nsupdate=self.nsupdate))
+            return self._rndc
+
+    def created(self):
+        """
+        Return the list of the backends created so far
+        """
+        return [name for (name, backend) in (('dig', self._dig), ('nsupdate', self._nsupdate),
+                                             ('rndc', self._rndc)) if backend is not None]
+
+class StatusCheck:
+    """
+    The result of the last 'rndc status' connectivity check, so that it
+    can be reported (see the /healthz route of the API) without waiting
+    on BIND. The check is made again every refresh_interval seconds by
+    a background thread (if refresh_interval is not 0). It uses its own
+    RNDCControl, so it does not set up (or wait on) the backends.
+    """
+
+    def __init__(self, backends, refresh_interval=0):
+        self.backends = backends
+        self.control = None
+        self.reachable = None
+        self.error = None
+        self.checked = None
+        self.lock = threading.Lock()
+        self.refresh_interval = float(refresh_interval)
+        if self.refresh_interval > 0:
+            refresher = threading.Thread(target=self._refresh_loop, daemon=True,
+                                         name='mmbop-status-check')
+            refresher.start()
+
+    def _refresh_loop(self):
+        """
+        Background thread, checking every refresh_interval seconds
+        """
+        while True:
+            self.check()
+            sleep(self.refresh_interval)
+
+    def check(self):
+        """
+        Run 'rndc status', returning True if BIND answered
+        """
+        error = None
+        try:
+            if self.control is None:
+                self.control = RNDCControl(**self.backends.config)
+            status = self.control.status(True)
+            if status is not True:
+                error = status.strip()
+        except RNDCError as rndc_err:
+            error = str(rndc_err)
+        if error:
+            logging.debug('Status check failed: %s', error)
+        with self.lock:
+            self.reachable = error is None
+            self.error = error
+            self.checked = time()
+        return error is None
+
+    def state(self):
+        """
+        Return a dict of the last result: reachable (None if no check has
+        been made yet), error, and age (seconds since the check)
+        """
+        with self.lock:
+            age = None
+            if self.checked is not None:
+                age = round(time() - self.checked, 3)
+            return {'reachable': self.reachable, 'error': self.error, 'age': age}
+
+# The longest request line the daemon reads
+MAX_COMMAND_BYTES = 65536
+# Options and commands that are always run by the CLI itself, rather
+# than sent to the daemon (mmbop.py keeps the same lists, as words)
+LOCAL_OPTIONS = ('verbose', 'config', 'jobs', 'profile', 'cprofile')
+LOCAL_COMMANDS = (None, 'serve', 'import')
+
+class CommandHandler(socketserver.StreamRequestHandler):
+    """
+    Runs one command for the mmbop daemon (see serve). The request is a
+    line of the command line words, quoted as for a shell (such as
+    "hostadd www.example.com 10.1.2.3"), and the reply is the output of
+    the command, then a last line of a NUL character and the exit
+    status the command would have had (such as "\\x000\\n"). The
+    connection is closed once the command is done.
+    """
+
+    # Output is sent as the buffer fills, rather than a line at a time
+    wbufsize = 65536
+
+    def handle(self):
+        out = io.TextIOWrapper(self.wfile, encoding='utf-8')
+        try:
+            status = self.run(self.rfile.readline(MAX_COMMAND_BYTES).decode('utf-8', 'replace'),
+                              out)
+            out.write('\0%d\n' % status)
+            out.flush()
+        except OSError as os_err:
+            logging.debug('Unable to send the reply: %s', os_err)
+
+    def run(self, line, out):
+        """
+        Run the command of the request line, writing its output to out.
+        Returns the exit status: 0, 1 if the command failed with an
+        exception (as the CLI would, after the traceback) or 2 if the
+        request is not a command the daemon runs.
+        """
+        try:
+            my_args = parse_arguments(shlex.split(line))
+        except (ValueError, SystemExit):
+            # argparse exits on invalid arguments (after printing the usage)
+            my_args = None
+        if not my_args or my_args.command in LOCAL_COMMANDS or any(
+                getattr(my_args, x) != argument_parser().get_default(x) for x in LOCAL_OPTIONS):
+            print('Error: invalid command: %s' % line.strip(), file=out)
+            return 2
+        logging.debug('Running command: %s', line.strip())
+        try:
+            run_command(my_args, self.server.backends, out)
+        except (DigQueryError, NSUpdateError, RNDCError) as backend_err:
+            print('Error: ' + str(backend_err), file=out)
+            return 1
+        except Exception as command_err:  # pylint: disable=broad-except
+            logging.exception('Command failed: %s', line.strip())
+            print('Error: %s' % (str(command_err) or command_err.__class__.__name__), file=out)
+            return 1
+        return 0
+
+class CommandServer(socketserver.ThreadingUnixStreamServer):
+    """
+    The Unix socket server of the mmbop daemon, running each command in
+    its own thread with the shared backends (a Backends)
+    """
+
+    daemon_threads = True
+
+    def __init__(self, path, backends):
+        self.backends = backends
+        super().__init__(path, CommandHandler)
+
+def read_config(conf_file='./mmbop.ini'):
+    """
+    Import the mmbop configuration file as a ConfigParser
+    object and return it as a real dictionary
+    """
+    config = configparser.ConfigParser()
+    try:
+        config.read(conf_file)
+        config = ensure_defaults(config)
+        return config_to_dict(config)
+    except IOError as io_err:
+        logging.debug('Error reading config file: %s', io_err)
+    return None
+
+def ensure_defaults(config):
+    """
+    Make sure the required values (server, port, key) are
+    specified in the ConfigParser object
+    """
+    default_section = 'RNDC'
+    default_values = {'server': '127.0.0.1',
+                      'port': '953',
+                      'keyfile': '/etc/bind/rndc.key'}
+    if not config.has_section(default_section):
+        config.add_section(default_section)
+    for req_key in default_values:
+        if req_key not in config.options(default_section):
+            config.set(default_section, req_key, default_values[req_key])
+    logging.debug('Configuration: %s', print_config(config))
+    return config
+
+def config_to_dict(config_parser_obj):
+    """
+    While a ConfigParser object is close to a dictionary, it
+    isn't one. This collapses the sections (flattens the keys)
+    and converts it to a dictionary, while also converting
+    multiple values into a list
+    """
+    conf_dict = {}
+    for section in config_parser_obj.sections():
+        for item in config_parser_obj.options(section):
+            if item == 'https':
+                item_value = config_parser_obj[section].getboolean(item)
+            else:
+                item_value = config_parser_obj[section][item]
+                if '|' in item_value:
+                    item_value = item_value.split('|')
+            conf_dict[item] = item_value
+    return conf_dict
+
+def print_config(config_parser_obj):
+    """
+    Helper function to return all of the configuration
+    values as a string, for debugging
+    """
+    conf_list = []
+    for section in config_parser_obj.sections():
+        for key in config_parser_obj[section]:
+            conf_list.append(section + ':' + key + ':' + config_parser_obj[section][key])
+    return " ".join(conf_list)
+
+@functools.lru_cache(maxsize=None)
+def argument_parser():
+    """
+    Uses argparse to define the command-line arguments. The parser is
+    made once, as the daemon (see serve) parses every command it runs.
+    """
+    help_width = lambda prog: argparse.HelpFormatter(prog, max_help_position=34)
+    desc = 'mmbop manages BIND over Python'
+    parser = argparse.ArgumentParser(description=desc, formatter_class=help_width)
+    parser.add_argument('-v', '--verbose', action='store_true', help='Enable verbose messages')
+    parser.add_argument('-c', '--config', metavar='FILE', help='Location of config file',
+                        default='./mmbop.ini')
+    parser.add_argument('-j', '--jobs', metavar='N', type=int,
+                        help='Most DNS lookups or zone changes to run at once '
+                        '(default: jobs in config, or 8)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Print how long each step of the command took')
+    parser.add_argument('--cprofile', metavar='FILE',
+                        help='Run the command under cProfile, saving the stats to FILE '
+                        '(- to print the slowest functions)')
+    parser.add_argument('-s', '--socket', metavar='PATH',
+                        help='Send the command to the mmbop daemon listening on PATH, if '
+                        'there is one (default: socket in config)')
+    #
+    subparsers = parser.add_subparsers(title='commands', description='DNS actions', dest='command',
+                                       help='add -h after command for additional information')
+    #
+    parser_status = subparsers.add_parser('status', help='Return status of BIND')
+    #
+    parser_query = subparsers.add_parser('query', help='Query for name or IP')
+    parser_query.add_argument('entry', metavar='FQDN|IP', help='Name or IP to search for')
+    parser_query.add_argument('--strict', action='store_true', help='Return name or IP only')
+    #
+    parser_hadd = subparsers.add_parser('hostadd', help='Add an A and PTR record')
+    parser_hadd.add_argument('fqdn', help='fully qualified domain name')
+    parser_hadd.add_argument('addr', nargs='+', help='One or more IP addresses')
+    parser_hadd.add_argument('--force', action='store_true',
+                             help='Replace any existing records, if they exist')
+    parser_hadd.add_argument('--range', metavar='N',
+                             help='Create N entries, incrementing fqdn by starting index')
+    #
+    parser_alias = subparsers.add_parser('alias', help='Add a CNAME record')
+    parser_alias.add_argument('alias', help='fully qualified alias name')
+    parser_alias.add_argument('real', help='fully qualified real name that alias will refer to')
+    parser_alias.add_argument('--force', action='store_true',
+                              help='Replace any existing records, if they exist')
+    #
+    parser_hdel = subparsers.add_parser('hostdel', help='Remove CNAME or A and PTR record')
+    parser_hdel.add_argument('entry', metavar='fqdn|addr', help='Either FQDN or IP')
+    parser_hdel.add_argument('--force', action='store_true',
+                             help='Remove associated aliases, if they exist')
+    parser_hdel.add_argument('--range', metavar='N',
+                             help='Delete N entries, incrementing fqdn by starting index')
+    #
+    parser_hlist = subparsers.add_parser('hostlist', help='Show all records for zone')
+    parser_hlist.add_argument('zone')
+    #
+    parser_hsearch = subparsers.add_parser('hostsearch', help='Wildcard search of a zone')
+    parser_hsearch.add_argument('zone', nargs='?')
+    parser_hsearch.add_argument('search', nargs='?')
+    parser_hsearch.add_argument('--reverse', action='store_true',
+                                help='Negate search, returning records that do not match')
+    parser_hsearch.add_argument('--range', metavar='CIDR|START-END',
+                                help='Instead, return the PTR records for an address range')
+    #
+    parser_zadd = subparsers.add_parser('zoneadd', help='Add one or more zones')
+    parser_zadd.add_argument('zone', nargs='+')
+    #
+    parser_zdel = subparsers.add_parser('zonedel', help='Remove one or more zones')
+    parser_zdel.add_argument('zone', nargs='+')
+    #
+    parser_zlist = subparsers.add_parser('zonelist', help='Show all zones')
+    #
+    parser_zstatus = subparsers.add_parser('zonestatus', help='Show status of a zone')
+    parser_zstatus.add_argument('zone')
+    #
+    parser_import = subparsers.add_parser('import', help='Add host and alias records from a '
+                                          'CSV or NDJSON file')
+    parser_import.add_argument('file', metavar='FILE', help='File to read (- for stdin)')
+    parser_import.add_argument('--format', choices=('csv', 'ndjson'),
+                               help='Format of FILE (default: found from the first line)')
+    parser_import.add_argument('--force', action='store_true',
+                               help='Replace any existing records, if they exist')
+    parser_import.add_argument('--log', metavar='FILE',
+                               help='Write the result of each record to FILE (as NDJSON)')
+    parser_import.add_argument('--resume', action='store_true',
+                               help='Skip the records that succeeded in the --log file')
+    parser_import.add_argument('--batch', metavar='N', type=int, default=5000,
+                               help='Records checked and sent together (default: 5000)')
+    #
+    parser_serve = subparsers.add_parser('serve', help='Run commands sent over a Unix socket')
+    parser_serve.add_argument('--socket', metavar='PATH', dest='listen',
+                              help='Socket to listen on (default: socket in config)')
+    return parser
+
+def parse_arguments(argv=None):
+    """
+    Parse the command-line arguments (argv, or those of the script if None)
+    """
+    parser = argument_parser()
+    args = parser.parse_args(argv)
+    if args.command == 'hostsearch':
+        if args.range and args.zone:
+            parser.error('zone and search are not used with --range')
+        if not (args.range or args.search):
+            parser.error('zone and search are required (unless --range is used)')
+    if args.command == 'import':
+        if args.resume and not args.log:
+            parser.error('--resume needs --log')
+        if args.batch < 1:
+            parser.error('--batch must be at least 1')
+    return args
+
+def set_logging(debug_flag=False):
+    """
+    Set logging to either DEBUG or INFO
+    """
+    if debug_flag:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+def query(dig_instance, host_to_query, strict_mode, out=sys.stdout):
+    """
+    Handle query request
+    """
+    replies = dig_instance.find_record(host_to_query, strict_mode)
+    for line in replies:
+        print(line, file=out)
+
+def zonelist(rndc_instance, out=sys.stdout):
+    """
+    Handle zonelist request
+    """
+    zones = rndc_instance.list_zones()
+    for zone in zones or []:
+        print(zone, file=out)
+
+def zonemodify(rndc_instance, zones_to_modify, delete=False, out=sys.stdout):
+    """
+    Handle zoneadd and zonedelete request (for one or more zones)
+    """
+    if isinstance(zones_to_modify, str):
+        zones_to_modify = [zones_to_modify]
+    action = 'Add'
+    if delete:
+        action = 'Deletion'
+        results = rndc_instance.delete_zones(zones_to_modify)
+    else:
+        results = rndc_instance.add_zones(zones_to_modify)
+    for (zone_to_modify, success, message) in results:
+        if not success:
+            print('%s of zone %s failed: %s' % (action, zone_to_modify, message), file=out)
+        else:
+            print('%s of zone %s succeeded' % (action, zone_to_modify), file=out)
+
+def rangesearch(dig_instance, address_range, out=sys.stdout):
+    """
+    Handle hostsearch --range request, printing the PTR records in
+    address order
+    """
+    try:
+        records = dig_instance.iter_range(address_range)
+    except ValueError as val_err:
+        print('Error: ' + str(val_err), file=out)
+        return
+    for entry in records:
+        print(entry, file=out)
+
+def hostlist(dig_instance, search_zone, search_term=None, reverse=False, out=sys.stdout):
+    """
+    Handle hostlist request, returning on A/CNAME/PTR records
+    """
+    if search_term:
+        zone_records = dig_instance.iter_domain(search_zone, search_term, reverse)
+    else:
+        zone_records = dig_instance.hostlist(search_zone)
+    for entry in zone_records:
+        print(entry, file=out)
+
+def get_index_from_fqdn(fqdn):
+    """
+    Given a fully qualified domain name, extract the starting
+    index at the end of the shortname, if it exists, and return
+    a three-valued tuple of the form:
+        (shortname [minus the starting index], domain, starting_index)
+    starting_index is a string, to preserve the zero padding.
+    If the fqdn is malformed, return tuple filled with None.
+    """
+    try:
+        (shortname, domain) = fqdn.split('.', 1)
+    except ValueError:
+        logging.debug('FQDN not provided')
+        return (None, None, None)
+    starting_index = ''
+    for c_name in reversed(shortname):
+        if not c_name.isdigit():
+            break
+        starting_index = c_name + starting_index
+    if not starting_index:
+        logging.debug('No index marker found on name %s', fqdn)
+        return (None, None, None)
+    name_minus_index = shortname.rsplit(starting_index, 1)[0]
+    if not name_minus_index:
+        logging.debug('%s only consists of numbers, invalid for indexing', fqdn)
+        return (None, None, None)
+    logging.debug('shortname: %s, domain: %s, index: %s', name_minus_index,
+                  domain, starting_index)
+    return (name_minus_index, domain, starting_index)
+
+@spanned('hostdel range')
+def hostdel_range(ns_instance, start_fqdn, num_entries, force=False):
+    """
+    Given a starting name, delete num_entries, incrementing the
+    index in the name by 1.
+    Requires that the end of start_fqdn contains 1 or more integers. The number
+    of leading zeros will determine the padding. For example:
+        start_fqdn = host003.example.com num_entries = 3
+        will delete:
+            host003.example.com
+            host004.example.com
+            host005.example.com
+    The entries are not pre-checked; force is passed to the delete_record
+    method to handle that.
+    """
+    (short_name, dom_name, starting_index) = get_index_from_fqdn(start_fqdn)
+    if not short_name:
+        return (False, 'Unable to determine index for name')
+    index_num = int(starting_index)
+    entries = []
+    for i in range(int(num_entries)):
+        del_entry = short_name + str(i + index_num).zfill(len(starting_index)) + '.' + dom_name
+        logging.debug('Preparing to delete entry %s', del_entry)
+        entries.append(del_entry)
+    for entry in entries:
+        logging.debug('Requesting to delete record %s', entry)
+        (status, output) = ns_instance.delete_record(entry, force)
+        if not status:
+            logging.debug('Unable to delete record, canceling range delete')
+            return (status, output)
+    logging.debug('All entries in range deleted successfully')
+    return (True, None)
+
+def range_entries(start_fqdn, start_ip, num_entries):
+    """
+    Given a starting name and IP address, return a list of num_entries
+    tuples of form (fqdn, ip), incrementing the index in the name by 1
+    and the IP by 1 (see hostadd_range). Raises ValueError if the name
+    has no index or the IP is invalid.
+    """
+    (short_name, dom_name, starting_index) = get_index_from_fqdn(start_fqdn)
+    if not short_name:
+        raise ValueError('Unable to determine index for name')
+    try:
+        if not isinstance(start_ip, str) and isinstance(start_ip, list):
+            start_ip = start_ip[0]
+        addr_start = ipaddress.ip_address(start_ip)
+    except ValueError as addr_err:
+        raise ValueError('Invalid IP provided') from addr_err
+    index_num = int(starting_index)
+    entries = []
+    for i in range(int(num_entries)):
+        new_entry = (short_name + str(i + index_num).zfill(len(starting_index)) + '.' + dom_name,
+                     str(addr_start + i))
+        logging.debug('Preparing new entry %s', new_entry)
+        entries.append(new_entry)
+    return entries
+
+def parse_address_range(address_range):
+    """
+    Return a tuple of form (first, last) of the addresses (ipaddress)
+    of address_range, which is either a network in CIDR notation
+    (10.4.16.0/22), a range of form start-end (10.4.16.5-10.4.17.20)
+    or a single address. Raises ValueError if it is none of these.
+    """
+    address_range = address_range.strip()
+    if '/' in address_range:
+        network = ipaddress.ip_network(address_range, strict=False)
+        return (network.network_address, network.broadcast_address)
+    if '-' in address_range:
+        (first, last) = (ipaddress.ip_address(x.strip()) for x in address_range.split('-', 1))
+        if first.version != last.version or first > last:
+            raise ValueError('Range %s does not go from a lower to a higher address'
+                             % address_range)
+        return (first, last)
+    address = ipaddress.ip_address(address_range)
+    return (address, address)
+
+@spanned('hostadd range')
+def hostadd_range(ns_instance, start_fqdn, start_ip, num_entries, force=False):
+    """
+    Given a starting name and IP address, create num_entries, incrementing the
+    index in the name by 1 and the IP by 1.
+    Requires that the end of start_fqdn contains 1 or more integers. The number
+    of leading zeros will determine the padding. For example:
+        start_fqdn = host003.example.com start_ip = 192.168.5.34 num_entries = 3
+        will create:
+            host003.example.com 192.168.5.34
+            host004.example.com 192.168.5.35
+            host005.example.com 192.168.5.36
+    All of the entries will be pre-checked before creating, for conflict with
+    existing forward or reverse entries. The records are added in bulk (see
+    NSUpdate.add_records), and the message lists any entries that failed.
+    """
+    try:
+        entries = range_entries(start_fqdn, start_ip, num_entries)
+    except ValueError as val_err:
+        return (False, str(val_err))
+    results = ns_instance.add_records(entries, force, True)
+    failed = ['%s %s: %s' % (fqdn, ' '.join(addrs), message)
+              for (fqdn, addrs, success, message) in results if not success]
+    if failed:
+        logging.debug('%d of %d entries in range not added', len(failed), len(results))
+        return (False, '\n'.join(failed))
+    logging.debug('All entries in range added successfully')
+    return (True, None)
+
+def iter_import_file(import_file, import_format=None):
+    """
+    Generator of the records of an import file (an open text file), as
+    tuples of form (line, record). record is a dict, or a string saying
+    why the line is not valid. import_format is csv (with a header row
+    naming the columns) or ndjson, found from the first line if None.
+    """
+    first = import_file.readline()
+    if import_format is None:
+        import_format = 'ndjson' if first.lstrip().startswith('{') else 'csv'
+    lines = itertools.chain([first], import_file)
+    if import_format == 'csv':
+        reader = csv.DictReader(lines)
+        for row in reader:
+            yield (reader.line_num, row)
+        return
+    for (line_num, line) in enumerate(lines, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                record = 'Not a JSON object'
+        except ValueError as val_err:
+            record = 'Invalid JSON: %s' % val_err
+        yield (line_num, record)
+
+def read_import_log(log_file):
+    """
+    Return the set of the line numbers that succeeded in an import
+    result log. The log is rewritten to hold only those results, as the
+    failed lines are tried (and logged) again by the resumed import.
+    """
+    done = set()
+    if not os.path.exists(log_file):
+        return done
+    kept_file = log_file + '.tmp'
+    with open(log_file) as log, open(kept_file, 'w') as kept:
+        for log_line in log:
+            try:
+                result = json.loads(log_line)
+                if result['success'] is not True or result['line'] in done:
+                    continue
+            except (ValueError, KeyError, TypeError):
+                # Such as the last line of an interrupted import
+                continue
+            done.add(result['line'])
+            kept.write(log_line.rstrip('\n') + '\n')
+    os.replace(kept_file, log_file)
+    return done
+
+@spanned('import')
+def import_records(ns_instance, file_name, import_format=None, force=False, log_file=None,
+                   resume=False, batch_size=5000, out=sys.stdout):
+    """
+    Handle import request: add the records of file_name (- for stdin)
+    with RecordImport. The result of each record is written to log_file
+    as NDJSON, of form {line, name, success, message}, or if there is
+    no log, the failed records are printed. With resume, the records
+    whose lines succeeded in log_file are skipped (the failed ones are
+    tried again).
+    """
+    done = read_import_log(log_file) if resume else set()
+    counts = collections.Counter()
+    def pending(records):
+        for (line, record) in records:
+            if line in done:
+                counts['skipped'] += 1
+            else:
+                yield (line, record)
+    try:
+        import_file = sys.stdin if file_name == '-' else open(file_name, newline='')
+    except OSError as os_err:
+        print('Error: ' + str(os_err), file=out)
+        return
+    log = open(log_file, 'a' if resume else 'w', buffering=1) if log_file else None
+    try:
+        importer = RecordImport(ns_instance, batch_size, force)
+        for (line, name, success, message) in importer.run(
+                pending(iter_import_file(import_file, import_format))):
+            if not success:
+                counts['failed'] += 1
+            elif message == RecordImport.EXISTS:
+                counts['existing'] += 1
+            else:
+                counts['added'] += 1
+            if log:
+                log.write(json.dumps({'line': line, 'name': name, 'success': success,
+                                      'message': message}) + '\n')
+            elif not success:
+                print('Error: line %d (%s): %s' % (line, name, message), file=out)
+    finally:
+        if log:
+            log.close()
+        if import_file is not sys.stdin:
+            import_file.close()
+    print('%d added, %d already existed, %d failed, %d skipped'
+          % (counts['added'], counts['existing'], counts['failed'], counts['skipped']), file=out)
+
+def profile(my_args):
+    """
+    Run the command with tracing (--profile), printing the timing tree
+    to stderr, and/or under cProfile (--cprofile)
+    """
+    # Imported here, as they add to the start up time of every command
+    import cProfile  # pylint: disable=import-outside-toplevel
+    import pstats  # pylint: disable=import-outside-toplevel
+    trace = Trace(my_args.command or 'mmbop')
+    profiler = cProfile.Profile() if my_args.cprofile else None
+    try:
+        if profiler:
+            profiler.enable()
+        trace.run(run_command, my_args)
+    finally:
+        trace.finish()
+        if profiler:
+            profiler.disable()
+            if my_args.cprofile == '-':
+                pstats.Stats(profiler, stream=sys.stderr).sort_stats('cumulative').print_stats(25)
+            else:
+                profiler.dump_stats(my_args.cprofile)
+        if my_args.profile:
+            sys.stderr.write(trace.tree())
+
+def connect_daemon(path):
+    """
+    Return a socket connected to the mmbop daemon listening on path, or
+    None if there is none
+    """
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError as os_err:
+        logging.debug('No mmbop daemon on %s: %s', path, os_err)
+        client.close()
+        return None
+    return client
+
+def serve(my_args):
+    """
+    Handle serve request: run the commands sent to the socket (see
+    CommandHandler) until stopped, with one set of backends kept (with
+    their caches) for the life of the daemon
+    """
+    my_conf = read_config(my_args.config)
+    path = my_args.listen or my_conf.get('socket')
+    if not path:
+        print('Error: no socket to listen on (--socket, or socket in config)')
+        sys.exit(1)
+    if os.path.exists(path):
+        running = connect_daemon(path)
+        if running:
+            running.close()
+            print('Error: an mmbop daemon is already listening on ' + path)
+            sys.exit(1)
+        os.unlink(path)
+    backends = Backends(my_conf, check=False)
+    try:
+        # Set up (without contacting BIND) before taking commands
+        backends.rndc  # pylint: disable=pointless-statement
+    except (DigQueryError, NSUpdateError, RNDCError) as backend_err:
+        print('Error: ' + str(backend_err))
+        sys.exit(1)
+    # Only the owner and group of the daemon can send it commands
+    old_umask = os.umask(0o117)
+    try:
+        server = CommandServer(path, backends)
+    finally:
+        os.umask(old_umask)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    logging.info('Listening on %s', path)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(path)
+
+def main():
+    """
+    Direct calling function
+    """
+    my_args = parse_arguments()
+    set_logging(my_args.verbose)
+    if my_args.command == 'serve':
+        serve(my_args)
+    elif my_args.profile or my_args.cprofile:
+        profile(my_args)
+    else:
+        run_command(my_args)
+
+def run_command(my_args, backends=None, out=sys.stdout):
+    """
+    Run the command given on the command line, writing its output to
+    out. backends (a Backends) is created from the config file if None.
+    """
+    if backends is None:
+        my_conf = read_config(my_args.config)
+        if my_args.jobs:
+            my_conf['jobs'] = my_args.jobs
+        # Only the backends the command uses are created. The status command
+        # reports for itself whether BIND can be reached.
+        backends = Backends(my_conf, check=my_args.command != 'status')
+    if my_args.command == 'query':
+        query(backends.dig, my_args.entry, my_args.strict, out)
+    if my_args.command == 'status':
+        print(backends.rndc.status(), file=out)
+    if my_args.command == 'hostadd':
+        if my_args.range:
+            (success, message) = hostadd_range(backends.nsupdate, my_args.fqdn, my_args.addr,
+                                               my_args.range, my_args.force)
+        else:
+            (success, message) = backends.nsupdate.add_record(my_args.fqdn, my_args.addr,
+                                                              my_args.force)
+        if not success:
+            print('Error: ' + message, file=out)
+        elif message:
+            print(message, file=out)
+    if my_args.command == 'alias':
+        (success, message) = backends.nsupdate.add_alias(my_args.alias, my_args.real,
+                                                         my_args.force)
+        if not success:
+            print('Error: ' + message, file=out)
+        elif message:
+            print(message, file=out)
+    if my_args.command == 'hostdel':
+        if my_args.range:
+            (success, message) = hostdel_range(backends.nsupdate, my_args.entry,
+                                               my_args.range, my_args.force)
+        else:
+            (success, message) = backends.nsupdate.delete_record(my_args.entry, my_args.force)
+        if not success:
+            print('Error: ' + message, file=out)
+        elif message:
+            print(message, file=out)
+    if my_args.command == 'hostlist':
+        hostlist(backends.dig, my_args.zone, out=out)
+    if my_args.command == 'hostsearch':
+        if my_args.range:
+            rangesearch(backends.dig, my_args.range, out)
+        else:
+            hostlist(backends.dig, my_args.zone, my_args.search, my_args.reverse, out)
+    if my_args.command == 'zonestatus':
+        print(backends.rndc.zonestatus(my_args.zone), file=out)
+    if my_args.command == 'zonelist':
+        zonelist(backends.rndc, out)
+    if my_args.command == 'zoneadd':
+        zonemodify(backends.rndc, my_args.zone, out=out)
+    if my_args.command == 'zonedel':
+        zonemodify(backends.rndc, my_args.zone, True, out)
+    if my_args.command == 'import':
+        import_records(backends.nsupdate, my_args.file, my_args.format, my_args.force,
+                       my_args.log, my_args.resume, my_args.batch, out)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,466 @@
+"""
+Load test of the mmbop API, to size worker counts and find where
+the API saturates.
+
+The real APP of mmbop_api (or of mmbop_asgi) is run against the
+in-process stand-ins for BIND of mmbop_bench, either called directly
+(inprocess), or served on localhost by a threaded wsgiref server
+(wsgi) or by uvicorn (asgi, needs Falcon 3 and uvicorn). Client
+threads replay a mix of /query, /hostsearch, /hostmodify (adds and
+deletes) and /zonelist requests, at each of the concurrency levels.
+
+For every level and route it reports the requests made, the errors
+(status 400 and up), throughput, p50/p95/p99 latency and the peak
+resident memory of the process while requests for the route were
+in progress.
+
+Usage: python3 mmbop_loadtest.py [--server wsgi] [--concurrency 1,4,16]
+"""
+import argparse
+import collections
+import http.client
+import io
+import ipaddress
+import json
+import os
+import random
+import resource
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import wsgiref.simple_server
+import wsgiref.util
+from time import perf_counter, sleep
+import mmbop_bench
+
+# The token the load test authenticates with
+TOKEN = 'mmbop-loadtest'
+# Seconds between samples of the resident memory
+RSS_INTERVAL = 0.02
+OPERATIONS = ('query', 'hostsearch', 'hostadd', 'hostdel', 'zonelist')
+
+def current_rss():
+    """
+    The resident memory of the process, in bytes (the peak so far
+    where the current size cannot be read)
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+class InProcessClient:
+    """
+    Makes requests by calling the WSGI application directly
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def request(self, method, path, body=None):
+        """
+        Make a request, reading the whole reply. Returns the status code.
+        """
+        (path, _, query) = path.partition('?')
+        body = json.dumps(body).encode() if body is not None else b''
+        environ = {'REQUEST_METHOD': method,
+                   'PATH_INFO': path,
+                   'QUERY_STRING': query,
+                   'CONTENT_TYPE': 'application/json',
+                   'CONTENT_LENGTH': str(len(body)),
+                   'HTTP_AUTHORIZATION': TOKEN,
+                   'wsgi.input': io.BytesIO(body),
+                   'wsgi.multithread': True}
+        wsgiref.util.setup_testing_defaults(environ)
+        status = []
+        def start_response(status_line, _headers, _exc_info=None):
+            status.append(int(status_line.split(' ', 1)[0]))
+        reply = self.app(environ, start_response)
+        try:
+            for _ in reply:
+                pass
+        finally:
+            if hasattr(reply, 'close'):
+                reply.close()
+        return status[0]
+
+class HTTPClient:
+    """
+    Makes requests over HTTP, with one connection per client thread
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.local = threading.local()
+
+    def request(self, method, path, body=None):
+        """
+        Make a request, reading the whole reply. Returns the status code.
+        """
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=60)
+            self.local.connection = connection
+        headers = {'Authorization': TOKEN}
+        if body is not None:
+            body = json.dumps(body)
+            headers['Content-Type'] = 'application/json'
+        try:
+            connection.request(method, path, body, headers)
+            reply = connection.getresponse()
+            reply.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            self.local.connection = None
+            raise
+        return reply.status
+
+class _QuietHandler(wsgiref.simple_server.WSGIRequestHandler):
+    """
+    wsgiref request handler that does not log every request
+    """
+
+    def log_message(self, *_):
+        pass
+
+class _ThreadingWSGIServer(socketserver.ThreadingMixIn, wsgiref.simple_server.WSGIServer):
+    """
+    wsgiref server handling each connection in its own thread
+    """
+    daemon_threads = True
+
+def serve_wsgi(app):
+    """
+    Serve app on a free localhost port, returning (port, stop function)
+    """
+    server = wsgiref.simple_server.make_server('127.0.0.1', 0, app,
+                                               server_class=_ThreadingWSGIServer,
+                                               handler_class=_QuietHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    def stop():
+        server.shutdown()
+        server.server_close()
+    return (server.server_address[1], stop)
+
+def serve_asgi(app):
+    """
+    Serve app with uvicorn on a free localhost port, returning
+    (port, stop function)
+    """
+    import uvicorn  # pylint: disable=import-outside-toplevel
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=port,
+                                           log_level='warning', access_log=False))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise OSError('uvicorn did not start')
+        sleep(0.01)
+    def stop():
+        server.should_exit = True
+        thread.join()
+    return (port, stop)
+
+class LevelStats:
+    """
+    The latencies and errors of one concurrency level, by route, and
+    the peak resident memory while each route had requests in progress
+    """
+
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self.errors = collections.Counter()
+        self.in_flight = collections.Counter()
+        self.peak_rss = collections.Counter()
+        self.lock = threading.Lock()
+        self.elapsed = 0.0
+
+    def start(self, route):
+        """
+        Called as a request for route is sent
+        """
+        with self.lock:
+            self.in_flight[route] += 1
+
+    def finish(self, route, latency, success):
+        """
+        Called once the reply has been read
+        """
+        with self.lock:
+            self.in_flight[route] -= 1
+            self.latencies[route].append(latency)
+            if not success:
+                self.errors[route] += 1
+
+    def sample(self):
+        """
+        Record the current resident memory against the routes with
+        requests in progress
+        """
+        rss = current_rss()
+        with self.lock:
+            for (route, count) in self.in_flight.items():
+                if count > 0 and rss > self.peak_rss[route]:
+                    self.peak_rss[route] = rss
+
+    def summary(self, concurrency):
+        """
+        List of dicts of the results by route
+        """
+        results = []
+        for route in sorted(self.latencies):
+            latencies = sorted(self.latencies[route])
+            results.append({'concurrency': concurrency,
+                            'route': route,
+                            'requests': len(latencies),
+                            'errors': self.errors[route],
+                            'requests_per_sec': len(latencies) / self.elapsed,
+                            'p50_ms': mmbop_bench.percentile(latencies, 50) * 1000,
+                            'p95_ms': mmbop_bench.percentile(latencies, 95) * 1000,
+                            'p99_ms': mmbop_bench.percentile(latencies, 99) * 1000,
+                            'peak_rss_mb': self.peak_rss[route] / 1048576.0})
+        return results
+
+class Workload:
+    """
+    The mix of requests the client threads make. Hosts added by
+    hostadd requests are deleted by later hostdel requests (a hostdel
+    with none to delete is made as a hostadd).
+    """
+
+    def __init__(self, client, records, mix):
+        self.client = client
+        self.records = records
+        (self.names, self.weights) = zip(*mix)
+        self.added = collections.deque()
+        self.next_host = 0
+        self.lock = threading.Lock()
+
+    def _send(self, stats, route, path, body=None):
+        """
+        Make one request, recording it in stats (if not None)
+        """
+        method = route.split(' ', 1)[0]
+        if stats:
+            stats.start(route)
+        started = perf_counter()
+        try:
+            success = self.client.request(method, path, body) < 400
+        except (OSError, http.client.HTTPException):
+            success = False
+        if stats:
+            stats.finish(route, perf_counter() - started, success)
+        return success
+
+    def query(self, rng, stats):
+        """
+        GET /query of a random host
+        """
+        self._send(stats, 'GET /query', '/query?entry=host%07d.%s'
+                   % (rng.randint(1, self.records), mmbop_bench.BENCH_ZONE))
+
+    def hostsearch(self, rng, stats):
+        """
+        GET /hostsearch of the zone, for a term matching about 100 hosts
+        """
+        self._send(stats, 'GET /hostsearch', '/hostsearch?domain=%s&term=host%05d'
+                   % (mmbop_bench.BENCH_ZONE, rng.randint(0, max(self.records // 100, 1))))
+
+    def hostadd(self, _, stats):
+        """
+        POST /hostmodify of a new host
+        """
+        with self.lock:
+            self.next_host += 1
+            index = self.next_host
+        fqdn = 'load%07d.%s' % (index, mmbop_bench.BENCH_ZONE)
+        address = str(ipaddress.ip_address('10.160.0.0') + index)
+        if self._send(stats, 'POST /hostmodify', '/hostmodify',
+                      {'fqdn': fqdn, 'addr': address}):
+            with self.lock:
+                self.added.append(fqdn)
+
+    def hostdel(self, rng, stats):
+        """
+        DELETE /hostmodify of a host added by hostadd
+        """
+        with self.lock:
+            fqdn = self.added.popleft() if self.added else None
+        if fqdn is None:
+            self.hostadd(rng, stats)
+            return
+        self._send(stats, 'DELETE /hostmodify', '/hostmodify', {'entry': fqdn})
+
+    def zonelist(self, _, stats):
+        """
+        GET /zonelist
+        """
+        self._send(stats, 'GET /zonelist', '/zonelist')
+
+    def warm_up(self):
+        """
+        Make one request of each kind in the mix, unrecorded
+        """
+        rng = random.Random(0)
+        for name in self.names:
+            getattr(self, name)(rng, None)
+
+    def run_level(self, concurrency, duration, seed):
+        """
+        Run concurrency client threads for duration seconds,
+        returning the LevelStats
+        """
+        stats = LevelStats()
+        deadline = perf_counter() + duration
+        def client(number):
+            rng = random.Random(seed * 10000 + number)
+            operations = [getattr(self, x) for x in self.names]
+            while perf_counter() < deadline:
+                rng.choices(operations, self.weights)[0](rng, stats)
+        threads = [threading.Thread(target=client, args=(x,), daemon=True)
+                   for x in range(concurrency)]
+        started = perf_counter()
+        for thread in threads:
+            thread.start()
+        while any(x.is_alive() for x in threads):
+            stats.sample()
+            sleep(RSS_INTERVAL)
+        stats.elapsed = perf_counter() - started
+        return stats
+
+def print_level(results, out=sys.stdout):
+    """
+    Print the results of one concurrency level as a table
+    """
+    total = sum(x['requests'] for x in results)
+    rate = sum(x['requests_per_sec'] for x in results)
+    peak = max([x['peak_rss_mb'] for x in results] or [0.0])
+    concurrency = results[0]['concurrency'] if results else 0
+    out.write('\nconcurrency %d: %d requests, %.1f req/s, peak RSS %.1f MB\n'
+              % (concurrency, total, rate, peak))
+    out.write('%-20s %9s %7s %9s %9s %9s %9s %8s\n'
+              % ('route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'RSS MB'))
+    for result in results:
+        out.write('%-20s %9d %7d %9.1f %9.2f %9.2f %9.2f %8.1f\n'
+                  % (result['route'], result['requests'], result['errors'],
+                     result['requests_per_sec'], result['p50_ms'], result['p95_ms'],
+                     result['p99_ms'], result['peak_rss_mb']))
+    out.flush()
+
+def parse_mix(mix):
+    """
+    Convert NAME=WEIGHT,... to a list of tuples of form (name, weight).
+    Raises ValueError if it is not valid.
+    """
+    parsed = []
+    for item in mix.split(','):
+        if not item.strip():
+            continue
+        (name, _, weight) = item.partition('=')
+        name = name.strip()
+        if name not in OPERATIONS:
+            raise ValueError('Unknown request %s (use %s)' % (name, ', '.join(OPERATIONS)))
+        parsed.append((name, float(weight or 1)))
+    if not parsed or sum(x[1] for x in parsed) <= 0:
+        raise ValueError('The mix has no requests')
+    return parsed
+
+def parse_arguments():
+    """
+    Uses argparse to define and parse command-line arguments
+    """
+    help_width = lambda prog: argparse.HelpFormatter(prog, max_help_position=30)
+    parser = argparse.ArgumentParser(description='Load test the mmbop API against local '
+                                     'stand-ins for BIND', formatter_class=help_width)
+    parser.add_argument('--server', choices=('inprocess', 'wsgi', 'asgi'), default='inprocess',
+                        help='Call the app directly, or serve it with wsgiref or uvicorn '
+                        '(default: inprocess)')
+    parser.add_argument('--concurrency', metavar='N,N', default='1,2,4,8,16',
+                        help='Client threads at each level (default: 1,2,4,8,16)')
+    parser.add_argument('--duration', metavar='SECONDS', type=float, default=10.0,
+                        help='Length of each level (default: 10)')
+    parser.add_argument('--mix', metavar='NAME=WEIGHT,...',
+                        default='query=60,hostsearch=10,hostadd=10,hostdel=10,zonelist=10',
+                        help='Relative weights of the requests (default: query=60,'
+                        'hostsearch=10,hostadd=10,hostdel=10,zonelist=10)')
+    parser.add_argument('--records', metavar='N', type=int, default=10000,
+                        help='Hosts in the zone queried and searched (default: 10000)')
+    parser.add_argument('--dump-zones', metavar='N', type=int, default=1000,
+                        help='Extra zones listed by /zonelist (default: 1000)')
+    parser.add_argument('-o', '--option', metavar='KEY=VALUE', action='append', default=[],
+                        help='Set an mmbop configuration option (e.g. zonelistage=60)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for the random requests')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the results as JSON, one route and level per line')
+    args = parser.parse_args()
+    try:
+        args.concurrency = [int(x) for x in args.concurrency.split(',') if x.strip()]
+        args.mix = parse_mix(args.mix)
+    except ValueError as val_err:
+        parser.error(str(val_err))
+    if not args.concurrency or min(args.concurrency) < 1 or args.records < 1:
+        parser.error('concurrency and records must be at least 1')
+    for option in args.option:
+        if '=' not in option:
+            parser.error('--option must be of form KEY=VALUE')
+    # Only the query zone and the dump zones are needed (see mmbop_bench.load_zones)
+    args.sizes = []
+    return args
+
+def main():
+    """
+    Direct calling function
+    """
+    args = parse_arguments()
+    with tempfile.TemporaryDirectory(prefix='mmbop-loadtest-') as work_dir:
+        key_file = os.path.join(work_dir, 'bench.key')
+        mmbop_bench.write_key_file(key_file)
+        sys.stderr.write('Loading zones...\n')
+        zones = mmbop_bench.load_zones(args)
+        standins = mmbop_bench.StandIns(zones, key_file, work_dir)
+        mmbop_bench.write_config(mmbop_bench.bench_config(standins, work_dir, args.option),
+                                 work_dir, TOKEN)
+        # mmbop_api reads its configuration from the current directory on import
+        old_dir = os.getcwd()
+        os.chdir(work_dir)
+        stop = None
+        try:
+            # pylint: disable=import-outside-toplevel
+            if args.server == 'asgi':
+                import mmbop_asgi
+                (port, stop) = serve_asgi(mmbop_asgi.APP)
+                client = HTTPClient(port)
+            else:
+                import mmbop_api
+                if args.server == 'wsgi':
+                    (port, stop) = serve_wsgi(mmbop_api.APP)
+                    client = HTTPClient(port)
+                else:
+                    client = InProcessClient(mmbop_api.APP)
+            workload = Workload(client, args.records, args.mix)
+            workload.warm_up()
+            for concurrency in args.concurrency:
+                results = workload.run_level(concurrency, args.duration,
+                                             args.seed).summary(concurrency)
+                if args.json:
+                    for result in results:
+                        print(json.dumps(result))
+                    sys.stdout.flush()
+                else:
+                    print_level(results)
+        finally:
+            if stop:
+                stop()
+            standins.close()
+            os.chdir(old_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+"""
+Shared setup of the mmbop tests. The mmbop modules are imported from
+the directory above, so the tests run from a checkout. The tests that
+need BIND use the stand-ins of mmbop_bench, started for each test.
+"""
+import argparse
+import os
+import sys
+import pytest
+
+MMBOP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if MMBOP_DIR not in sys.path:
+    sys.path.insert(0, MMBOP_DIR)
+import mmbop_bench  # pylint: disable=wrong-import-position
+import mmbop_core  # pylint: disable=wrong-import-position
+
+@pytest.fixture(name='standins')
+def fixture_standins(tmp_path):
+    """
+    The stand-ins of mmbop_bench (name server and control channel),
+    serving bench.example with 20 hosts, their reverse zone, the
+    catalog zone and two small zones below dump.bench.example
+    """
+    key_file = str(tmp_path / 'bench.key')
+    mmbop_bench.write_key_file(key_file)
+    zones = mmbop_bench.load_zones(argparse.Namespace(records=20, sizes=[], dump_zones=2))
+    standins = mmbop_bench.StandIns(zones, key_file, str(tmp_path))
+    yield standins
+    standins.close()
+
+@pytest.fixture(name='config')
+def fixture_config(standins, tmp_path):
+    """
+    The mmbop configuration (as read_config returns it) for the stand-ins
+    """
+    return mmbop_bench.bench_config(standins, str(tmp_path), [])
+
+@pytest.fixture(name='backends')
+def fixture_backends(config):
+    """
+    Backends (in the native modes) using the stand-ins
+    """
+    return mmbop_core.Backends(config)
@@ -0,0 +1,52 @@
+"""
+Address ranges of hostsearch --range (parse_address_range)
+"""
+from ipaddress import ip_address
+import pytest
+from mmbop_core import parse_address_range
+
+@pytest.mark.parametrize('address_range,first,last', [
+    ('10.4.16.0/22', '10.4.16.0', '10.4.19.255'),
+    # The host bits of a network are ignored
+    ('10.4.17.9/22', '10.4.16.0', '10.4.19.255'),
+    ('10.4.16.5/32', '10.4.16.5', '10.4.16.5'),
+    ('10.4.16.5-10.4.17.20', '10.4.16.5', '10.4.17.20'),
+    (' 10.4.16.5 - 10.4.16.5 ', '10.4.16.5', '10.4.16.5'),
+    ('10.4.16.5', '10.4.16.5', '10.4.16.5'),
+    ('2001:db8::/126', '2001:db8::', '2001:db8::3'),
+    ('2001:db8::1-2001:db8::1:0', '2001:db8::1', '2001:db8::1:0'),
+    ('2001:db8::7', '2001:db8::7', '2001:db8::7'),
+])
+def test_parse(address_range, first, last):
+    """
+    Networks, start-end ranges and single addresses give their first
+    and last address
+    """
+    assert parse_address_range(address_range) == (ip_address(first), ip_address(last))
+
+@pytest.mark.parametrize('address_range', [
+    '10.4.17.20-10.4.16.5',
+    '10.4.16.5-2001:db8::1',
+    '10.4.16.0/33',
+    '10.4.16',
+    'host0000001.bench.example',
+    '10.4.16.5-',
+    '',
+])
+def test_invalid(address_range):
+    """
+    Anything else (including a range going down, or from IPv4 to IPv6)
+    raises ValueError
+    """
+    with pytest.raises(ValueError):
+        parse_address_range(address_range)
+
+def test_search(backends):
+    """
+    The PTR records of a range are found in address order
+    """
+    found = list(backends.dig.iter_range('10.0.0.18-10.0.0.30'))
+    assert [x.split()[-1] for x in found] == ['host%07d.bench.example.' % x
+                                              for x in (18, 19, 20)]
+    assert list(backends.dig.iter_range('10.0.0.8/29'))[0].split()[-1] == \
+        'host0000008.bench.example.'
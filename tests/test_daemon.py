@@ -0,0 +1,202 @@
+"""
+The mmbop daemon (mmbop.py serve) and the CLI sending it commands
+"""
+import os
+import shlex
+import socket
+import subprocess
+import sys
+import threading
+import pytest
+import mmbop_bench
+import mmbop_core
+
+MMBOP_PY = os.path.join(mmbop_bench.MMBOP_DIR, 'mmbop.py')
+HOST = 'host0000001.bench.example'
+HOST_ANSWER = 'host0000001.bench.example.\t3600\tIN\tA\t10.0.0.1\n'
+
+@pytest.fixture(name='daemon')
+def fixture_daemon(backends, tmp_path):
+    """
+    The socket of an mmbop daemon (run in this process) for the stand-ins
+    """
+    path = str(tmp_path / 'mmbop.sock')
+    server = mmbop_core.CommandServer(path, backends)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield path
+    server.shutdown()
+    server.server_close()
+
+class FakeDaemon:
+    """
+    Listens on a socket like the daemon, and answers the first request
+    line with reply (bytes), whatever it is
+    """
+
+    def __init__(self, path, reply):
+        self.reply = reply
+        self.lines = []
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(1)
+        self.thread = threading.Thread(target=self._answer, daemon=True)
+        self.thread.start()
+
+    def _answer(self):
+        """
+        Read one request line and send the reply
+        """
+        try:
+            (conn, _) = self.listener.accept()
+        except OSError:
+            return
+        with conn:
+            self.lines.append(conn.makefile('rb').readline().decode())
+            conn.sendall(self.reply)
+
+    def close(self):
+        """
+        Stop listening (waking the accept, if no request came)
+        """
+        try:
+            self.listener.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.listener.close()
+        self.thread.join(5)
+
+@pytest.fixture(name='fake_daemon')
+def fixture_fake_daemon(tmp_path):
+    """
+    Function starting a FakeDaemon (on a socket in tmp_path) with a reply
+    """
+    started = []
+    def start(reply):
+        started.append(FakeDaemon(str(tmp_path / 'fake.sock'), reply))
+        return started[-1]
+    yield start
+    for fake in started:
+        fake.close()
+
+def run_cli(cwd, *argv):
+    """
+    Run mmbop.py with argv, in cwd, returning the CompletedProcess
+    (with stdout and stderr as bytes)
+    """
+    return subprocess.run([sys.executable, MMBOP_PY] + list(argv), cwd=str(cwd),
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=60,
+                          check=False)
+
+def send(path, line):
+    """
+    Send a request line to the daemon on path, returning the whole reply
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(path)
+        client.sendall(line)
+        reply = b''
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                return reply
+            reply += chunk
+
+def test_forward(daemon, tmp_path):
+    """
+    The command is run by the daemon (there is no mmbop.ini for the CLI
+    to run it with), and its output and status are those of the CLI
+    """
+    cli = run_cli(tmp_path, '-s', daemon, 'query', HOST)
+    assert (cli.returncode, cli.stdout, cli.stderr) == (0, HOST_ANSWER.encode(), b'')
+    assert send(daemon, ('query %s\n' % HOST).encode()) == HOST_ANSWER.encode() + b'\x000\n'
+
+def test_socket_from_config(daemon, tmp_path):
+    """
+    Without --socket, the socket is taken from the config file
+    """
+    with open(str(tmp_path / 'mmbop.ini'), 'w') as conf_file:
+        conf_file.write('[BACKEND]\nsocket: %s\n' % daemon)
+    cli = run_cli(tmp_path, 'query', HOST)
+    assert (cli.returncode, cli.stdout) == (0, HOST_ANSWER.encode())
+
+def test_command_failed(daemon, backends, tmp_path, monkeypatch):
+    """
+    A command that fails with an exception has exit status 1
+    """
+    def failed(*_):
+        raise mmbop_core.DigQueryError('dig failed')
+    monkeypatch.setattr(backends.dig, 'find_record', failed)
+    cli = run_cli(tmp_path, '--socket=' + daemon, 'query', HOST)
+    assert (cli.returncode, cli.stdout) == (1, b'Error: dig failed\n')
+
+@pytest.mark.parametrize('line', [b'serve\n', b'import hosts.csv\n', b'-v query x\n',
+                                  b"query 'x\n", b'nosuch\n', b'\n'],
+                         ids=['serve', 'import', 'verbose', 'quote', 'unknown', 'empty'])
+def test_invalid_request(daemon, line):
+    """
+    Requests that are not commands the daemon runs have exit status 2
+    """
+    reply = send(daemon, line)
+    assert reply.startswith(b'Error: invalid command')
+    assert reply.endswith(b'\x002\n')
+
+def test_quoting(fake_daemon, tmp_path):
+    """
+    The words of the command line reach the daemon as they were given
+    """
+    fake = fake_daemon(b'done\n\x000\n')
+    argv = ['hostadd', "it's here", '10.0.0.1', '--force', 'a "b" $c', '']
+    cli = run_cli(tmp_path, '-s', str(tmp_path / 'fake.sock'), *argv)
+    assert (cli.returncode, cli.stdout) == (0, b'done\n')
+    fake.close()
+    assert fake.lines[0].endswith('\n')
+    # The options before the command (here --socket) are sent as well
+    assert shlex.split(fake.lines[0]) == ['-s', str(tmp_path / 'fake.sock')] + argv
+
+@pytest.mark.parametrize('output,status', [
+    (b'', 0),
+    (b'line\n', 7),
+    (b'with \x00 inside\n', 1),
+    (b'x' * 200000 + b'\n' + b'9' * 10, 12),
+], ids=['empty', 'line', 'nul', 'large'])
+def test_reply(fake_daemon, tmp_path, output, status):
+    """
+    The output is written as sent, however it is split, and the status
+    line is the exit status
+    """
+    fake_daemon(output + b'\x00%d\n' % status)
+    cli = run_cli(tmp_path, '-s', str(tmp_path / 'fake.sock'), 'query', HOST)
+    assert (cli.returncode, cli.stdout, cli.stderr) == (status, output, b'')
+
+def test_stopped_early(fake_daemon, tmp_path):
+    """
+    A reply without the status line (the daemon stopped) is a failure
+    """
+    fake_daemon(b'partial output')
+    cli = run_cli(tmp_path, '-s', str(tmp_path / 'fake.sock'), 'query', HOST)
+    assert (cli.returncode, cli.stdout) == (1, b'partial output')
+    assert b'stopped before the command was done' in cli.stderr
+
+def test_invalid_status(fake_daemon, tmp_path):
+    """
+    A status line that is not a number is a failure
+    """
+    fake_daemon(b'output\n\x00ok\n')
+    cli = run_cli(tmp_path, '-s', str(tmp_path / 'fake.sock'), 'query', HOST)
+    assert (cli.returncode, cli.stdout) == (1, b'output\n')
+    assert b"sent an invalid status 'ok'" in cli.stderr
+
+@pytest.mark.parametrize('argv', [['-s', 'missing.sock', 'query', HOST],
+                                  ['-s', 'fake.sock', '-v', 'query', HOST],
+                                  ['-s', 'fake.sock', '-c', 'mmbop.ini', 'query', HOST]])
+def test_run_locally(fake_daemon, config, tmp_path, argv):
+    """
+    With no daemon listening, or options that only apply to the CLI,
+    the command is run by the CLI itself
+    """
+    mmbop_bench.write_config(config, str(tmp_path))
+    fake = fake_daemon(b'from the daemon\n\x000\n')
+    cli = run_cli(tmp_path, *argv)
+    assert (cli.returncode, cli.stdout) == (0, HOST_ANSWER.encode())
+    fake.close()
+    assert fake.lines == []
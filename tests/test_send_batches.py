@@ -0,0 +1,130 @@
+"""
+Sending bulk changes as update messages (NSUpdate._send_batches)
+"""
+import pytest
+import mmbop_core
+
+# The batches are sent with NSUpdate._send_batches directly
+# pylint: disable=protected-access
+
+@pytest.fixture(name='sent')
+def fixture_sent(monkeypatch):
+    """
+    The list of the nsupdate commands of each update message sent
+    (by any NSUpdate), which are still sent to the stand-ins
+    """
+    sent = []
+    call_modify = mmbop_core.NSUpdate.call_modify
+    def recorded(nsupdate, commands):
+        sent.append(commands)
+        return call_modify(nsupdate, commands)
+    monkeypatch.setattr(mmbop_core.NSUpdate, 'call_modify', recorded)
+    return sent
+
+def nsupdate_of(config, **options):
+    """
+    An NSUpdate for the stand-ins, with options (such as maxbatch) set
+    """
+    return mmbop_core.Backends(dict(config, **options)).nsupdate
+
+def host_update(index):
+    """
+    The update of form (key, name, command) adding host index (above
+    the hosts the stand-ins start with)
+    """
+    name = 'new%04d.bench.example' % index
+    return (index, name, 'update add %s 3600 a 10.1.0.%d' % (name, index))
+
+def ptr_update(index):
+    """
+    The update adding the PTR record of host_update(index)
+    """
+    ptr = '%d.0.1.10.in-addr.arpa' % index
+    return (index, ptr, 'update add %s 3600 ptr new%04d.bench.example.' % (ptr, index))
+
+def records(standins, zone_name, rtype):
+    """
+    The names of the records of rtype in a zone of the stand-ins
+    """
+    zone = standins.zones.zones[zone_name]
+    return sorted(x.name.rstrip('.') for rrset in zone.records.values()
+                  for x in rrset if x.rtype == rtype)
+
+def updates_of(commands):
+    """
+    The names updated by the nsupdate commands of one message
+    """
+    return [x.split()[2] for x in commands.split('\n') if x.startswith('update')]
+
+def test_max_batch(config, standins, sent):
+    """
+    The updates of each zone are sent in messages of at most maxbatch
+    records, and the zones are not mixed
+    """
+    nsupdate = nsupdate_of(config, maxbatch='3')
+    updates = [host_update(x) for x in range(1, 8)] + [ptr_update(x) for x in (1, 2)]
+    results = nsupdate._send_batches(updates)
+    assert results == {x: (True, None) for x in range(1, 8)}
+    assert [len(updates_of(x)) for x in sent] == [3, 3, 1, 2]
+    assert [x.split('\n')[0] for x in sent] == ['zone bench.example'] * 3 + [
+        'zone 10.in-addr.arpa']
+    assert all(x.endswith('\nsend') for x in sent)
+    assert [x for x in records(standins, 'bench.example', 'A') if x.startswith('new')] == [
+        'new%04d.bench.example' % x for x in range(1, 8)]
+    assert '2.0.1.10.in-addr.arpa' in records(standins, '10.in-addr.arpa', 'PTR')
+
+def test_max_update_bytes(config, sent, monkeypatch):
+    """
+    A message also ends before it would pass MAX_UPDATE_BYTES
+    """
+    nsupdate = nsupdate_of(config)
+    monkeypatch.setattr(nsupdate, 'MAX_UPDATE_BYTES', 2 * len(host_update(1)[2]) + 1)
+    results = nsupdate._send_batches([host_update(x) for x in range(1, 6)])
+    assert all(x[0] for x in results.values())
+    assert [len(updates_of(x)) for x in sent] == [2, 2, 1]
+
+def test_failed_message(config, standins, sent):
+    """
+    Every update of a message fails with it, and a key fails if any of
+    its updates failed
+    """
+    nsupdate = nsupdate_of(config, maxbatch='2')
+    # The stand-ins do not update a zone loaded for transfer only
+    standins.zones.add_zone('static.bench.example', static=True)
+    updates = [host_update(1), (2, 'a.static.bench.example', 'update add '
+                                'a.static.bench.example 3600 a 10.1.0.2'),
+               host_update(3), (1, 'b.static.bench.example', 'update add '
+                                'b.static.bench.example 3600 a 10.1.0.1')]
+    results = nsupdate._send_batches(updates)
+    assert results[3] == (True, None)
+    assert not results[1][0] and 'NOTAUTH' in results[1][1]
+    assert not results[2][0] and 'NOTAUTH' in results[2][1]
+    assert len(sent) == 2
+
+def test_notzone_fallback(backends, standins, sent, monkeypatch):
+    """
+    If the zone found for the names was wrong (the server replies
+    NOTZONE), each update is sent on its own, and the server finds
+    its zone
+    """
+    monkeypatch.setattr(backends.dig, 'find_zone', lambda name: 'z00000.dump.bench.example')
+    results = backends.nsupdate._send_batches([host_update(x) for x in range(1, 4)])
+    assert results == {x: (True, None) for x in range(1, 4)}
+    assert sent[0].startswith('zone z00000.dump.bench.example\n')
+    assert len(updates_of(sent[0])) == 3
+    assert sent[1:] == [host_update(x)[2] + '\nsend' for x in range(1, 4)]
+    assert [x for x in records(standins, 'bench.example', 'A') if x.startswith('new')] == [
+        'new%04d.bench.example' % x for x in range(1, 4)]
+
+def test_notzone_fallback_failure(backends, standins, sent, monkeypatch):
+    """
+    After a NOTZONE reply, the updates that fail on their own fail alone
+    """
+    standins.zones.add_zone('static.bench.example', static=True)
+    monkeypatch.setattr(backends.dig, 'find_zone', lambda name: 'z00000.dump.bench.example')
+    updates = [host_update(1), (2, 'a.static.bench.example',
+                                'update add a.static.bench.example 3600 a 10.1.0.2')]
+    results = backends.nsupdate._send_batches(updates)
+    assert results[1] == (True, None)
+    assert not results[2][0] and 'NOTAUTH' in results[2][1]
+    assert len(sent) == 3
@@ -0,0 +1,136 @@
+"""
+TSIG signing and verification (TSIGKey)
+"""
+import pytest
+import mmbop_bench
+import mmbop_core
+from mmbop_core import DNSMessage, DNSRecord, DNSWireError, TSIGKey
+
+SECRET = b'0123456789abcdef0123456789abcdef'
+
+def query_message():
+    """
+    An SOA query, as DNSUpdater and DNSClient build them
+    """
+    message = DNSMessage(msg_id=4660)
+    message.question.append(('bench.example.', 'SOA', 'IN'))
+    return message
+
+def reply_message():
+    """
+    The reply to query_message
+    """
+    reply = DNSMessage(msg_id=4660, flags=mmbop_core.FLAG_QR | mmbop_core.FLAG_AA)
+    reply.question.append(('bench.example.', 'SOA', 'IN'))
+    reply.answer.append(DNSRecord('bench.example.', 3600, 'IN', 'SOA',
+                                  'ns.bench.example. admin.bench.example. 7 3600 600 86400 60'))
+    return reply
+
+def signed(key, message, request_mac=None):
+    """
+    Return tuple of form: (bytes:wire, DNSMessage:parsed, bytes:mac)
+    of the message signed with key
+    """
+    (wire, mac) = key.sign(message, request_mac)
+    return (wire, DNSMessage.from_wire(wire), mac)
+
+@pytest.mark.parametrize('algorithm', sorted(mmbop_core.TSIG_ALGORITHMS))
+def test_sign_verify(algorithm):
+    """
+    A signed message verifies, with the mac it was signed with
+    """
+    key = TSIGKey('bench-key', algorithm, SECRET)
+    (wire, message, mac) = signed(key, query_message())
+    assert message.question == [('bench.example.', 'SOA', 'IN')]
+    assert key.verify(wire, message) == mac
+
+def test_reply_signed_with_request_mac():
+    """
+    A reply verifies only with the mac of the request it answers
+    """
+    key = TSIGKey('bench-key', 'hmac-sha256', SECRET)
+    (_, _, request_mac) = signed(key, query_message())
+    (wire, reply, _) = signed(key, reply_message(), request_mac)
+    assert reply.answer[0].value.split()[2] == '7'
+    key.verify(wire, reply, request_mac)
+    with pytest.raises(DNSWireError, match='does not match'):
+        key.verify(wire, reply)
+    with pytest.raises(DNSWireError, match='does not match'):
+        key.verify(wire, reply, bytes(len(request_mac)))
+
+def test_tampered_message():
+    """
+    A change to the signed message after signing is found
+    """
+    key = TSIGKey('bench-key', 'hmac-sha256', SECRET)
+    (wire, _, _) = signed(key, reply_message())
+    # The serial of the SOA record (7) is the last byte before its refresh
+    position = wire.index(b'\x00\x00\x00\x07\x00\x00\x0e\x10') + 3
+    tampered = wire[:position] + b'\x08' + wire[position + 1:]
+    with pytest.raises(DNSWireError, match='does not match'):
+        key.verify(tampered, DNSMessage.from_wire(tampered))
+
+def test_other_key():
+    """
+    A message signed with another secret, name or algorithm is rejected
+    """
+    key = TSIGKey('bench-key', 'hmac-sha256', SECRET)
+    (wire, message, _) = signed(key, query_message())
+    with pytest.raises(DNSWireError, match='does not match'):
+        TSIGKey('bench-key', 'hmac-sha256', SECRET[::-1]).verify(wire, message)
+    with pytest.raises(DNSWireError, match='does not match'):
+        TSIGKey('other-key', 'hmac-sha256', SECRET).verify(wire, message)
+    with pytest.raises(DNSWireError, match='unexpected algorithm'):
+        TSIGKey('bench-key', 'hmac-sha512', SECRET).verify(wire, message)
+
+def test_unsigned_reply():
+    """
+    A reply without a TSIG record is rejected
+    """
+    key = TSIGKey('bench-key', 'hmac-sha256', SECRET)
+    wire = reply_message().to_wire()
+    with pytest.raises(DNSWireError, match='not signed'):
+        key.verify(wire, DNSMessage.from_wire(wire))
+
+def test_time_outside_fudge(monkeypatch):
+    """
+    A signature made more than the fudge away from now is rejected
+    """
+    key = TSIGKey('bench-key', 'hmac-sha256', SECRET)
+    (wire, message, _) = signed(key, query_message())
+    signed_at = mmbop_core.time()
+    monkeypatch.setattr(mmbop_core, 'time', lambda: signed_at + mmbop_core.TSIG_FUDGE + 10)
+    with pytest.raises(DNSWireError, match='fudge'):
+        key.verify(wire, message)
+
+def test_unsupported_algorithm():
+    """
+    Only the HMAC algorithms of RFC 8945 are accepted
+    """
+    with pytest.raises(DNSWireError, match='Unsupported'):
+        TSIGKey('bench-key', 'gss-tsig', SECRET)
+
+def test_from_file(tmp_path):
+    """
+    The key is read from a BIND key file
+    """
+    key_file = str(tmp_path / 'bench.key')
+    mmbop_bench.write_key_file(key_file)
+    key = TSIGKey.from_file(key_file)
+    assert key.name == 'bench-key.'
+    assert key.algorithm == 'hmac-sha256.'
+    (wire, message, _) = signed(key, query_message())
+    TSIGKey.from_file(key_file, 'bench-key').verify(wire, message)
+    with pytest.raises(DNSWireError, match='No usable key'):
+        TSIGKey.from_file(key_file, 'other-key')
+
+def test_from_file_comments(tmp_path):
+    """
+    Comments are skipped, but not a // in the secret
+    """
+    key_file = tmp_path / 'rndc.key'
+    key_file.write_text('# rndc-confgen\n// key "old-key" { algorithm hmac-md5; };\n'
+                        'key "rndc-key" { // used by rndc\n\talgorithm hmac-sha256;\n'
+                        '\tsecret "ab//cd+/Yw=="; # base64\n};\n')
+    key = TSIGKey.from_file(str(key_file))
+    assert (key.name, key.secret) == ('rndc-key.', b'i\xbf\xffq\xdf\xbfc')
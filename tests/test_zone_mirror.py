@@ -0,0 +1,141 @@
+"""
+Applying zone transfers to the replicas of ZoneMirror
+"""
+import pytest
+from mmbop_core import ZoneMirror
+
+# The transfers are given to ZoneMirror._apply directly
+# pylint: disable=protected-access
+
+ZONE = 'bench.example'
+
+def soa(serial):
+    """
+    The SOA line of the zone at serial, as the transfer has it
+    """
+    return ('bench.example. 3600 IN SOA ns.bench.example. admin.bench.example. '
+            '%d 3600 600 86400 60' % serial)
+
+def host(index, address):
+    """
+    The A record line of host index
+    """
+    return 'host%07d.bench.example. 3600 IN A %s' % (index, address)
+
+def axfr(serial, hosts):
+    """
+    The lines of a whole zone transfer, with hosts (index: address)
+    """
+    return [soa(serial)] + [host(x, y) for (x, y) in sorted(hosts.items())] + [soa(serial)]
+
+@pytest.fixture(name='mirror')
+def fixture_mirror():
+    """
+    A ZoneMirror of the zone (which is only given transfers, so needs no dig)
+    """
+    return ZoneMirror(None, [ZONE])
+
+@pytest.fixture(name='loaded')
+def fixture_loaded(mirror):
+    """
+    The zone replica, loaded at serial 10 with hosts 1 to 3
+    """
+    zone = mirror.zones[ZONE]
+    assert mirror._apply(zone, axfr(10, {1: '10.0.0.1', 2: '10.0.0.2', 3: '10.0.0.3'}))
+    return zone
+
+def hosts_of(zone):
+    """
+    The replica as a dict of name: sorted list of its lines
+    """
+    return {x: sorted(y) for (x, y) in zone['names'].items()}
+
+def test_axfr(mirror, loaded):
+    """
+    A whole zone transfer loads the replica
+    """
+    assert loaded['serial'] == 10
+    assert loaded['soa'] == soa(10)
+    assert hosts_of(loaded) == {'host0000001.bench.example': [host(1, '10.0.0.1')],
+                                'host0000002.bench.example': [host(2, '10.0.0.2')],
+                                'host0000003.bench.example': [host(3, '10.0.0.3')]}
+    assert list(mirror.transfer(ZONE))[0] == soa(10)
+
+def test_axfr_cut_short(mirror):
+    """
+    A whole zone transfer without its last SOA is not loaded
+    """
+    zone = mirror.zones[ZONE]
+    assert not mirror._apply(zone, axfr(10, {1: '10.0.0.1'})[:-1])
+    assert not mirror._apply(zone, [host(1, '10.0.0.1')])
+    assert not mirror._apply(zone, [])
+    assert zone['serial'] is None
+    assert zone['names'] == {}
+
+def test_ixfr(loaded, mirror):
+    """
+    One sequence of differences deletes, changes and adds records
+    """
+    changes = [soa(11),
+               soa(10), host(1, '10.0.0.1'), host(2, '10.0.0.2'),
+               soa(11), host(2, '10.0.0.22'), host(4, '10.0.0.4'),
+               soa(11)]
+    assert mirror._apply(loaded, changes)
+    assert loaded['serial'] == 11
+    assert loaded['soa'] == soa(11)
+    assert hosts_of(loaded) == {'host0000002.bench.example': [host(2, '10.0.0.22')],
+                                'host0000003.bench.example': [host(3, '10.0.0.3')],
+                                'host0000004.bench.example': [host(4, '10.0.0.4')]}
+
+def test_ixfr_sequences(loaded, mirror):
+    """
+    Several sequences of differences are applied in turn
+    """
+    changes = [soa(13),
+               soa(10), host(3, '10.0.0.3'), soa(11), host(3, '10.0.0.33'),
+               soa(11), soa(12), host(5, '10.0.0.5'),
+               soa(12), host(5, '10.0.0.5'), soa(13), host(1, '10.0.0.11'),
+               soa(13)]
+    assert mirror._apply(loaded, changes)
+    assert loaded['serial'] == 13
+    assert hosts_of(loaded) == {
+        'host0000001.bench.example': sorted([host(1, '10.0.0.1'), host(1, '10.0.0.11')]),
+        'host0000002.bench.example': [host(2, '10.0.0.2')],
+        'host0000003.bench.example': [host(3, '10.0.0.33')]}
+
+@pytest.mark.parametrize('cut', [2, 4, 6, 7])
+def test_ixfr_cut_short(loaded, mirror, cut):
+    """
+    A transfer that stops before the last SOA changes nothing, wherever
+    it stops (in deletions, additions, or between sequences)
+    """
+    changes = [soa(12),
+               soa(10), host(1, '10.0.0.1'), soa(11), host(4, '10.0.0.4'),
+               soa(11), soa(12),
+               soa(12)]
+    before = hosts_of(loaded)
+    assert not mirror._apply(loaded, changes[:cut])
+    assert loaded['serial'] == 10
+    assert hosts_of(loaded) == before
+
+def test_ixfr_up_to_date(loaded, mirror):
+    """
+    A reply of the SOA alone means there are no changes
+    """
+    before = hosts_of(loaded)
+    assert mirror._apply(loaded, [soa(10)])
+    assert hosts_of(loaded) == before
+    # The SOA alone, at another serial, is not a usable reply
+    assert not mirror._apply(loaded, [soa(11)])
+    assert loaded['serial'] == 10
+
+def test_ixfr_whole_zone(loaded, mirror):
+    """
+    An IXFR the server answers with the whole zone replaces the replica
+    """
+    assert mirror._apply(loaded, axfr(14, {7: '10.0.0.7'}))
+    assert loaded['serial'] == 14
+    assert hosts_of(loaded) == {'host0000007.bench.example': [host(7, '10.0.0.7')]}
+    # An empty zone is the SOA twice, with the same serial
+    assert mirror._apply(loaded, [soa(15), soa(15)])
+    assert loaded['names'] == {}